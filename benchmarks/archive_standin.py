@@ -0,0 +1,294 @@
+"""
+A local stand-in for the archive API and the file store, so the ingester
+can be benchmarked offline.
+
+The server answers the two archive calls an ingestion makes (the upload
+and the frame record post) after a configurable latency, fails a
+configurable fraction of them with 400, 500 and 502 errors or md5
+duplicates, and caps the upload bandwidth shared by all connections, much
+like a site's uplink. Validation makes no archive calls, so it is left to
+the real ocs_ingester.
+
+ArchiveStandin.install() swaps upload_file_to_file_store,
+ingest_archive_record and the bulk ingest_archive_records in thewatcher
+for clients of the stand-in. The
+clients raise the same kinds of errors the real ingester does, so
+thewatcher's error handling, backoff and retries all get exercised.
+Connection refused is simulated on the client side by calling a port
+nothing listens on.
+
+Run on its own to poke at it with curl:
+
+    python benchmarks/archive_standin.py --port 8765 --latency upload=0.2
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+import requests
+import requests.adapters
+
+try:
+    from ocs_ingester.exceptions import DoNotRetryError
+except ImportError:
+    class DoNotRetryError(Exception):
+        pass
+
+
+ENDPOINTS = ('upload', 'record')
+ERROR_KINDS = ('400', '500', '502', 'duplicate', 'refused')
+
+
+def parse_pairs(pairs, kinds, what):
+    """
+    ['upload=0.2', ...] -> {'upload': 0.2}
+    """
+    values = {}
+    for pair in pairs or []:
+        for part in pair.split(','):
+            name, _, value = part.partition('=')
+            if name not in kinds:
+                raise argparse.ArgumentTypeError(f"Unknown {what} {name!r}, expected one of {', '.join(kinds)}")
+            values[name] = float(value)
+    return values
+
+
+class BandwidthCap:
+    """
+    Token bucket in bytes, shared by every upload connection.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.bytes_per_second, self.allowance + (now - self.last) * self.bytes_per_second)
+            self.last = now
+            self.allowance -= size
+            wait = -self.allowance / self.bytes_per_second if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ArchiveStandinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        payload = json.dumps(body if body is not None else {}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self, cap=None):
+        remaining = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 256 * 1024))
+            if not chunk:
+                break
+            if cap is not None:
+                cap.consume(len(chunk))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def _serve(self, endpoint, body):
+        standin = self.server.standin
+        status = standin.injected_error(endpoint)
+        standin.sleep(endpoint)
+        standin.count(endpoint, status or 200)
+        if status:
+            self._reply(status, {'detail': 'Injected error'})
+            return None
+        return body
+
+    def do_PUT(self):
+        if not self.path.startswith('/upload/'):
+            self._reply(404)
+            return
+        # The whole upload goes over the wire even if the server then fails it
+        data = self._read_body(self.server.standin.bandwidth)
+        if self._serve('upload', data) is None:
+            return
+        self._reply(200, {'key': self.path.rsplit('/', 1)[-1], 'md5': hashlib.md5(data).hexdigest()})
+
+    def do_POST(self):
+        if not self.path.startswith('/frames/'):
+            self._reply(404)
+            return
+        body = self._read_body()
+        standin = self.server.standin
+        if standin.roll() < standin.error_rates.get('duplicate', 0):
+            # What the archive says when it already has the frame
+            standin.sleep('record')
+            standin.count('record', 'duplicate')
+            self._reply(400, {'detail': 'Version with this md5 already exists'})
+            return
+        if self._serve('record', body) is None:
+            return
+        records = json.loads(body)
+        if isinstance(records, list):
+            self._reply(201, [{'id': i} for i, _ in enumerate(records)])
+        else:
+            self._reply(201, {'id': 0})
+
+
+class ArchiveStandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # Every ingestion thread can have a connection open at once
+    request_queue_size = 256
+
+
+class ArchiveStandin:
+    """
+    The stand-in server plus the client functions that talk to it.
+    """
+
+    def __init__(self, latency=None, error_rates=None, bandwidth_mbps=0, seed=None):
+        self.latency = dict(latency or {})
+        self.error_rates = dict(error_rates or {})
+        self.bandwidth = BandwidthCap(bandwidth_mbps * 1e6 / 8) if bandwidth_mbps else None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}  # (endpoint, status) -> count
+        self.server = None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=256)
+        self.session.mount('http://', adapter)
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def injected_error(self, endpoint):
+        roll = self.roll()
+        for kind in ('400', '500', '502'):
+            rate = self.error_rates.get(kind, 0)
+            if roll < rate:
+                return int(kind)
+            roll -= rate
+        return None
+
+    def sleep(self, endpoint):
+        mean = self.latency.get(endpoint, 0)
+        if mean:
+            # Spread around the mean, so percentiles mean something
+            time.sleep(random.uniform(0.5 * mean, 1.5 * mean))
+
+    def count(self, endpoint, status):
+        with self.lock:
+            self.requests[(endpoint, status)] = self.requests.get((endpoint, status), 0) + 1
+
+    def start(self, address='127.0.0.1', port=0):
+        self.server = ArchiveStandinServer((address, port), ArchiveStandinHandler)
+        self.server.standin = self
+        threading.Thread(target=self.server.serve_forever, daemon=True, name='archive_standin').start()
+        self.url = 'http://%s:%d/' % self.server.server_address
+        # Somewhere nothing listens, for connection refused
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.refused_url = 'http://127.0.0.1:%d/' % probe.getsockname()[1]
+        probe.close()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _base_url(self):
+        if self.roll() < self.error_rates.get('refused', 0):
+            return self.refused_url
+        return self.url
+
+    # The client side, with the same signatures as ocs_ingester's
+
+    def upload_file_to_file_store(self, fileobj, path=None, file_metadata=None):
+        fileobj.seek(0)
+        data = fileobj.read()
+        response = self.session.put(self._base_url() + 'upload/' + uuid.uuid4().hex, data=data, timeout=600)
+        response.raise_for_status()
+        return response.json()
+
+    def ingest_archive_record(self, version, record, **kwargs):
+        record = dict(record)
+        record['version_set'] = [version]
+        response = self.session.post(self._base_url() + 'frames/', json=record, timeout=60)
+        self._raise_for_duplicate(response)
+        response.raise_for_status()
+        return response.json()
+
+    def ingest_archive_records(self, versions_and_records):
+        payload = []
+        for version, record in versions_and_records:
+            record = dict(record)
+            record['version_set'] = [version]
+            payload.append(record)
+        response = self.session.post(self._base_url() + 'frames/', json=payload, timeout=120)
+        self._raise_for_duplicate(response)
+        response.raise_for_status()
+        return response.json()
+
+    def _raise_for_duplicate(self, response):
+        if response.status_code == 400 and 'md5 already exists' in response.text:
+            raise DoNotRetryError('Version with this md5 already exists')
+
+    def install(self, module):
+        """
+        Point module (thewatcher) at the stand-in.
+        """
+        for name in ('upload_file_to_file_store', 'ingest_archive_record', 'ingest_archive_records'):
+            setattr(module, name, getattr(self, name))
+
+
+def add_standin_arguments(parser):
+    parser.add_argument('--latency', action='append', metavar='ENDPOINT=SECONDS',
+                        help=f"Mean latency per call, endpoints {', '.join(ENDPOINTS)}")
+    parser.add_argument('--error-rate', action='append', metavar='KIND=FRACTION',
+                        help=f"Fraction of calls to fail, kinds {', '.join(ERROR_KINDS)}")
+    parser.add_argument('--bandwidth-mbps', type=float, default=0,
+                        help="Upload bandwidth cap shared by all connections, 0 for none")
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def standin_from_arguments(args):
+    return ArchiveStandin(
+        latency=parse_pairs(args.latency, ENDPOINTS, 'endpoint'),
+        error_rates=parse_pairs(args.error_rate, ERROR_KINDS, 'error kind'),
+        bandwidth_mbps=args.bandwidth_mbps,
+        seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+    standin = standin_from_arguments(args).start(args.address, args.port)
+    print("Archive stand-in listening on " + standin.url)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,169 @@
+"""
+Fills scratch Ingestion, tokens and localptrarchive trees with the kind of
+mess a pipe sees on a bad night, for benchmarking the directory scanning
+and discovery code at 50k-500k entries.
+
+- Ingestion: FITS frames with their JSON sidecars, mostly science frames
+  with some calibrations, reduced frames, thumbnails, variance_ files and
+  the empty (50 byte) sek, sea and psx files.
+- tokens: JSON lists of frames, with some zero-byte tokens.
+- localptrarchive: camera/date folders of frames, plus calibrations.
+
+Data files are sparse, so they report realistic sizes without using the
+disk space. Ages are mostly recent with a long tail of backlog, much like
+a pipe catching up after an outage.
+
+    python benchmarks/directory_load.py /tmp/load --ingestion 50000 --tokens 50000 --archive 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+
+SITES = ['ecoo', 'mrc1', 'mrc2', 'aro1']
+CAMERAS = ['sq101sbig', 'sq003ms', 'sq005mm', 'ec002cs', 'sq101sm']
+SIDECAR_KINDS = ['sek', 'sea', 'psx']
+
+# (weight, kind) of what turns up in the ingester directory
+INGESTION_MIX = [
+    (60, 'science'),
+    (10, 'calibration'),
+    (8, 'reduced'),
+    (8, 'empty_sidecar'),
+    (6, 'sidecar'),
+    (4, 'thumbnail'),
+    (4, 'variance'),
+]
+
+
+def frame_name(rng, index, day):
+    site = rng.choice(SITES)
+    camera = rng.choice(CAMERAS)
+    return f"{site}-{camera}_{rng.randint(1, 3):03d}-{day}-{index:08d}"
+
+
+def random_age(rng, backlog_days):
+    """
+    Seconds old: mostly from the last few hours, with a tail going back backlog_days.
+    """
+    if rng.random() < 0.8:
+        return rng.expovariate(1 / 3600)
+    return rng.uniform(0, backlog_days * 86400)
+
+
+def touch_sized(path, size, mtime):
+    with open(path, 'wb') as f:
+        if size:
+            f.truncate(size)
+    os.utime(path, (mtime, mtime))
+
+
+def fill_ingestion(directory, count, rng, backlog_days=7, now=None):
+    """
+    count sidecars (and their data files) in the ingester directory.
+    """
+    now = now or time.time()
+    os.makedirs(directory, exist_ok=True)
+    kinds = [kind for weight, kind in INGESTION_MIX for _ in range(weight)]
+    for index in range(count):
+        mtime = now - random_age(rng, backlog_days)
+        day = time.strftime('%Y%m%d', time.gmtime(mtime))
+        base = frame_name(rng, index, day)
+        kind = rng.choice(kinds)
+        if kind == 'science':
+            name, size = base + '-EX00.fits.fz', rng.randint(20, 120) * 2**20
+        elif kind == 'calibration':
+            name, size = base + '-' + rng.choice(['BI', 'DK', 'FL']) + '00.fits.fz', rng.randint(20, 120) * 2**20
+        elif kind == 'reduced':
+            name, size = base + '-EX10.fits.fz', rng.randint(30, 200) * 2**20
+        elif kind == 'empty_sidecar':
+            name, size = base + '-' + rng.choice(SIDECAR_KINDS) + '.fits', 50
+        elif kind == 'sidecar':
+            name, size = base + '-' + rng.choice(SIDECAR_KINDS) + '.fits', rng.randint(1, 20) * 2**20
+        elif kind == 'thumbnail':
+            name, size = base + '-thumbnail.jpg', rng.randint(50, 500) * 1024
+        else:
+            name, size = 'variance_' + base + '-EX00.fits.fz', rng.randint(20, 120) * 2**20
+        path = os.path.join(directory, name)
+        touch_sized(path, size, mtime)
+        with open(path + '.json', 'w') as f:
+            json.dump({'SITEID': base.split('-')[0], 'INSTRUME': base.split('-')[1].split('_')[0]}, f)
+        os.utime(path + '.json', (mtime, mtime))
+
+
+def fill_tokens(directory, count, rng, empty_fraction=0.02, backlog_days=7, now=None):
+    """
+    count token files, each listing a handful of frames from one camera and night.
+    """
+    now = now or time.time()
+    os.makedirs(directory, exist_ok=True)
+    for index in range(count):
+        mtime = now - random_age(rng, backlog_days)
+        day = time.strftime('%Y%m%d', time.gmtime(mtime))
+        base = frame_name(rng, index * 100, day)
+        path = os.path.join(directory, f"{base}-token")
+        if rng.random() < empty_fraction:
+            touch_sized(path, 0, mtime)
+            continue
+        frames = [f"{base[:-8]}{index * 100 + i:08d}-EX00.fits.fz" for i in range(rng.randint(1, 30))]
+        with open(path, 'w') as f:
+            json.dump(frames, f)
+        os.utime(path, (mtime, mtime))
+
+
+def fill_archive(directory, count, rng, calibration_fraction=0.05, backlog_days=60, now=None):
+    """
+    count frames spread over camera/date folders, some of them calibrations.
+    """
+    now = now or time.time()
+    for index in range(count):
+        mtime = now - rng.uniform(0, backlog_days * 86400)
+        day = time.strftime('%Y%m%d', time.gmtime(mtime))
+        camera = rng.choice(CAMERAS)
+        if rng.random() < calibration_fraction:
+            folder = os.path.join(directory, 'calibrations', camera)
+            name = f"{rng.choice(SITES)}-{camera}_001-{day}-{rng.choice(['BIAS', 'DARK', 'FLAT'])}-master.fits"
+        else:
+            folder = os.path.join(directory, camera, day)
+            name = frame_name(rng, index, day) + '-EX00.fits.fz'
+        os.makedirs(folder, exist_ok=True)
+        touch_sized(os.path.join(folder, name), rng.randint(20, 120) * 2**20, mtime)
+
+
+def fill_all(root, ingestion=0, tokens=0, archive=0, seed=None):
+    """
+    Lay out root like an archive base directory. Returns the paths filled.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    paths = {
+        'ingestion': os.path.join(root, 'ingestion'),
+        'failedingestion': os.path.join(root, 'failedingestion'),
+        'tokens': os.path.join(root, 'localptrarchive', 'tokens'),
+        'localptrarchive': os.path.join(root, 'localptrarchive'),
+        'EVAreducedfiles': os.path.join(root, 'EVAreducedfiles'),
+    }
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    fill_ingestion(paths['ingestion'], ingestion, rng, now=now)
+    fill_tokens(paths['tokens'], tokens, rng, now=now)
+    fill_archive(paths['localptrarchive'], archive, rng, now=now)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root')
+    parser.add_argument('--ingestion', type=int, default=50000, help="Sidecar/data pairs in the ingester directory")
+    parser.add_argument('--tokens', type=int, default=50000)
+    parser.add_argument('--archive', type=int, default=100000, help="Frames in localptrarchive")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    start = time.time()
+    paths = fill_all(args.root, args.ingestion, args.tokens, args.archive, args.seed)
+    print(f"Filled {args.root} in {time.time() - start:.0f}s")
+    for name, path in paths.items():
+        print(f"  {name}: {path}")
@@ -0,0 +1,266 @@
+"""
+Offline benchmark of thewatcher's ingestion against a local archive stand-in.
+
+Writes synthetic FITS files and their JSON sidecars into a scratch
+ingester directory, points thewatcher's upload and record calls at the
+stand-in in archive_standin.py, and runs them all through one of
+thewatcher's ingestion engines, with its own rate limiting, error handling
+and retries. Reports files/s, MB/s and percentiles of the end to end and
+per stage latencies.
+
+    python benchmarks/ingest_benchmark.py --files 200 --sizes 30MB:0.6,8MB:0.3,200KB:0.1 \\
+        --workers 16 --total-rate 16 --latency upload=0.2,record=0.05 \\
+        --error-rate 502=0.02,refused=0.01 --bandwidth-mbps 400
+
+--engine staged (the default, as in thewatcher) runs the
+StagedIngestionPipeline, validating in its process pool; --engine threads
+runs the pool of ingester_worker threads. Either way validation is the
+real, local ocs_ingester validation, as it makes no archive calls.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import thewatcher
+from archive_standin import add_standin_arguments, standin_from_arguments
+
+
+SIZE_UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'B': 1}
+FITS_BLOCK = 2880
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, multiplier in SIZE_UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * multiplier)
+    return int(text)
+
+
+def parse_size_mix(text):
+    """
+    '30MB:0.6,8MB:0.3,200KB:0.1' -> [(size, weight)]
+    """
+    mix = []
+    for part in text.split(','):
+        size, _, weight = part.partition(':')
+        mix.append((parse_size(size), float(weight or 1)))
+    return mix
+
+
+def fits_header(cards):
+    header = ''.join(card.ljust(80)[:80] for card in cards + ['END'])
+    return header.ljust(-(-len(header) // FITS_BLOCK) * FITS_BLOCK).encode('ascii')
+
+
+def write_synthetic_frame(directory, index, size, rng):
+    """
+    A FITS file of about size bytes named like a real frame, and its JSON sidecar.
+    Returns the sidecar path.
+    """
+    cameras = ['sq101sbig', 'sq003ms', 'sq005mm', 'ec002cs']
+    camera = cameras[index % len(cameras)]
+    name = f"ecoo-{camera}_001-20250101-{index:05d}-EX00.fits"
+    header = fits_header([
+        'SIMPLE  =                    T',
+        'BITPIX  =                   16',
+        'NAXIS   =                    1',
+        f"NAXIS1  = {max(size - FITS_BLOCK, 2) // 2:20d}",
+        f"INSTRUME= '{camera}'",
+    ])
+    data_size = max(size - len(header), FITS_BLOCK)
+    data_size = -(-data_size // FITS_BLOCK) * FITS_BLOCK
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(header)
+        # Random so that nothing gets deduplicated by md5
+        remaining = data_size
+        while remaining:
+            chunk = min(remaining, 4 * 1024 * 1024)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+    sidecar = path + '.json'
+    with open(sidecar, 'w') as f:
+        json.dump({'INSTRUME': camera, 'SITEID': 'ecoo', 'TELID': 'ecoo', 'OBSTYPE': 'EXPOSE',
+                   'DATE-OBS': '2025-01-01T00:00:00', 'DAY-OBS': '20250101', 'PROPID': 'benchmark',
+                   'BLKUID': str(index)}, f)
+    return sidecar
+
+
+def percentiles(values, points=(50, 90, 95, 99)):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f"p{p}": values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] for p in points}
+    result['max'] = values[-1]
+    return result
+
+
+class IngestTimings:
+    """
+    Wraps thewatcher's run_ingest_stage and finish_ingest_item to time each
+    stage and each file from being queued to leaving the ingester directory.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = {}      # sidecar -> time queued
+        self.finished = {}    # sidecar -> end to end seconds
+        self.stages = {}      # (stage, outcome) -> [seconds]
+        self.done = threading.Event()
+        self.expected = 0
+
+    def install(self, module):
+        run_ingest_stage = module.run_ingest_stage
+        finish_ingest_item = module.finish_ingest_item
+
+        def timed_run_ingest_stage(job, stage, **kwargs):
+            start = time.monotonic()
+            went_through = run_ingest_stage(job, stage, **kwargs)
+            with self.lock:
+                self.stages.setdefault((stage, 'ok' if went_through else 'error'), []).append(time.monotonic() - start)
+            return went_through
+
+        def timed_finish_ingest_item(file):
+            finish_ingest_item(file)
+            # Still there means it went back for a retry
+            if os.path.exists(file):
+                return
+            with self.lock:
+                if file in self.queued and file not in self.finished:
+                    self.finished[file] = time.monotonic() - self.queued[file]
+                if len(self.finished) >= self.expected:
+                    self.done.set()
+
+        module.run_ingest_stage = timed_run_ingest_stage
+        module.finish_ingest_item = timed_finish_ingest_item
+
+    def queue(self, sidecar):
+        with self.lock:
+            self.queued[sidecar] = time.monotonic()
+            self.expected += 1
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    scratch = tempfile.mkdtemp(prefix='ingest_benchmark_', dir=args.scratch)
+    ingester_directory = os.path.join(scratch, 'ingestion')
+    failed_ingestion_directory = os.path.join(scratch, 'failedingestion')
+    os.makedirs(ingester_directory)
+    os.makedirs(failed_ingestion_directory)
+
+    try:
+        mix = parse_size_mix(args.sizes)
+        sizes = [rng.choices([s for s, w in mix], weights=[w for s, w in mix])[0] for _ in range(args.files)]
+        print(f"Writing {args.files} synthetic frames, {sum(sizes) / 1e6:.0f} MB, into {scratch}")
+        sidecars = [write_synthetic_frame(ingester_directory, i, size, rng) for i, size in enumerate(sizes)]
+        total_bytes = sum(os.path.getsize(s[:-5]) for s in sidecars)
+
+        standin = standin_from_arguments(args).start()
+        standin.install(thewatcher)
+
+        thewatcher.ingestion_journal = thewatcher.IngestionJournal(':memory:')
+        thewatcher.maximum_parallel_ingestions = args.workers
+        # Shared out between the call types, as thewatcher does with TOTAL_RATE
+        rate = args.total_rate / len(thewatcher.archive_rate_limiters)
+        for limiter in thewatcher.archive_rate_limiters.values():
+            limiter.max_rate = limiter.rate = rate
+            limiter.capacity = max(1.0, rate)
+        thewatcher.ingestion_retry_scheduler.base_delay = args.retry_base_delay
+        thewatcher.ingestion_retry_scheduler.max_attempts = args.max_attempts
+        if args.batch_records:
+            if args.engine != 'staged':
+                raise SystemExit("--batch-records needs --engine staged, as in thewatcher")
+            thewatcher.archive_record_batcher = thewatcher.ArchiveRecordBatcher(
+                batch_size=args.batch_records, max_latency=0.5).start()
+
+        timings = IngestTimings()
+        timings.install(thewatcher)
+
+        if not args.verbose:
+            # thewatcher talks a lot, keep the report readable
+            sys.stdout = open(os.devnull, 'w')
+        start = time.monotonic()
+        if args.engine == 'staged':
+            thewatcher.StagedIngestionPipeline(validation_processes=args.validation_processes).start()
+        else:
+            thewatcher.start_ptringester_worker_threads('threads')
+        for sidecar in sidecars:
+            timings.queue(sidecar)
+            thewatcher.add_ingester_item([sidecar, ingester_directory, failed_ingestion_directory])
+        finished_in_time = timings.done.wait(args.timeout)
+        elapsed = time.monotonic() - start
+        sys.stdout = sys.__stdout__
+
+        failed = len([n for n in os.listdir(failed_ingestion_directory) if n.endswith('.json')])
+        ingested = len(timings.finished) - failed
+        report = {
+            'engine': args.engine,
+            'files': args.files,
+            'ingested': ingested,
+            'failed': failed,
+            'unfinished': args.files - len(timings.finished),
+            'timed_out': not finished_in_time,
+            'seconds': round(elapsed, 2),
+            'files_per_second': round(len(timings.finished) / elapsed, 2),
+            'megabytes_per_second': round(total_bytes / 1e6 / elapsed, 2),
+            'end_to_end_seconds': {k: round(v, 3) for k, v in percentiles(list(timings.finished.values())).items()},
+            'stage_seconds': {f"{stage} {outcome}": {k: round(v, 3) for k, v in percentiles(values).items()}
+                              for (stage, outcome), values in sorted(timings.stages.items())},
+            'archive_calls': {f"{endpoint} {status}": count for (endpoint, status), count in sorted(standin.requests.items(), key=str)},
+        }
+        standin.stop()
+        return report
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def print_report(report):
+    print(f"{report['engine']}: {report['files']} files in {report['seconds']}s: {report['ingested']} ingested, "
+          f"{report['failed']} failed, {report['unfinished']} unfinished")
+    print(f"{report['files_per_second']} files/s, {report['megabytes_per_second']} MB/s")
+    print("end to end   " + '  '.join(f"{k} {v:.3f}s" for k, v in report['end_to_end_seconds'].items()))
+    for stage, points in report['stage_seconds'].items():
+        print(f"{stage:<16} " + '  '.join(f"{k} {v:.3f}s" for k, v in points.items()))
+    print("archive calls " + ', '.join(f"{k}: {v}" for k, v in report['archive_calls'].items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--sizes', default='30MB:0.6,8MB:0.3,200KB:0.1',
+                        help="Mix of frame sizes and weights")
+    parser.add_argument('--engine', choices=('staged', 'threads'), default='staged',
+                        help="Ingestion engine to drive")
+    parser.add_argument('--workers', type=int, default=thewatcher.maximum_parallel_ingestions,
+                        help="maximum_parallel_ingestions: worker threads, or upload threads when staged")
+    parser.add_argument('--validation-processes', type=int, default=None,
+                        help="Validation processes when staged, default one per core")
+    parser.add_argument('--total-rate', type=float, default=thewatcher.TOTAL_RATE,
+                        help="Archive calls per second allowed in all (TOTAL_RATE)")
+    parser.add_argument('--retry-base-delay', type=float, default=0.5,
+                        help="First retry backoff in seconds; thewatcher itself uses 2")
+    parser.add_argument('--max-attempts', type=int, default=thewatcher.ingestion_retry_scheduler.max_attempts)
+    parser.add_argument('--batch-records', type=int, default=0,
+                        help="Post archive records in batches of this size, 0 for one at a time")
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--scratch', default=None, help="Where to write the synthetic frames")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="Let thewatcher's own output through")
+    add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
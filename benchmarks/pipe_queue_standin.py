@@ -0,0 +1,298 @@
+"""
+A local stand-in for the PIPE work queue, for trying out thewatcher's
+PipeQueueClient (and several pipes sharing one queue) without the
+photonranch API.
+
+Speaks the lease API PipeQueueClient expects, relative to
+http://address:port/<queue>/:
+
+    POST lease                   {"worker", "visibility_timeout", "max_items", "wait"} -> [item, ...] or 204
+    POST leases/<lease_id>/renew {"visibility_timeout"}                        -> 200 or 404
+    POST leases/<lease_id>/ack                                                 -> 200 or 404
+    POST leases/<lease_id>/nack  {"delay", "reason"}                           -> 200 or 404
+    POST enqueue                 {"request", "request_content"} or a list      -> [id, ...]
+    GET  stats
+
+A lease call with nothing to hand out holds on for up to "wait" seconds
+for something to turn up (long polling), and hands out up to max_items in
+one go. A leased item is invisible to other workers until its lease
+expires or is nacked, when it goes back on the queue. An item delivered max_deliveries
+times without being acked goes to the dead letter list instead.
+
+    python benchmarks/pipe_queue_standin.py --port 8766 --tokens ~/localptrarchive/tokens
+
+then in the pipe's config.json:
+
+    "pipe_queue_enabled": true,
+    "pipe_queue_url": "http://127.0.0.1:8766",
+"""
+
+import argparse
+import http.server
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class PipeQueue:
+    """
+    One queue: items waiting, in order, and the ones out on lease.
+    """
+
+    def __init__(self, max_deliveries=5):
+        self.max_deliveries = max_deliveries
+        self.lock = threading.Lock()
+        # Notified whenever an item goes on the queue, for long polls
+        self.arrived = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.waiting = []      # [item], oldest first
+        self.leased = {}       # lease_id -> item
+        self.dead_letters = []
+        self.counts = {'enqueued': 0, 'leased': 0, 'renewed': 0, 'acked': 0, 'nacked': 0, 'expired': 0}
+
+    def enqueue(self, payload):
+        with self.lock:
+            item = {'id': next(self.ids), 'payload': payload, 'deliveries': 0, 'visible_at': 0}
+            self.waiting.append(item)
+            self.counts['enqueued'] += 1
+            self.arrived.notify_all()
+            return item['id']
+
+    def _requeue(self, item, delay=0):
+        item.pop('lease_id', None)
+        item.pop('lease_expires', None)
+        item.pop('worker', None)
+        if item['deliveries'] >= self.max_deliveries:
+            self.dead_letters.append(item)
+        else:
+            item['visible_at'] = time.time() + delay
+            self.waiting.append(item)
+            self.waiting.sort(key=lambda waiting: waiting['id'])
+            self.arrived.notify_all()
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for lease_id, item in list(self.leased.items()):
+                if item['lease_expires'] <= now:
+                    del self.leased[lease_id]
+                    self.counts['expired'] += 1
+                    self._requeue(item)
+
+    def lease(self, worker, visibility_timeout, max_items, wait=0):
+        deadline = time.time() + wait
+        while True:
+            self.expire()
+            leased = self._lease(worker, visibility_timeout, max_items)
+            remaining = deadline - time.time()
+            if leased or remaining <= 0:
+                return leased
+            with self.lock:
+                if not any(item['visible_at'] <= time.time() for item in self.waiting):
+                    # Wake at least every second for expiring leases and delayed nacks
+                    self.arrived.wait(min(remaining, 1))
+
+    def _lease(self, worker, visibility_timeout, max_items):
+        now = time.time()
+        leased = []
+        with self.lock:
+            for item in list(self.waiting):
+                if len(leased) >= max_items:
+                    break
+                if item['visible_at'] > now:
+                    continue
+                self.waiting.remove(item)
+                item['deliveries'] += 1
+                item['lease_id'] = uuid.uuid4().hex
+                item['lease_expires'] = now + visibility_timeout
+                item['worker'] = worker
+                self.leased[item['lease_id']] = item
+                self.counts['leased'] += 1
+                leased.append({key: item[key] for key in ('id', 'lease_id', 'lease_expires', 'payload', 'deliveries')})
+        return leased
+
+    def renew(self, lease_id, visibility_timeout):
+        self.expire()
+        with self.lock:
+            item = self.leased.get(lease_id)
+            if item is None:
+                return None
+            item['lease_expires'] = time.time() + visibility_timeout
+            self.counts['renewed'] += 1
+            return {'lease_expires': item['lease_expires']}
+
+    def ack(self, lease_id):
+        self.expire()
+        with self.lock:
+            item = self.leased.pop(lease_id, None)
+            if item is None:
+                return None
+            self.counts['acked'] += 1
+            return {'id': item['id']}
+
+    def nack(self, lease_id, delay=0):
+        self.expire()
+        with self.lock:
+            item = self.leased.pop(lease_id, None)
+            if item is None:
+                return None
+            self.counts['nacked'] += 1
+            self._requeue(item, delay)
+            return {'id': item['id']}
+
+    def stats(self):
+        self.expire()
+        with self.lock:
+            return dict(self.counts, waiting=len(self.waiting), on_lease=len(self.leased),
+                        dead_letters=len(self.dead_letters),
+                        workers=sorted({item['worker'] for item in self.leased.values()}))
+
+
+class PipeQueueStandinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if payload:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _queue_and_path(self):
+        name, _, rest = self.path.strip('/').partition('/')
+        return self.server.queue(name), rest
+
+    def do_GET(self):
+        queue, rest = self._queue_and_path()
+        if rest != 'stats':
+            self._reply(404, {'detail': 'Not found'})
+            return
+        self._reply(200, queue.stats())
+
+    def do_POST(self):
+        queue, rest = self._queue_and_path()
+        try:
+            body = self._read_json()
+        except ValueError:
+            self._reply(400, {'detail': 'Body is not JSON'})
+            return
+        parts = rest.split('/')
+
+        if rest == 'lease':
+            items = queue.lease(body.get('worker', 'unknown'),
+                                float(body.get('visibility_timeout', self.server.default_visibility_timeout)),
+                                int(body.get('max_items', 1)),
+                                min(float(body.get('wait', 0)), self.server.max_wait))
+            if items:
+                self._reply(200, items)
+            else:
+                self._reply(204)
+        elif rest == 'enqueue':
+            payloads = body if isinstance(body, list) else [body]
+            self._reply(201, [queue.enqueue(payload) for payload in payloads])
+        elif len(parts) == 3 and parts[0] == 'leases' and parts[2] in ('renew', 'ack', 'nack'):
+            lease_id, action = parts[1], parts[2]
+            if action == 'renew':
+                result = queue.renew(lease_id, float(body.get('visibility_timeout', self.server.default_visibility_timeout)))
+            elif action == 'ack':
+                result = queue.ack(lease_id)
+            else:
+                result = queue.nack(lease_id, float(body.get('delay', 0)))
+            if result is None:
+                self._reply(404, {'detail': 'No such lease, it may have expired'})
+            else:
+                self._reply(200, result)
+        else:
+            self._reply(404, {'detail': 'Not found'})
+
+
+class PipeQueueStandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, max_deliveries=5, default_visibility_timeout=600, max_wait=30, verbose=False):
+        http.server.ThreadingHTTPServer.__init__(self, server_address, PipeQueueStandinHandler)
+        self.max_deliveries = max_deliveries
+        self.max_wait = max_wait
+        self.default_visibility_timeout = default_visibility_timeout
+        self.verbose = verbose
+        self.queues = {}
+        self.queues_lock = threading.Lock()
+
+    def queue(self, name):
+        with self.queues_lock:
+            if name not in self.queues:
+                self.queues[name] = PipeQueue(self.max_deliveries)
+            return self.queues[name]
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True, name='pipe_queue_standin').start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def enqueue_token_files(queue, token_directory):
+    """
+    Put every token in token_directory on the queue as an EVA_process_files request.
+    """
+    count = 0
+    for entry in sorted(os.scandir(token_directory), key=lambda e: e.stat().st_mtime):
+        if not entry.is_file():
+            continue
+        try:
+            with open(entry.path) as f:
+                request_content = json.load(f)
+        except (OSError, ValueError):
+            continue
+        queue.enqueue({'request': 'EVA_process_files', 'request_content': request_content, 'token': entry.name})
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--queue', default='lcs1', help="Queue to load --tokens into")
+    parser.add_argument('--tokens', default=None, help="Directory of token files to enqueue at start")
+    parser.add_argument('--max-deliveries', type=int, default=5,
+                        help="Deliveries before an item goes to the dead letters")
+    parser.add_argument('--visibility-timeout', type=float, default=600,
+                        help="Lease length when the client doesn't ask for one")
+    parser.add_argument('--max-wait', type=float, default=30,
+                        help="Longest a lease call may long poll, 0 to answer straight away")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    args = parser.parse_args()
+
+    server = PipeQueueStandinServer((args.address, args.port), args.max_deliveries,
+                                    args.visibility_timeout, args.max_wait, args.verbose).start()
+    if args.tokens:
+        count = enqueue_token_files(server.queue(args.queue), os.path.expanduser(args.tokens))
+        print(f"Enqueued {count} tokens on {args.queue}")
+    print(f"PIPE queue stand-in listening on {server.url}")
+    try:
+        while True:
+            time.sleep(60)
+            for name, queue in server.queues.items():
+                print(name, json.dumps(queue.stats()))
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,140 @@
+"""
+Times thewatcher's directory scanning and discovery paths against trees of
+increasing size made by directory_load.py:
+
+- process_ingester_directory, the periodic scan of the ingester directory
+- IngesterDirectoryWatcher.reconcile and its first dispatch into the queue
+- token selection: the old scandir-and-min pass the main loop used to make,
+  the TokenIndex start-up scan, and a steady state TokenIndex pass
+- ArchiveDiskCuller culling 10% of localptrarchive
+
+    python benchmarks/scan_benchmark.py --scales 1000,10000,50000
+
+Each scale gets a fresh tree in a scratch directory, removed afterwards.
+Culling really deletes (sparse) files, so it goes last.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import thewatcher
+from directory_load import fill_all
+
+
+def legacy_select_token(monitor_dir, completed_tokens):
+    """
+    The token selection main() used to do on every pass, kept for comparison.
+    """
+    completed = set(completed_tokens)
+    with os.scandir(monitor_dir) as it:
+        candidates = (entry for entry in it if entry.is_file() and entry.name not in completed)
+        try:
+            return min(candidates, key=lambda e: e.stat().st_mtime)
+        except ValueError:
+            return None
+
+
+def timed(function, *args, **kwargs):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return time.perf_counter() - start, result
+
+
+def fresh_ingester_queue():
+    thewatcher.ingester_queue = thewatcher.IngestionPriorityQueue()
+    thewatcher.known_ingester_jsons.clear()
+
+
+def benchmark_scale(scale, args):
+    results = {}
+    scratch = tempfile.mkdtemp(prefix='scan_benchmark_', dir=args.scratch)
+    try:
+        start = time.perf_counter()
+        paths = fill_all(scratch, ingestion=scale, tokens=scale, archive=scale * args.archive_factor, seed=args.seed)
+        print(f"[{scale}] generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        # Ingester directory, the scanning way and the watcher's reconcile
+        fresh_ingester_queue()
+        watcher = thewatcher.IngesterDirectoryWatcher(paths['ingestion'], paths['failedingestion'])
+        results['ingester watcher reconcile'], _ = timed(watcher.reconcile)
+        results['ingester watcher first dispatch'], _ = timed(watcher._dispatch)
+        fresh_ingester_queue()
+        results['process_ingester_directory'], _ = timed(
+            thewatcher.process_ingester_directory, paths['ingestion'], paths['failedingestion'])
+        fresh_ingester_queue()
+
+        # Tokens, with half of them already run as they would be late in a night
+        names = sorted(os.listdir(paths['tokens']))
+        completed = names[:len(names) // 2]
+        results['legacy token selection pass'], _ = timed(legacy_select_token, paths['tokens'], completed)
+        token_index = thewatcher.TokenIndex(paths['tokens'])
+        results['token index start'], _ = timed(token_index.start)
+        token_index.pop_ready(len(completed))
+        passes = 1000
+
+        def steady_state():
+            for _ in range(passes):
+                token_index.wait(0)
+                token_index.pop_ready(1)
+        elapsed, _ = timed(steady_state)
+        results['token index pass'] = elapsed / passes
+        if token_index.inotify is not None:
+            token_index.inotify.close()
+
+        # Culling 10% of the archive, with the disk made to look nearly full
+        archive_bytes = 0
+        for root, dirs, files in os.walk(paths['localptrarchive']):
+            for name in files:
+                archive_bytes += os.lstat(os.path.join(root, name)).st_size
+        culler = thewatcher.ArchiveDiskCuller(
+            scratch, ['localptrarchive', 'EVAreducedfiles'],
+            trigger_free_fraction=0.2, target_free_fraction=0.25,
+            protected_paths=['localptrarchive/calibrations', 'localptrarchive/tokens'],
+            background=False)
+        total = 0.1 * archive_bytes / 0.15
+        disk_usage = shutil.disk_usage
+        # free at 10% of a disk sized so that getting to 25% means culling 10% of the archive
+        thewatcher.shutil.disk_usage = lambda path: (total, 0.9 * total, 0.1 * total)
+        try:
+            # Sparse files use no blocks, so count their apparent size as the culler's freed bytes
+            st_blocks_index = culler._index
+            culler._index = lambda: [(mtime, os.lstat(path).st_size, path) for mtime, size, path in st_blocks_index()]
+            results['archive cull 10%'], _ = timed(culler.cull)
+        finally:
+            thewatcher.shutil.disk_usage = disk_usage
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,10000,50000',
+                        help="Comma separated numbers of ingester files and tokens")
+    parser.add_argument('--archive-factor', type=int, default=2,
+                        help="Frames in localptrarchive per ingester file")
+    parser.add_argument('--scratch', default=None, help="Where to build the trees")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    all_results = {}
+    for scale in [int(s) for s in args.scales.split(',')]:
+        all_results[scale] = benchmark_scale(scale, args)
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        scales = list(all_results)
+        print(f"{'seconds':<32}" + ''.join(f"{scale:>12}" for scale in scales))
+        for name in all_results[scales[0]]:
+            print(f"{name:<32}" + ''.join(f"{all_results[scale][name]:>12.6f}" for scale in scales))
@@ -3,7 +3,8 @@ set -euo pipefail
 
 # ─── Configuration ────────────────────────────────────────────────────────────
 PIDFILE="thewatcher.pid"      # run_watcher.sh must write this
-HEARTBEAT="thewatcher.hbeat"  # thewatcher.py must touch this
+HEARTBEAT="thewatcher.hbeat"  # thewatcher.py touches this while every subsystem is healthy
+STATUS="thewatcher.status.json"  # per-subsystem health, written by thewatcher.py
 WATCHER_LOG="watcher.log"     # thewatcher.py must append to this
 WRAPPER="./run_watcher.sh"    # launcher, must be executable
 
@@ -59,6 +60,18 @@ check_heartbeat() {
   (( age <= STALE_LIMIT )) || { echo "   → Heartbeat stale (${age}s > ${STALE_LIMIT}s)"; return 1; }
 }
 
+report_status() {
+  # Say which part of the watcher stalled, so the restart has a reason in the log
+  [[ -f $STATUS ]] || return 0
+  python3 - "$STATUS" <<'PY' || true
+import json, sys
+status = json.load(open(sys.argv[1]))
+for name, subsystem in status.get('subsystems', {}).items():
+    if subsystem.get('stalled'):
+        print(f"   → {name} stalled, no progress for {subsystem['seconds_since_beat']}s")
+PY
+}
+
 check_log_activity() {
   [[ -f $WATCHER_LOG ]] || { echo "   → watcher.log missing"; return 1; }
   age=$(( $(date +%s) - $(stat -c %Y "$WATCHER_LOG") ))
@@ -76,7 +89,7 @@ while true; do
   echo "$(date +'%F %T') ● Monitor heartbeat: still running"
 
   if ! check_pid;          then restart_watcher; continue; fi
-  if ! check_heartbeat;    then restart_watcher; continue; fi
+  if ! check_heartbeat;    then report_status; restart_watcher; continue; fi
   if ! check_log_activity; then restart_watcher; continue; fi
 
   echo "   → All checks passed"
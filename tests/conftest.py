@@ -0,0 +1,7 @@
+import os
+import sys
+
+# thewatcher is a script rather than a package, and the stand-ins live in benchmarks/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
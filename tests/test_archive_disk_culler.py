@@ -0,0 +1,66 @@
+import collections
+import os
+
+import pytest
+
+import thewatcher
+
+Usage = collections.namedtuple('Usage', 'total used free')
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """
+    An archive tree of 10 files, oldest first, on a pretend disk that gains
+    the space of every file deleted.
+    """
+    disk = {'free': 0}
+    paths = []
+    for n in range(10):
+        directory = tmp_path / ('calibrations' if n == 0 else 'frames') / f"day{n % 3}"
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"frame{n}.fits"
+        path.write_bytes(b'\0' * 8192)
+        os.utime(path, (n, n))
+        paths.append(path)
+    block_bytes = os.lstat(paths[0]).st_blocks * 512
+    disk['total'] = 100 * block_bytes
+    disk['free'] = 10 * block_bytes
+
+    real_remove = os.remove
+
+    def remove(path):
+        real_remove(path)
+        disk['free'] += block_bytes
+
+    monkeypatch.setattr(thewatcher.shutil, 'disk_usage', lambda path: Usage(disk['total'], disk['total'] - disk['free'], disk['free']))
+    monkeypatch.setattr(thewatcher.os, 'remove', remove)
+    return paths
+
+
+def test_culls_the_oldest_files_up_to_the_target_in_one_pass(tmp_path, archive):
+    culler = thewatcher.ArchiveDiskCuller(str(tmp_path), ['frames', 'calibrations'], trigger_free_fraction=0.12,
+                                          target_free_fraction=0.135, protected_paths=['calibrations'],
+                                          background=False)
+    assert culler.cull() > 0
+    remaining = [path.name for path in archive if path.exists()]
+    # The calibration is the oldest file but protected
+    assert remaining == ['frame0.fits'] + [f"frame{n}.fits" for n in range(5, 10)]
+    assert culler.free_fraction() >= 0.135
+    assert culler.cull() == 0
+
+
+def test_leaves_the_disk_alone_above_the_trigger(tmp_path, archive):
+    culler = thewatcher.ArchiveDiskCuller(str(tmp_path), ['frames'], trigger_free_fraction=0.05, background=False)
+    culler.check()
+    assert all(path.exists() for path in archive)
+
+
+def test_background_check_culls_in_its_own_thread(tmp_path, archive):
+    culler = thewatcher.ArchiveDiskCuller(str(tmp_path), ['frames'], trigger_free_fraction=0.12,
+                                          target_free_fraction=0.12)
+    culler.check()
+    assert culler.thread is not None
+    culler.thread.join(30)
+    assert not culler.busy()
+    assert not archive[1].exists() and not archive[2].exists() and archive[3].exists()
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import thewatcher
+
+
+class Job:
+    def __init__(self, index):
+        self.s3_version = {'key': str(index)}
+        self.record = {'basename': f"frame{index}"}
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    """
+    Stands in for the archive's bulk and single record posts.
+    """
+    calls = {'bulk': [], 'single': [], 'recorded': [], 'bulk_error': None}
+
+    def ingest_archive_records(versions_and_records):
+        calls['bulk'].append([record['basename'] for version, record in versions_and_records])
+        if calls['bulk_error']:
+            raise requests.HTTPError(calls['bulk_error'])
+        return [{'id': index} for index in range(len(versions_and_records))]
+
+    def run_ingest_stage(job, stage):
+        calls['single'].append(job.record['basename'])
+        return job.record['basename'] != 'frame1'
+
+    monkeypatch.setattr(thewatcher, 'ingest_archive_records', ingest_archive_records)
+    monkeypatch.setattr(thewatcher, 'run_ingest_stage', run_ingest_stage)
+    monkeypatch.setattr(thewatcher, 'mark_ingest_job_recorded', lambda job: calls['recorded'].append(job.record['basename']))
+    monkeypatch.setitem(thewatcher.archive_rate_limiters, 'record', thewatcher.TokenBucket('record', 1000))
+    return calls
+
+
+def test_flushes_a_full_batch_without_waiting(archive):
+    batcher = thewatcher.ArchiveRecordBatcher(batch_size=3, max_latency=60).start()
+    futures = [batcher.submit(Job(index)) for index in range(3)]
+    assert all(future.result(timeout=5) for future in futures)
+    assert archive['bulk'] == [['frame0', 'frame1', 'frame2']]
+    assert archive['recorded'] == ['frame0', 'frame1', 'frame2']
+
+
+def test_flushes_a_part_batch_after_max_latency(archive):
+    batcher = thewatcher.ArchiveRecordBatcher(batch_size=50, max_latency=0.3).start()
+    start = time.monotonic()
+    futures = [batcher.submit(Job(index)) for index in range(2)]
+    assert all(future.result(timeout=5) for future in futures)
+    assert time.monotonic() - start >= 0.3
+    assert archive['bulk'] == [['frame0', 'frame1']]
+
+
+def test_a_lone_record_goes_through_the_single_path(archive):
+    batcher = thewatcher.ArchiveRecordBatcher(batch_size=50, max_latency=0.1).start()
+    assert batcher.submit(Job(0)).result(timeout=5)
+    assert archive['bulk'] == []
+    assert archive['single'] == ['frame0']
+
+
+def test_failed_bulk_post_falls_back_to_one_record_at_a_time(archive):
+    archive['bulk_error'] = '500 Server Error: Internal Server Error'
+    batcher = thewatcher.ArchiveRecordBatcher(batch_size=3, max_latency=60).start()
+    futures = [batcher.submit(Job(index)) for index in range(3)]
+    # Each record gets its own result, frame1 is the one the archive turns down
+    assert [future.result(timeout=5) for future in futures] == [True, False, True]
+    assert archive['single'] == ['frame0', 'frame1', 'frame2']
+    # A server error says nothing about whether bulk posts work
+    assert batcher.bulk_supported
+
+
+def test_stops_bulk_posting_when_the_archive_only_takes_single_records(archive, monkeypatch):
+    monkeypatch.setattr(thewatcher, 'run_ingest_stage', lambda job, stage: archive['single'].append(job.record['basename']) or True)
+    archive['bulk_error'] = '400 Client Error: Bad Request'
+    batcher = thewatcher.ArchiveRecordBatcher(batch_size=2, max_latency=60).start()
+    assert all(future.result(timeout=5) for future in [batcher.submit(Job(index)) for index in range(2)])
+    assert not batcher.bulk_supported
+    assert all(future.result(timeout=5) for future in [batcher.submit(Job(index)) for index in range(2, 4)])
+    assert len(archive['bulk']) == 1
+    assert archive['single'] == ['frame0', 'frame1', 'frame2', 'frame3']
+
+
+def test_submit_blocks_while_two_batches_are_waiting(archive):
+    # Not started, so nothing drains
+    batcher = thewatcher.ArchiveRecordBatcher(batch_size=2, max_latency=60)
+    for index in range(4):
+        batcher.submit(Job(index))
+    submitted = threading.Event()
+    threading.Thread(target=lambda: batcher.submit(Job(4)) and submitted.set(), daemon=True).start()
+    assert not submitted.wait(0.3)
+    batcher.start()
+    assert submitted.wait(5)
@@ -0,0 +1,60 @@
+import http.server
+import json
+import threading
+
+import pytest
+import requests
+
+import thewatcher
+from ocs_ingester.exceptions import DoNotRetryError
+
+
+class FramesHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.posts.append((self.client_address[1], self.headers.get('Authorization'), body))
+        status, reply = (400, {'detail': 'Bad record'}) if body.get('bad') else (201, {'id': len(self.server.posts)})
+        payload = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FramesHandler)
+    server.posts = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(thewatcher.ingester_settings, 'API_ROOT', 'http://127.0.0.1:%d/' % server.server_address[1])
+    monkeypatch.setattr(thewatcher.ingester_settings, 'AUTH_TOKEN', 'secret')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_record_posts_share_one_keep_alive_connection(archive):
+    session = requests.Session()
+    for index in range(3):
+        assert thewatcher.post_archive_record({'key': str(index)}, {'basename': f"frame{index}"}, session) == {'id': index + 1}
+    ports = {port for port, authorization, body in archive.posts}
+    assert len(ports) == 1
+    assert all(authorization == 'Token secret' for port, authorization, body in archive.posts)
+    assert archive.posts[0][2] == {'basename': 'frame0', 'version_set': [{'key': '0'}]}
+
+
+def test_client_errors_read_like_ocs_ingesters(archive):
+    with pytest.raises(DoNotRetryError, match='400 Client Error'):
+        thewatcher.post_archive_record({'key': 'k'}, {'bad': True}, requests.Session())
+
+
+def test_unknown_engine_is_refused():
+    # There is no asyncio engine, so asking for one mustn't quietly run another
+    with pytest.raises(ValueError):
+        thewatcher.start_ptringester_worker_threads('asyncio')
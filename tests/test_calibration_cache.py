@@ -0,0 +1,98 @@
+import gzip
+import os
+
+import pytest
+
+import thewatcher
+
+
+@pytest.fixture
+def calibrations(tmp_path, monkeypatch):
+    monkeypatch.setattr(thewatcher, 'eva_registry', thewatcher.EvaProcessRegistry())
+    directory = tmp_path / 'calibrations'
+    directory.mkdir()
+    for date in ('20250101', '20250102', '20250103'):
+        with gzip.open(directory / f"ecoo-sq003ms-{date}-BIAS.fits.gz", 'wb') as f:
+            f.write(date.encode() * 1000)
+    (directory / f"ecoo-sq003ms-20250103-DARK.fits").write_bytes(b'd' * 8000)
+    (directory / 'notes.txt').write_text('not a master')
+    return str(directory)
+
+
+def cache(tmp_path, calibrations, **kwargs):
+    calibration_cache = thewatcher.CalibrationCache(calibrations, str(tmp_path / 'cache'), **kwargs)
+    calibration_cache.refresh()
+    return calibration_cache
+
+
+def fetch(calibration_cache, sources):
+    for source in sources:
+        calibration_cache._prefetch(source)
+    calibration_cache._evict()
+
+
+def test_indexes_masters_newest_first_and_serves_uncompressed_copies(tmp_path, calibrations):
+    calibration_cache = cache(tmp_path, calibrations)
+    assert set(calibration_cache.index) == {('ecoo', 'sq003ms', 'bias'), ('ecoo', 'sq003ms', 'dark')}
+    biases = calibration_cache.index[('ecoo', 'sq003ms', 'bias')]
+    assert [date for date, source in biases] == ['20250103', '20250102', '20250101']
+
+    fetch(calibration_cache, [biases[0][1]])
+    camera_index = calibration_cache.camera_index('ecoo', 'sq003ms')
+    newest = camera_index['bias'][0]
+    assert newest['cached'].endswith('-ecoo-sq003ms-20250103-BIAS.fits')
+    with open(newest['cached'], 'rb') as f:
+        assert f.read() == b'20250103' * 1000
+    assert camera_index['bias'][1]['cached'] is None
+    assert calibration_cache.camera_index('ecoo', 'other') == {}
+
+
+def test_evicts_least_recently_used_copies_over_max_bytes(tmp_path, calibrations):
+    calibration_cache = cache(tmp_path, calibrations, max_bytes=20000)
+    biases = [source for date, source in calibration_cache.index[('ecoo', 'sq003ms', 'bias')]]
+    fetch(calibration_cache, [biases[2], biases[1], biases[0]])
+    # Three 8000 byte copies don't fit in 20000, the one used longest ago goes
+    assert set(calibration_cache.cached) == {biases[0], biases[1]}
+    assert not any(biases[2][-20:-3] in name for name in os.listdir(calibration_cache.cache_directory))
+
+
+def test_copies_listed_for_a_running_token_are_pinned_until_it_finishes(tmp_path, calibrations):
+    calibration_cache = cache(tmp_path, calibrations, max_bytes=10000)
+    biases = [source for date, source in calibration_cache.index[('ecoo', 'sq003ms', 'bias')]]
+    fetch(calibration_cache, [biases[2]])
+    calibration_cache.prepare('token1', 'ecoo', 'sq003ms')
+    fetch(calibration_cache, [biases[0]])
+    # Over max_bytes, but token1's run was told about biases[2], so the newer copy goes instead
+    assert set(calibration_cache.cached) == {biases[2]}
+
+    calibration_cache.finished({'token': 'token1'})
+    fetch(calibration_cache, [biases[0]])
+    assert set(calibration_cache.cached) == {biases[0]}
+
+
+def test_pins_of_runs_that_never_started_expire(tmp_path, calibrations):
+    calibration_cache = cache(tmp_path, calibrations, max_bytes=0)
+    biases = [source for date, source in calibration_cache.index[('ecoo', 'sq003ms', 'bias')]]
+    fetch(calibration_cache, [biases[0]])
+    calibration_cache.prepare('token1', 'ecoo', 'sq003ms')
+    pinned_at, sources = calibration_cache.pinned['token1']
+    calibration_cache.pinned['token1'] = (pinned_at - 601, sources)
+    fetch(calibration_cache, [])
+    assert calibration_cache.cached == {}
+
+
+def test_copies_survive_a_restart(tmp_path, calibrations):
+    calibration_cache = cache(tmp_path, calibrations)
+    source = calibration_cache.index[('ecoo', 'sq003ms', 'dark')][0][1]
+    fetch(calibration_cache, [source])
+    calibration_cache._save_manifest()
+    assert source in cache(tmp_path, calibrations).cached
+
+
+def test_memory_headroom_only_counts_on_tmpfs(tmp_path, calibrations):
+    calibration_cache = cache(tmp_path, calibrations, max_bytes=20000)
+    calibration_cache.in_memory = False
+    assert calibration_cache.memory_headroom() == 0
+    calibration_cache.in_memory = True
+    fetch(calibration_cache, [calibration_cache.index[('ecoo', 'sq003ms', 'dark')][0][1]])
+    assert calibration_cache.memory_headroom() == 12000
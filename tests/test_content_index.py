@@ -0,0 +1,49 @@
+import json
+import os
+import time
+
+import thewatcher
+
+
+def test_remembers_what_the_archive_has(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    assert journal.already_ingested('abc') is None
+    journal.remember_ingested('abc', 'a.fits')
+    assert journal.already_ingested('abc') == 'a.fits'
+
+
+def test_seed_from_csv_and_json_lines(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    (tmp_path / 'export.csv').write_text('md5,basename\naaa,a.fits\nbbb,b.fits\n,nothing.fits\n')
+    assert journal.seed_ingested(str(tmp_path / 'export.csv')) == 2
+    with open(tmp_path / 'frames.jsonl', 'w') as f:
+        f.write(json.dumps({'basename': 'c', 'version_set': [{'md5': 'ccc'}, {'md5': 'ddd'}]}) + '\n')
+        f.write('\n')
+        f.write(json.dumps({'md5': 'eee', 'basename': 'e.fits'}) + '\n')
+    assert journal.seed_ingested(str(tmp_path / 'frames.jsonl')) == 3
+    assert [journal.already_ingested(md5) for md5 in ('aaa', 'bbb', 'ccc', 'ddd', 'eee')] == \
+        ['a.fits', 'b.fits', 'c', 'c', 'e.fits']
+
+
+def test_seed_only_reloads_a_changed_export(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    export = tmp_path / 'export.csv'
+    export.write_text('md5,basename\naaa,a.fits\n')
+    assert journal.seed_ingested(str(export)) == 1
+    assert journal.seed_ingested(str(export)) == 0
+    export.write_text('md5,basename\naaa,a.fits\nbbb,b.fits\n')
+    later = time.time() + 10
+    os.utime(export, (later, later))
+    # Duplicates are ignored, so reloading just adds the new one
+    assert journal.seed_ingested(str(export)) == 2
+    assert journal.already_ingested('bbb') == 'b.fits'
+
+
+def test_prune_forgets_content_after_its_age(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    journal.remember_ingested('old', 'old.fits')
+    journal.connection.execute("UPDATE ingested SET ingested = 0 WHERE md5 = 'old'")
+    journal.remember_ingested('new', 'new.fits')
+    journal.prune(content_max_age_days=180)
+    assert journal.already_ingested('old') is None
+    assert journal.already_ingested('new') == 'new.fits'
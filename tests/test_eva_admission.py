@@ -0,0 +1,110 @@
+import thewatcher
+
+GB = thewatcher.EvaAdmissionController.GIGABYTE
+TOKEN = ['ecoo-sq003ms_001-20250101-00001-EX00.fits'] * 10
+
+
+class Registry:
+    def __init__(self, runs=(), history=()):
+        self.runs = list(runs)
+        self.history = list(history)
+        self.listeners = []
+
+    def running(self):
+        return self.runs
+
+    def load_history(self):
+        return self.history
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+
+def snapshot(memory_available=None, cpu_percent=0.0, disks=None):
+    if memory_available is None:
+        memory_available = thewatcher.total_ram
+    return {'cpu_percent': cpu_percent, 'memory_available': memory_available, 'disks': disks or {}}
+
+
+def controller(registry, **kwargs):
+    admission = thewatcher.EvaAdmissionController(registry, **kwargs)
+    admission.memory_budget = 100 * GB
+    admission.cpu_budget = 8
+    return admission
+
+
+def running(memory_estimate=0, rss=0, cpu_estimate=0):
+    return {'memory_estimate': memory_estimate, 'rss': rss, 'cpu_estimate': cpu_estimate}
+
+
+def test_always_admits_when_nothing_is_running():
+    admission = controller(Registry())
+    admission.memory_budget = 0
+    assert admission.can_admit(TOKEN, snapshot(memory_available=0)) == (True, 'nothing running')
+
+
+def test_max_concurrent_runs():
+    admission = controller(Registry([running()] * 2), max_concurrent=2)
+    admitted, reason = admission.can_admit(TOKEN, snapshot())
+    assert not admitted and 'already' in reason
+    assert admission.capacity() == 0
+
+
+def test_counts_memory_running_evas_are_still_expected_to_grow_by():
+    admission = controller(Registry([running(memory_estimate=95 * GB, rss=5 * GB)]))
+    # Only 5 GB in use right now, but the running EVA should grow to 95
+    admitted, reason = admission.can_admit(TOKEN, snapshot(memory_available=thewatcher.total_ram - 5 * GB))
+    assert not admitted and 'memory' in reason
+    admission.registry.runs = [running(memory_estimate=10 * GB, rss=5 * GB)]
+    assert admission.can_admit(TOKEN, snapshot(memory_available=thewatcher.total_ram - 5 * GB))[0]
+
+
+def test_memory_reservations_count_against_the_budget():
+    admission = controller(Registry([running()]))
+    admission.memory_reservations.append(lambda: 99 * GB)
+    admitted, reason = admission.can_admit(TOKEN, snapshot())
+    assert not admitted and 'memory' in reason
+
+
+def test_cpu_budget():
+    admission = controller(Registry([running(cpu_estimate=7.5)]), cpu_cores=1.0)
+    admitted, reason = admission.can_admit(TOKEN, snapshot())
+    assert not admitted and 'CPU' in reason
+
+
+def test_waits_out_a_saturated_work_drive():
+    admission = controller(Registry([running()]), workdrive='sdb', disk_busy_limit=90, disk_write_limit=100000)
+    busy = {'sdb': {'busy_percent': 99, 'write_kBps': 0}}
+    writing = {'sdb': {'busy_percent': 10, 'write_kBps': 200000}}
+    quiet = {'sdb': {'busy_percent': 10, 'write_kBps': 0}}
+    assert not admission.can_admit(TOKEN, snapshot(disks=busy))[0]
+    assert not admission.can_admit(TOKEN, snapshot(disks=writing))[0]
+    assert admission.can_admit(TOKEN, snapshot(disks=quiet))[0]
+
+
+def test_learns_memory_per_file_from_finished_runs(tmp_path):
+    model_file = str(tmp_path / 'model.json')
+    registry = Registry()
+    admission = controller(registry, model_file=model_file)
+    default_estimate = admission.estimate('sq003ms', 100)[0]
+    for n_files in (10, 50, 100, 200):
+        # Each finished run reaches the controller through the registry's listener
+        registry.listeners[0]({'camera': 'sq003ms', 'n_files': n_files, 'peak_rss': 1 * GB + n_files * 0.05 * GB,
+                               'cpu_cores': 3.0})
+    memory, cpu_cores = admission.estimate('sq003ms', 100)
+    assert memory < default_estimate
+    assert cpu_cores > 1.0
+    # Saved, and picked up again by the next controller
+    assert controller(Registry(), model_file=model_file).estimate('sq003ms', 100) == (memory, cpu_cores)
+
+
+def test_learns_from_run_history_when_there_is_no_saved_model():
+    history = [{'camera': 'sq003ms', 'n_files': n, 'peak_rss': 20 * GB, 'cpu_cores': 2.0} for n in (5, 50)]
+    fresh = controller(Registry()).estimate('sq003ms', 10)[0]
+    assert controller(Registry(history=history)).estimate('sq003ms', 10)[0] > fresh
+
+
+def test_runs_never_sampled_teach_nothing():
+    admission = controller(Registry())
+    admission.finished({'camera': 'sq003ms', 'n_files': 10, 'peak_rss': 0, 'cpu_cores': None})
+    assert admission.models.get('sq003ms', {}).get('runs', 0) == 0
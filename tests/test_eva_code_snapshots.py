@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pytest
+
+import thewatcher
+
+
+@pytest.fixture
+def eva_checkout(tmp_path):
+    checkout = tmp_path / 'EVA'
+    (checkout / 'modules').mkdir(parents=True)
+    (checkout / 'configs').mkdir()
+    (checkout / 'EVApipeline.py').write_text('import modules.archive_file_input_classes\n')
+    (checkout / 'modules' / 'archive_file_input_classes.py').write_text('VERSION = 1\n')
+    (checkout / 'configs' / 'site.json').write_text('{}')
+    return str(checkout)
+
+
+def snapshots(tmp_path, **kwargs):
+    return thewatcher.EvaCodeSnapshots(str(tmp_path / 'snapshots'), eva_python=sys.executable, **kwargs)
+
+
+def test_one_read_only_snapshot_per_version(tmp_path, eva_checkout):
+    cache = snapshots(tmp_path)
+    version, snapshot_directory = cache.snapshot(eva_checkout)
+    assert cache.snapshot(eva_checkout) == (version, snapshot_directory)
+    assert os.stat(os.path.join(snapshot_directory, 'modules')).st_mode & 0o777 == 0o555
+    assert os.stat(os.path.join(snapshot_directory, 'EVApipeline.py')).st_mode & 0o777 == 0o444
+    # Compiled by EVA's interpreter up front, as nothing can write __pycache__ later
+    assert os.path.isdir(os.path.join(snapshot_directory, 'modules', '__pycache__'))
+
+    with open(os.path.join(eva_checkout, 'modules', 'archive_file_input_classes.py'), 'w') as f:
+        f.write('VERSION = 2\n')
+    new_version, new_snapshot_directory = cache.snapshot(eva_checkout)
+    assert new_version != version and new_snapshot_directory != snapshot_directory
+
+
+def test_token_directory_links_to_the_snapshot(tmp_path, eva_checkout):
+    cache = snapshots(tmp_path)
+    version, snapshot_directory = cache.snapshot(eva_checkout)
+    token_directory = tmp_path / 'token'
+    token_directory.mkdir()
+    cache.link_into(snapshot_directory, str(token_directory))
+    assert os.path.samefile(token_directory / 'EVApipeline.py', os.path.join(snapshot_directory, 'EVApipeline.py'))
+    assert (token_directory / 'archive_file_input_classes.py').read_text() == 'VERSION = 1\n'
+    assert os.readlink(token_directory / 'modules') == os.path.join(snapshot_directory, 'modules')
+    assert os.readlink(token_directory / 'configs') == os.path.join(snapshot_directory, 'configs')
+
+
+def test_pycache_and_pyc_files_dont_change_the_version(tmp_path, eva_checkout):
+    cache = snapshots(tmp_path)
+    version = cache.version(eva_checkout)
+    os.makedirs(os.path.join(eva_checkout, 'modules', '__pycache__'))
+    with open(os.path.join(eva_checkout, 'modules', '__pycache__', 'x.pyc'), 'wb') as f:
+        f.write(b'\0')
+    assert thewatcher.EvaCodeSnapshots(str(tmp_path / 'other')).version(eva_checkout) == version
+
+
+def test_keeps_only_the_newest_snapshots(tmp_path, eva_checkout, monkeypatch):
+    monkeypatch.setattr(thewatcher, 'eva_registry', thewatcher.EvaProcessRegistry())
+    cache = snapshots(tmp_path, keep=2)
+    versions = []
+    for n in range(4):
+        with open(os.path.join(eva_checkout, 'configs', 'site.json'), 'w') as f:
+            f.write(str(n))
+        versions.append(cache.snapshot(eva_checkout)[0])
+        # Distinct mtimes, so the age order is clear
+        os.utime(os.path.join(cache.cache_directory, versions[-1]), (n, 1000 + n))
+    assert sorted(os.listdir(cache.cache_directory)) == sorted(versions[-2:])
+
+
+def test_leftover_half_built_snapshots_are_cleared(tmp_path):
+    building = tmp_path / 'snapshots' / '0123456789abcdef.building.99'
+    building.mkdir(parents=True)
+    snapshots(tmp_path)
+    assert not building.exists()
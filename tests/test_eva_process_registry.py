@@ -0,0 +1,59 @@
+import json
+import subprocess
+import sys
+import time
+
+import thewatcher
+
+TOKEN = ['ecoo-sq003ms_001-20250101-00001-EX00.fits', 'ecoo-sq003ms_001-20250101-00002-EX00.fits']
+
+
+def launch(code):
+    return subprocess.Popen([sys.executable, '-c', code], start_new_session=True)
+
+
+def poll_until_finished(registry, timeout=30):
+    deadline = time.time() + timeout
+    while registry.running() and time.time() < deadline:
+        registry.poll()
+        time.sleep(0.05)
+
+
+def test_records_a_run_from_launch_to_exit_code(tmp_path):
+    history_file = str(tmp_path / 'eva_runs.jsonl')
+    registry = thewatcher.EvaProcessRegistry(history_file=history_file)
+    finished = []
+    registry.add_listener(finished.append)
+    popen = launch('import time; data = bytearray(50 * 2**20); time.sleep(0.5); raise SystemExit(3)')
+    record = registry.launched(popen, '/tokens/token1', TOKEN, eva_code_version='abc')
+    assert record['pgid'] == popen.pid
+    assert record['camera'] == 'sq003ms' and record['n_files'] == 2
+    assert [run['pid'] for run in registry.running()] == [popen.pid]
+
+    poll_until_finished(registry)
+    assert registry.running() == []
+    assert registry.finished_count == 1
+    [run] = finished
+    assert run['exit_code'] == 3
+    assert run['peak_rss'] > 50 * 2**20
+    assert run['wall_time'] >= 0.5
+    assert run['eva_code_version'] == 'abc'
+    assert registry.load_history() == [json.loads(json.dumps(run))]
+
+
+def test_a_failing_listener_doesnt_stop_the_others():
+    registry = thewatcher.EvaProcessRegistry()
+    finished = []
+    registry.add_listener(lambda record: 1 / 0)
+    registry.add_listener(finished.append)
+    registry.launched(launch('pass'), 'token', TOKEN)
+    poll_until_finished(registry)
+    assert [record['exit_code'] for record in finished] == [0]
+
+
+def test_history_skips_half_written_lines(tmp_path):
+    history_file = tmp_path / 'eva_runs.jsonl'
+    history_file.write_text('{"pid": 1}\n{"pid": 2}\n{"pid"')
+    registry = thewatcher.EvaProcessRegistry(history_file=str(history_file))
+    assert [record['pid'] for record in registry.load_history()] == [1, 2]
+    assert [record['pid'] for record in registry.load_history(max_runs=1)] == [2]
@@ -0,0 +1,84 @@
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import thewatcher
+
+
+def test_a_subsystem_that_stops_beating_is_stalled():
+    monitor = thewatcher.HealthMonitor()
+    monitor.register('ingestion', stall_after=0.2)
+    monitor.register('main_loop', stall_after=60)
+    assert monitor.check()['healthy']
+    time.sleep(0.3)
+    status = monitor.check()
+    assert not status['healthy']
+    assert status['subsystems']['ingestion']['stalled']
+    assert not status['subsystems']['main_loop']['stalled']
+    monitor.beat('ingestion')
+    assert monitor.check()['healthy']
+
+
+def test_an_idle_subsystem_isnt_stalled_and_its_clock_restarts():
+    monitor = thewatcher.HealthMonitor()
+    idle = [True]
+    monitor.register('ingestion', stall_after=0.2, idle=lambda: idle[0])
+    time.sleep(0.3)
+    assert monitor.check()['subsystems']['ingestion']['idle']
+    idle[0] = False
+    # Work just turned up, so it has its full stall_after from now
+    assert monitor.check()['healthy']
+    time.sleep(0.3)
+    assert not monitor.check()['healthy']
+
+
+def test_startup_is_watched_until_started():
+    monitor = thewatcher.HealthMonitor()
+    monitor.register('startup', stall_after=0.1)
+    time.sleep(0.2)
+    assert monitor.check()['state'] == 'starting'
+    assert not monitor.check()['healthy']
+    monitor.started()
+    status = monitor.check()
+    assert status['healthy'] and status['state'] == 'running' and 'startup' not in status['subsystems']
+
+
+def test_heartbeat_only_while_healthy(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monitor = thewatcher.HealthMonitor(status_file=str(tmp_path / 'status.json'), interval=0.05)
+    monitor.register('ingestion', stall_after=0.3)
+    monitor.start()
+    try:
+        time.sleep(0.2)
+        assert os.path.exists(thewatcher.HEARTBEAT)
+        with open(tmp_path / 'status.json') as f:
+            assert json.load(f)['healthy']
+        time.sleep(0.3)
+        os.remove(thewatcher.HEARTBEAT)
+        time.sleep(0.2)
+        assert not os.path.exists(thewatcher.HEARTBEAT)
+    finally:
+        # Its thread can't be stopped, so have it go quiet
+        monitor.interval = 3600
+
+
+def test_health_endpoint(monkeypatch):
+    monitor = thewatcher.HealthMonitor()
+    monitor.register('ingestion', stall_after=0.2)
+    monkeypatch.setattr(thewatcher, 'health_monitor', monitor)
+    server = thewatcher.start_metrics_server(port=0)
+    try:
+        url = 'http://127.0.0.1:%d/health' % server.server_address[1]
+        with urllib.request.urlopen(url) as response:
+            assert json.load(response)['subsystems']['ingestion']['stalled'] is False
+        time.sleep(0.3)
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url)
+        assert error.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
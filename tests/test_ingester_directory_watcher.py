@@ -0,0 +1,105 @@
+import os
+import time
+
+import pytest
+
+import thewatcher
+
+
+def write_sidecar(directory, name, mtime, data=True):
+    path = os.path.join(directory, name + '.json')
+    with open(path, 'w') as f:
+        f.write('{}')
+    os.utime(path, (mtime, mtime))
+    if data:
+        with open(path[:-5], 'wb') as f:
+            f.write(b'\0' * 2880)
+    return path
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    items = []
+    monkeypatch.setattr(thewatcher, 'add_ingester_item', lambda item, priority=None: items.append(item[0]))
+    return items
+
+
+def watcher(tmp_path, **kwargs):
+    return thewatcher.IngesterDirectoryWatcher(str(tmp_path), str(tmp_path / 'failed'), **kwargs)
+
+
+def test_reconcile_indexes_and_dispatches_oldest_first(tmp_path, dispatched):
+    now = time.time()
+    newer = write_sidecar(tmp_path, 'eco1-sq003ms-20250101-0002-EX00.fits', now - 10)
+    older = write_sidecar(tmp_path, 'eco1-sq003ms-20250101-0001-EX00.fits', now - 20)
+    w = watcher(tmp_path)
+    w.reconcile()
+    w._dispatch()
+    assert dispatched == [older, newer]
+    # Queued sidecars aren't handed out again by the next reconcile
+    w.reconcile()
+    w._dispatch()
+    assert dispatched == [older, newer]
+
+
+def test_variance_sidecars_are_removed_not_ingested(tmp_path, dispatched):
+    path = write_sidecar(tmp_path, 'variance_eco1-sq003ms-20250101-0001-EX00.fits', time.time())
+    w = watcher(tmp_path)
+    w.reconcile()
+    w._dispatch()
+    assert dispatched == []
+    assert not os.path.exists(path)
+    assert not os.path.exists(path[:-5])
+
+
+def test_sidecar_waits_for_its_data_file_to_settle(tmp_path, dispatched):
+    path = write_sidecar(tmp_path, 'eco1-sq003ms-20250101-0001-EX00.fits', time.time(), data=False)
+    w = watcher(tmp_path, settle_time=60)
+    w.reconcile()
+    w._dispatch()
+    assert dispatched == []
+    assert path in w.deferred
+
+    # The data file turns up
+    with open(path[:-5], 'wb') as f:
+        f.write(b'\0')
+    w._dispatch()
+    assert dispatched == [path]
+
+
+def test_sidecar_goes_anyway_once_settle_time_has_passed(tmp_path, dispatched):
+    path = write_sidecar(tmp_path, 'eco1-sq003ms-20250101-0001-EX00.fits', time.time(), data=False)
+    w = watcher(tmp_path, settle_time=0)
+    w.reconcile()
+    w._dispatch()
+    assert dispatched == [path]
+
+
+def test_deleted_sidecars_are_forgotten(tmp_path, dispatched):
+    path = write_sidecar(tmp_path, 'eco1-sq003ms-20250101-0001-EX00.fits', time.time(), data=False)
+    w = watcher(tmp_path, settle_time=60)
+    w.reconcile()
+    w._forget(path)
+    os.remove(path)
+    w._dispatch()
+    assert dispatched == []
+    assert path not in w.pending and path not in w.deferred
+
+
+def test_inotify_reports_writes_and_deletes(tmp_path):
+    try:
+        inotify = thewatcher.Inotify()
+    except OSError:
+        pytest.skip("no inotify here")
+    try:
+        inotify.add_watch(str(tmp_path), thewatcher.IN_CLOSE_WRITE | thewatcher.IN_DELETE)
+        (tmp_path / 'a.json').write_text('{}')
+        os.remove(tmp_path / 'a.json')
+        events = []
+        deadline = time.time() + 5
+        while len(events) < 2 and time.time() < deadline:
+            events += inotify.read(timeout=0.5)
+        assert [(name, bool(mask & thewatcher.IN_CLOSE_WRITE), bool(mask & thewatcher.IN_DELETE))
+                for wd, mask, name in events] == [('a.json', True, False), ('a.json', False, True)]
+    finally:
+        inotify.close()
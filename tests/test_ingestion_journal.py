@@ -0,0 +1,56 @@
+import pytest
+
+import thewatcher
+
+
+def test_journal_replays_after_a_restart(tmp_path):
+    path = str(tmp_path / 'journal.sqlite3')
+    journal = thewatcher.IngestionJournal(path)
+    entry = journal.discovered('/ingestion/a.fits.json', 1000, 1.5)
+    assert entry['state'] == 'discovered'
+    journal.advance('/ingestion/a.fits.json', 'validated', record={'basename': 'a'})
+    journal.advance('/ingestion/a.fits.json', 'uploaded', s3_version={'key': 'k'})
+    journal.count_attempt('/ingestion/a.fits.json')
+    journal.connection.close()
+
+    journal = thewatcher.IngestionJournal(path)
+    entry = journal.discovered('/ingestion/a.fits.json', 1000, 1.5)
+    assert entry['state'] == 'uploaded'
+    assert entry['record'] == {'basename': 'a'}
+    assert entry['s3_version'] == {'key': 'k'}
+    assert entry['attempts'] == 1
+
+
+def test_journal_starts_afresh_for_a_different_file(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    journal.discovered('/ingestion/a.fits.json', 1000, 1.5)
+    journal.advance('/ingestion/a.fits.json', 'uploaded', s3_version={'key': 'k'})
+    entry = journal.discovered('/ingestion/a.fits.json', 2000, 2.5)
+    assert entry['state'] == 'discovered'
+    assert entry['s3_version'] is None
+    with pytest.raises(ValueError):
+        journal.advance('/ingestion/a.fits.json', 'lost')
+
+
+def test_journal_retries_a_failed_file_from_the_start(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    journal.discovered('/ingestion/a.fits.json', 1000, 1.5)
+    journal.advance('/ingestion/a.fits.json', 'validated', record={'basename': 'a'})
+    journal.count_attempt('/ingestion/a.fits.json')
+    journal.advance('/ingestion/a.fits.json', 'failed', error='400 Client Error')
+    entry = journal.discovered('/ingestion/a.fits.json', 1000, 1.5)
+    assert entry['state'] == 'discovered'
+    # Same file, so the attempts it has had still count
+    assert entry['attempts'] == 1
+
+
+def test_prune_forgets_old_finished_entries_only(tmp_path):
+    journal = thewatcher.IngestionJournal(str(tmp_path / 'journal.sqlite3'))
+    for name, state in (('done', 'recorded'), ('gave_up', 'failed'), ('busy', 'uploaded')):
+        journal.discovered(name, 1, 1)
+        journal.advance(name, state)
+    journal.connection.execute('UPDATE ingestion SET updated = 0')
+    journal.prune(max_age_days=14)
+    assert journal.get('done') is None
+    assert journal.get('gave_up') is None
+    assert journal.get('busy')['state'] == 'uploaded'
@@ -0,0 +1,77 @@
+import os
+import time
+
+import thewatcher
+
+
+def sidecar(telescope, camera, index, frame_type='EX00'):
+    return [f"/ingestion/{telescope}-{camera}_001-20250101-{index:04d}-{frame_type}.fits.json",
+            '/ingestion/', '/failedingestion/']
+
+
+def put(q, item, mtime, now):
+    q.put(item, priority=thewatcher.ingest_priority(item[0], mtime, now=now))
+
+
+def test_frame_class():
+    assert thewatcher.ingest_frame_class('eco1-sq003ms-20250101-0001-EX00.fits') == 'science'
+    assert thewatcher.ingest_frame_class('eco1-sq003ms-20250101-0001-BI00.fits') == 'calibration'
+    assert thewatcher.ingest_frame_class('eco1-sq003ms-20250101-0001-EX10.fits') == 'reduced'
+    assert thewatcher.ingest_frame_class('eco1-sq003ms-20250101-0001-EX00-sek.fits') == 'sidecar'
+    assert thewatcher.ingest_frame_class('eco1-sq003ms-20250101-0001-EX00_thumbnail.jpg') == 'sidecar'
+    # A camera named sea... is not a sidecar
+    assert thewatcher.ingest_frame_class('eco1-sea002cs-20250101-1-EX00.fits') == 'science'
+
+
+def test_orders_realtime_first_then_by_class_then_age():
+    now = time.time()
+    q = thewatcher.IngestionPriorityQueue()
+    items = {
+        'old science': (sidecar('eco1', 'sq003ms', 1), now - 7200),
+        'new calibration': (sidecar('eco1', 'sq003ms', 2, 'BI00'), now - 60),
+        'new science': (sidecar('eco1', 'sq003ms', 3), now - 30),
+        'newer science': (sidecar('eco1', 'sq003ms', 4), now - 10),
+    }
+    for item, mtime in items.values():
+        put(q, item, mtime, now)
+    order = [q.get()[0] for _ in items]
+    assert order == [items[name][0][0] for name in ('new science', 'newer science', 'new calibration', 'old science')]
+
+
+def test_cameras_take_turns():
+    now = time.time()
+    q = thewatcher.IngestionPriorityQueue()
+    # A big backlog from one camera, queued first, and a little from another
+    for index in range(10):
+        put(q, sidecar('eco1', 'sq003ms', index), now - 100 + index, now)
+    for index in range(2):
+        put(q, sidecar('eco2', 'sq005mm', index), now - 50 + index, now)
+    cameras = [thewatcher.ingest_stream(q.get()[0])[1] for _ in range(4)]
+    assert cameras == ['sq003ms', 'sq005mm', 'sq003ms', 'sq005mm']
+
+
+def test_sentinel_comes_first_and_task_done_joins():
+    q = thewatcher.IngestionPriorityQueue()
+    item = sidecar('eco1', 'sq003ms', 1)
+    put(q, item, time.time(), time.time())
+    q.put(None)
+    assert q.qsize() == 1
+    assert q.get() is None
+    assert q.get() == item
+    q.task_done()
+    q.task_done()
+    q.join()
+    assert q.empty()
+
+
+def test_works_out_priority_from_the_files_when_not_given(tmp_path):
+    now = time.time()
+    q = thewatcher.IngestionPriorityQueue()
+    paths = []
+    for index, age in ((1, 7200), (2, 10)):
+        path = tmp_path / f"eco1-sq003ms_001-20250101-{index:04d}-EX00.fits.json"
+        path.write_text('{}')
+        os.utime(path, (now - age, now - age))
+        paths.append(str(path))
+        q.put([str(path), str(tmp_path), str(tmp_path)])
+    assert [q.get()[0] for _ in paths] == [paths[1], paths[0]]
@@ -0,0 +1,50 @@
+import hashlib
+import io
+import os
+
+import thewatcher
+
+
+def test_reads_and_seeks_like_a_file(tmp_path):
+    data = os.urandom(10000)
+    path = tmp_path / 'frame.fits'
+    path.write_bytes(data)
+    with thewatcher.MappedFitsFile(str(path)) as f:
+        assert f.name == str(path)
+        assert f.read(100) == data[:100]
+        assert f.tell() == 100
+        f.seek(-10, io.SEEK_END)
+        assert f.read() == data[-10:]
+        assert f.read(5) == b''
+        f.seek(50)
+        f.seek(25, io.SEEK_CUR)
+        buffer = bytearray(25)
+        assert f.readinto(buffer) == 25
+        assert bytes(buffer) == data[75:100]
+        f.seek(0)
+        assert f.readall() == data
+
+
+def test_md5_matches_the_file(tmp_path):
+    data = os.urandom(9 * 2 ** 20 + 123)  # more than one chunk
+    path = tmp_path / 'frame.fits'
+    path.write_bytes(data)
+    with thewatcher.MappedFitsFile(str(path)) as f:
+        f.seek(500)
+        assert f.md5 == hashlib.md5(data).hexdigest()
+        # Working out the md5 doesn't move the read position
+        assert f.tell() == 500
+
+
+def test_ingest_job_maps_once_and_rewinds(tmp_path):
+    path = tmp_path / 'frame.fits'
+    path.write_bytes(b'x' * 3000)
+    job = thewatcher.IngestJob(str(path) + '.json', str(tmp_path), str(tmp_path))
+    first = job.data_file()
+    first.read(100)
+    second = job.data_file()
+    assert second is first
+    assert second.tell() == 0
+    assert job.content_md5() == hashlib.md5(b'x' * 3000).hexdigest()
+    job.close()
+    assert first.closed
@@ -0,0 +1,69 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import thewatcher
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(thewatcher, 'metrics_registry', [])
+    return thewatcher.metrics_registry
+
+
+def test_counter_and_gauge_render_in_prometheus_text_format(registry):
+    files = thewatcher.Counter('files_total', 'Files.')
+    errors = thewatcher.Counter('errors_total', 'Errors.', ['stage'])
+    depth = thewatcher.Gauge('depth', 'Depth.', function=lambda: 7)
+    files.inc()
+    files.inc(2)
+    errors.inc(stage='upload')
+    errors.inc(stage='say "hi"')
+    text = thewatcher.render_metrics()
+    assert '# TYPE files_total counter\nfiles_total 3.0\n' in text
+    assert 'errors_total{stage="upload"} 1.0' in text
+    assert 'errors_total{stage="say \\"hi\\""} 1.0' in text
+    assert 'depth 7.0' in text
+    assert errors.total() == 2
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    seconds = thewatcher.Histogram('seconds', 'Seconds.', ['stage'], buckets=(1, 5))
+    for value in (0.5, 2, 2, 10):
+        seconds.observe(value, stage='upload')
+    text = thewatcher.render_metrics()
+    assert 'seconds_bucket{stage="upload",le="1.0"} 1' in text
+    assert 'seconds_bucket{stage="upload",le="5.0"} 3' in text
+    assert 'seconds_bucket{stage="upload",le="+Inf"} 4' in text
+    assert 'seconds_sum{stage="upload"} 14.5' in text
+    assert 'seconds_count{stage="upload"} 4' in text
+
+
+def test_histogram_timer(registry):
+    seconds = thewatcher.Histogram('seconds', 'Seconds.')
+    with seconds.time():
+        pass
+    assert 'seconds_count 1' in thewatcher.render_metrics()
+
+
+def test_error_classes_follow_the_error_handling():
+    assert thewatcher.ingest_error_class('requests.HTTPError: 502 Server Error: Bad Gateway') == 'http_502'
+    assert thewatcher.ingest_error_class('Version with this md5 already exists') == 'duplicate'
+    assert thewatcher.ingest_error_class('KeyError') == 'other'
+
+
+def test_metrics_endpoint(registry):
+    thewatcher.Counter('files_total', 'Files.').inc()
+    server = thewatcher.start_metrics_server(port=0)
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'files_total 1.0' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '/nothing')
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
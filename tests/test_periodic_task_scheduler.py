@@ -0,0 +1,111 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+import thewatcher
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    monitor = thewatcher.HealthMonitor()
+    monkeypatch.setattr(thewatcher, 'health_monitor', monitor)
+    return monitor
+
+
+def test_runs_each_task_on_its_own_cadence(monitor):
+    runs = {'fast': 0, 'slow': 0, 'later': 0}
+
+    def counter(name):
+        def run():
+            runs[name] += 1
+        return run
+
+    scheduler = thewatcher.PeriodicTaskScheduler()
+    scheduler.add('fast', counter('fast'), period=0.2)
+    scheduler.add('slow', counter('slow'), period=10)
+    scheduler.add('later', counter('later'), period=0.5, run_at_start=False)
+    scheduler.start()
+    time.sleep(1.1)
+    assert 4 <= runs['fast'] <= 7
+    assert runs['slow'] == 1
+    assert 1 <= runs['later'] <= 2
+
+
+def test_a_failing_task_keeps_its_schedule(monitor):
+    runs = []
+
+    def fails():
+        runs.append(time.time())
+        if len(runs) <= 3:
+            raise OSError('disk gone')
+
+    thewatcher.PeriodicTaskScheduler().add('fails', fails, period=0.1).start()
+    time.sleep(0.5)
+    assert len(runs) >= 4
+
+
+def test_each_run_gets_a_thread_so_a_slow_task_holds_nothing_up(monitor):
+    release = threading.Event()
+    fast_threads = []
+    scheduler = thewatcher.PeriodicTaskScheduler()
+    scheduler.add('held_up', release.wait, period=0.1)
+    scheduler.add('quick', lambda: fast_threads.append(threading.current_thread().name), period=0.1)
+    scheduler.start()
+    time.sleep(0.5)
+    release.set()
+    assert len(fast_threads) >= 3
+    assert set(fast_threads) == {'task_quick'}
+
+
+def test_runs_of_one_task_never_overlap(monitor):
+    running = []
+    overlapped = []
+    finished = []
+
+    def slow():
+        overlapped.append(bool(running))
+        running.append(1)
+        time.sleep(0.3)
+        running.pop()
+        finished.append(1)
+
+    thewatcher.PeriodicTaskScheduler().add('slow', slow, period=0.05).start()
+    time.sleep(1.0)
+    assert len(finished) >= 2
+    assert not any(overlapped)
+
+
+def test_a_run_past_its_timeout_is_reported_and_stalls_health(monitor):
+    release = threading.Event()
+    overruns = thewatcher.scheduled_task_overruns.values.get(('stuck',), 0)
+    scheduler = thewatcher.PeriodicTaskScheduler()
+    scheduler.add('stuck', release.wait, period=60, timeout=0.3)
+    scheduler.start()
+    time.sleep(1.5)
+    try:
+        assert thewatcher.scheduled_task_overruns.values.get(('stuck',), 0) == overruns + 1
+        assert monitor.check()['subsystems']['task:stuck']['stalled']
+    finally:
+        release.set()
+    time.sleep(0.2)
+    assert monitor.check()['healthy']
+
+
+def test_next_run_sets_the_times_of_a_task(monitor):
+    runs = []
+    next_run = lambda now: now + datetime.timedelta(seconds=0.3)
+    thewatcher.PeriodicTaskScheduler().add('timed', lambda: runs.append(1), next_run=next_run,
+                                           run_at_start=False).start()
+    time.sleep(0.2)
+    assert runs == []
+    time.sleep(0.8)
+    assert 1 <= len(runs) <= 3
+
+
+def test_next_day_rollover():
+    assert thewatcher.next_day_rollover(datetime.datetime(2025, 1, 1, 23, 59, 59)) == datetime.datetime(2025, 1, 2, 0, 0, 5)
+    assert thewatcher.next_day_rollover(datetime.datetime(2025, 1, 1, 0, 0, 1)) == datetime.datetime(2025, 1, 2, 0, 0, 5)
+    assert thewatcher.next_day_rollover(datetime.datetime(2024, 12, 31, 12)) == datetime.datetime(2025, 1, 1, 0, 0, 5)
+    assert thewatcher.next_day_rollover(datetime.datetime(2024, 2, 28, 12)) == datetime.datetime(2024, 2, 29, 0, 0, 5)
@@ -0,0 +1,91 @@
+import json
+import os
+import time
+
+import pytest
+
+import thewatcher
+from pipe_queue_standin import PipeQueueStandinServer
+
+
+@pytest.fixture
+def server():
+    server = PipeQueueStandinServer(('127.0.0.1', 0), max_wait=1).start()
+    yield server
+    server.stop()
+
+
+def enqueue_runs(queue, count):
+    for index in range(count):
+        queue.enqueue({'request': 'EVA_process_files',
+                       'request_content': [f"eco1-sq003ms_001-20250101-{index:04d}-EX00.fits"]})
+
+
+def client(server, directory, **kwargs):
+    return thewatcher.PipeQueueClient(server.url, 'lcs1', 'test', str(directory), **kwargs)
+
+
+def test_leases_into_token_files_and_acks(server, tmp_path):
+    queue = server.queue('lcs1')
+    enqueue_runs(queue, 3)
+    pipe_queue = client(server, tmp_path, visibility_timeout=60)
+    runs = pipe_queue.lease(2)
+    assert len(runs) == 2
+    token_paths, files, lease_id = runs[0]
+    assert json.load(open(token_paths[0])) == files
+    assert queue.stats()['on_lease'] == 2
+
+    pipe_queue.finished({'pipe_queue_lease': lease_id, 'exit_code': 0})
+    assert not os.path.exists(token_paths[0])
+    assert queue.stats()['acked'] == 1
+    pipe_queue.finished({'pipe_queue_lease': runs[1][2], 'exit_code': 1})
+    assert queue.stats()['nacked'] == 1
+    assert queue.stats()['waiting'] == 2
+
+
+def test_unsupported_and_empty_requests(server, tmp_path):
+    queue = server.queue('lcs1')
+    queue.enqueue({'request': 'something_else', 'request_content': ['a.fits']})
+    queue.enqueue({'request': 'EVA_process_files', 'request_content': []})
+    pipe_queue = client(server, tmp_path)
+    assert pipe_queue.lease(5) == []
+    stats = queue.stats()
+    assert (stats['nacked'], stats['acked'], stats['on_lease']) == (1, 1, 0)
+
+
+def test_empty_queue_long_polls(server, tmp_path):
+    pipe_queue = client(server, tmp_path)
+    start = time.time()
+    assert pipe_queue.lease(1, wait=0.5) == []
+    assert time.time() - start >= 0.4
+
+
+def test_renews_leases_and_notices_lost_ones(server, tmp_path):
+    queue = server.queue('lcs1')
+    enqueue_runs(queue, 2)
+    pipe_queue = client(server, tmp_path, visibility_timeout=3)
+    (kept_paths, files, kept), (lost_paths, files, lost) = pipe_queue.lease(2)
+    queue.nack(lost)  # gone behind our back
+    with pipe_queue.lock:
+        for lease in pipe_queue.leases.values():
+            lease['renewed'] = 0
+    pipe_queue.renew_due()
+    assert queue.stats()['renewed'] == 1
+    assert pipe_queue.leases[kept]['renewed'] > 0
+    assert pipe_queue.leases[lost].get('lost')
+    # Its token file goes when EVA is done with it
+    pipe_queue.finished({'pipe_queue_lease': lost, 'exit_code': 0})
+    assert not os.path.exists(lost_paths[0])
+
+
+def test_wrong_url_is_an_error_not_an_empty_queue(server, tmp_path, capsys):
+    pipe_queue = thewatcher.PipeQueueClient(server.url + '/nothing/here', 'lcs1', 'test', str(tmp_path))
+    assert pipe_queue.lease(1) == []
+    assert "404" in capsys.readouterr().out
+
+
+def test_sweeps_leftover_token_files(tmp_path):
+    (tmp_path / 'pipequeue_7').write_text('["x"]')
+    (tmp_path / 'not_ours').write_text('["x"]')
+    thewatcher.PipeQueueClient('http://127.0.0.1:9', 'lcs1', 'test', str(tmp_path))
+    assert os.listdir(tmp_path) == ['not_ours']
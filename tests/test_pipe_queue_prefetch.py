@@ -0,0 +1,68 @@
+import os
+import select
+import time
+
+import pytest
+
+import thewatcher
+from pipe_queue_standin import PipeQueueStandinServer
+
+
+@pytest.fixture
+def server():
+    server = PipeQueueStandinServer(('127.0.0.1', 0), max_wait=1).start()
+    yield server
+    server.stop()
+
+
+def enqueue_runs(queue, count):
+    for index in range(count):
+        queue.enqueue({'request': 'EVA_process_files',
+                       'request_content': [f"eco1-sq003ms_001-20250101-{index:04d}-EX00.fits"]})
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def started_client(server, directory):
+    return thewatcher.PipeQueueClient(server.url, 'lcs1', 'test', str(directory),
+                                      visibility_timeout=60, poll_period=0.2, long_poll=1).start()
+
+
+def test_prefetches_what_is_wanted_and_wakes_the_main_loop(server, tmp_path):
+    queue = server.queue('lcs1')
+    enqueue_runs(queue, 5)
+    pipe_queue = started_client(server, tmp_path)
+    time.sleep(0.5)
+    # Nothing wanted, nothing leased
+    assert queue.stats()['on_lease'] == 0
+
+    pipe_queue.want(2)
+    ready, _, _ = select.select([pipe_queue], [], [], 5)
+    assert ready == [pipe_queue]
+    assert wait_for(lambda: len(pipe_queue) == 2)
+    runs = pipe_queue.take(5)
+    assert len(runs) == 2
+    assert queue.stats()['on_lease'] == 2
+
+
+def test_gives_back_leases_there_is_no_room_for(server, tmp_path):
+    queue = server.queue('lcs1')
+    enqueue_runs(queue, 5)
+    pipe_queue = started_client(server, tmp_path)
+    pipe_queue.want(3)
+    assert wait_for(lambda: len(pipe_queue) == 3)
+    pipe_queue.want(1)
+    assert wait_for(lambda: queue.stats()['on_lease'] == 1)
+    assert len(pipe_queue) == 1
+    pipe_queue.want(0)
+    assert wait_for(lambda: queue.stats()['on_lease'] == 0)
+    assert len(pipe_queue) == 0
+    assert queue.stats()['nacked'] == 3
+    assert os.listdir(tmp_path) == []
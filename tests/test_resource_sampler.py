@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+import thewatcher
+
+
+def sample(cpu_percent, memory_percent=50.0, read_kBps=0.0):
+    return {'cpu_percent': cpu_percent, 'memory_percent': memory_percent, 'memory_available': 1,
+            'disks': {'sda': {'read_kBps': read_kBps, 'write_kBps': 0.0, 'busy_percent': 0.0}}}
+
+
+def test_snapshot_smooths_rates_but_not_memory():
+    sampler = thewatcher.ResourceSampler(interval=1.0, smoothing_time=4.0)
+    sampler._publish(sample(0.0, memory_percent=40.0, read_kBps=0.0))
+    sampler._publish(sample(100.0, memory_percent=90.0, read_kBps=1000.0))
+    snapshot = sampler.snapshot()
+    assert snapshot['cpu_percent'] == pytest.approx(25.0)
+    assert snapshot['disks']['sda']['read_kBps'] == pytest.approx(250.0)
+    assert snapshot['memory_percent'] == 90.0
+
+
+def test_snapshot_before_the_first_sample_doesnt_block():
+    sampler = thewatcher.ResourceSampler(interval=60)
+    start = time.monotonic()
+    snapshot = sampler.snapshot()
+    assert time.monotonic() - start < 0.5
+    assert set(snapshot) >= {'cpu_percent', 'memory_percent', 'disks', 'time'}
+
+
+def test_sampler_thread_publishes_samples_for_watched_devices():
+    sampler = thewatcher.ResourceSampler(interval=0.05, smoothing_time=0.05)
+    sampler.start(devices=['none', '', 'not-a-disk'])
+    assert sampler.devices == ['not-a-disk']
+    deadline = time.time() + 5
+    while sampler.current is None and time.time() < deadline:
+        time.sleep(0.02)
+    assert sampler.current is not None
+    assert 0.0 <= round(sampler.current['cpu_percent'], 6) <= 100.0
+    # A device psutil doesn't know about is left out rather than reported as idle
+    assert sampler.current['disks'] == {}
@@ -0,0 +1,33 @@
+import time
+
+import thewatcher
+
+
+def test_delays_double_with_jitter_up_to_the_cap():
+    scheduler = thewatcher.RetryScheduler(base_delay=2, max_delay=60, max_attempts=12)
+    for attempt, full_delay in ((1, 2), (2, 4), (3, 8), (5, 32), (6, 60), (12, 60)):
+        for _ in range(20):
+            delay = scheduler.delay_for(attempt)
+            assert full_delay / 2 <= delay <= full_delay
+
+
+def test_gives_up_after_max_attempts():
+    scheduler = thewatcher.RetryScheduler(max_attempts=3)
+    assert scheduler.schedule(['a.fits.json', '/ingestion/', '/failed/'], 4) is None
+    assert len(scheduler) == 0
+
+
+def test_items_go_back_on_the_queue_when_due(monkeypatch):
+    requeued = []
+    monkeypatch.setattr(thewatcher, 'add_ingester_item', lambda item, priority=None: requeued.append((time.monotonic(), item)))
+    scheduler = thewatcher.RetryScheduler(base_delay=0.4, max_attempts=3)
+    start = time.monotonic()
+    scheduler.schedule(['late'], 2)   # 0.4 to 0.8 s
+    scheduler.schedule(['early'], 1)  # 0.2 to 0.4 s
+    assert len(scheduler) == 2
+    deadline = time.time() + 5
+    while len(requeued) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    assert [item for due, item in requeued] == [['early'], ['late']]
+    assert requeued[0][0] - start >= 0.2
+    assert len(scheduler) == 0
@@ -0,0 +1,121 @@
+import json
+import os
+import queue
+import time
+
+import pytest
+import requests
+
+import thewatcher
+
+
+def fits_header(cards):
+    header = ''.join(card.ljust(80)[:80] for card in cards + ['END'])
+    return header.ljust(-(-len(header) // 2880) * 2880).encode('ascii')
+
+
+def write_frame(directory, index, size=2 * 2880):
+    """
+    A small FITS file the real validation takes, and its JSON sidecar. Returns the sidecar path.
+    """
+    path = os.path.join(str(directory), f"ecoo-sq003ms_001-20250101-{index:05d}-EX00.fits")
+    with open(path, 'wb') as f:
+        f.write(fits_header(['SIMPLE  =                    T', 'BITPIX  =                    8',
+                             'NAXIS   =                    1', f"NAXIS1  = {size - 2880:20d}"]))
+        f.write(os.urandom(size - 2880))
+    with open(path + '.json', 'w') as f:
+        json.dump({'INSTRUME': 'sq003ms', 'SITEID': 'ecoo', 'TELID': 'ecoo', 'OBSTYPE': 'EXPOSE',
+                   'DATE-OBS': '2025-01-01T00:00:00', 'DAY-OBS': '20250101', 'PROPID': 'test',
+                   'BLKUID': str(index)}, f)
+    return path + '.json'
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def archive(monkeypatch, tmp_path):
+    """
+    Stands in for the archive: records what was uploaded and posted.
+    """
+    calls = {'upload': [], 'record': [], 'record_error': None}
+
+    def upload_file_to_file_store(fileobj, path=None, file_metadata=None):
+        data = fileobj.read()
+        calls['upload'].append(len(data))
+        return {'key': str(len(calls['upload'])), 'md5': 'x', 'extension': '.fits'}
+
+    def ingest_archive_record(version, record, **kwargs):
+        if calls['record_error']:
+            raise requests.HTTPError(calls['record_error'])
+        calls['record'].append((version, record['basename']))
+        return {'id': len(calls['record'])}
+
+    monkeypatch.setattr(thewatcher, 'upload_file_to_file_store', upload_file_to_file_store)
+    monkeypatch.setattr(thewatcher, 'ingest_archive_record', ingest_archive_record)
+    monkeypatch.setattr(thewatcher, 'ingestion_journal', thewatcher.IngestionJournal(':memory:'))
+    (tmp_path / 'failed').mkdir()
+    return calls
+
+
+def item(sidecar, tmp_path):
+    return [sidecar, str(tmp_path) + '/', str(tmp_path / 'failed')]
+
+
+def test_staged_pipeline_ingests_and_tidies_up(archive, monkeypatch, tmp_path):
+    monkeypatch.setattr(thewatcher, 'ingester_queue', queue.Queue())
+    pipeline = thewatcher.StagedIngestionPipeline(validation_processes=1, upload_threads=2, record_threads=1)
+    pipeline.start()
+    try:
+        sidecars = [write_frame(tmp_path, index) for index in range(3)]
+        for sidecar in sidecars:
+            thewatcher.ingester_queue.put(item(sidecar, tmp_path))
+        assert wait_for(lambda: not any(os.path.exists(s) for s in sidecars))
+    finally:
+        thewatcher.ingester_queue.put(None)
+        pipeline.validation_pool.shutdown()
+    assert sorted(basename for version, basename in archive['record']) == \
+        sorted(os.path.basename(s)[:-len('.fits.json')] for s in sidecars)
+    assert len(archive['upload']) == 3
+    assert all(thewatcher.ingestion_journal.get(s)['state'] == 'recorded' for s in sidecars)
+    assert os.listdir(tmp_path / 'failed') == []
+
+
+def test_client_errors_go_to_the_failed_directory(archive, tmp_path):
+    archive['record_error'] = '400 Client Error: Bad Request'
+    sidecar = write_frame(tmp_path, 1)
+    thewatcher.ingest_item(item(sidecar, tmp_path))
+    assert sorted(os.listdir(tmp_path / 'failed')) == sorted([os.path.basename(sidecar), os.path.basename(sidecar)[:-5]])
+    assert thewatcher.ingestion_journal.get(sidecar)['state'] == 'failed'
+
+
+def test_resumes_after_the_last_step_that_finished(archive, tmp_path):
+    sidecar = write_frame(tmp_path, 1)
+    stat = os.stat(sidecar[:-5])
+    thewatcher.ingestion_journal.discovered(sidecar, stat.st_size, stat.st_mtime)
+    thewatcher.ingestion_journal.advance(sidecar, 'uploaded', record={'basename': 'from_before'},
+                                         s3_version={'key': 'k', 'md5': 'm'})
+    thewatcher.ingest_item(item(sidecar, tmp_path))
+    # Straight to the record, no second upload
+    assert archive['upload'] == []
+    assert archive['record'] == [({'key': 'k', 'md5': 'm'}, 'from_before')]
+    assert not os.path.exists(sidecar)
+
+
+def test_prepare_drops_missing_and_tiny_files(archive, tmp_path):
+    missing = str(tmp_path / 'gone.fits.json')
+    (tmp_path / 'gone.fits.json').write_text('{}')
+    assert thewatcher.prepare_ingest_job(item(missing, tmp_path)) is None
+    assert not os.path.exists(missing)
+
+    tiny = tmp_path / 'tiny.fits'
+    tiny.write_bytes(b'\0' * 50)
+    (tmp_path / 'tiny.fits.json').write_text('{}')
+    assert thewatcher.prepare_ingest_job(item(str(tmp_path / 'tiny.fits.json'), tmp_path)) is None
+    assert os.listdir(tmp_path) == ['failed']
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import thewatcher
+
+
+def test_total_rate_is_shared_between_the_buckets():
+    assert sum(bucket.max_rate for bucket in thewatcher.archive_rate_limiters.values()) == thewatcher.TOTAL_RATE
+
+
+def test_acquire_holds_calls_to_the_rate():
+    bucket = thewatcher.TokenBucket('test', 20)
+    start = time.monotonic()
+    # A burst of a second's worth goes straight through, the rest at 20 a second
+    for _ in range(30):
+        bucket.acquire()
+    assert 0.4 < time.monotonic() - start < 1.5
+
+
+def test_halves_once_per_bad_patch():
+    bucket = thewatcher.TokenBucket('test', 16, min_rate=1, increase=1)
+    bucket.acquire()
+    bucket.backoff()
+    assert bucket.rate == 8
+    # Another failure from a call sent before that backoff doesn't count again
+    bucket.backoff()
+    assert bucket.rate == 8
+    # One sent after it does
+    time.sleep(0.01)
+    bucket.acquire()
+    bucket.backoff()
+    assert bucket.rate == 4
+
+
+def test_failures_of_calls_in_flight_together_count_once():
+    bucket = thewatcher.TokenBucket('test', 16)
+    barrier = threading.Barrier(4)
+
+    def call():
+        bucket.acquire()
+        barrier.wait()
+        bucket.backoff()
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bucket.rate == 8
+
+
+def test_recovers_additively_up_to_max_and_floors_at_min():
+    bucket = thewatcher.TokenBucket('test', 4, min_rate=1, increase=0.5)
+    for _ in range(5):
+        time.sleep(0.01)
+        bucket.acquire()
+        bucket.backoff()
+    assert bucket.rate == 1
+    bucket.success()
+    bucket.success()
+    assert bucket.rate == 2
+    for _ in range(10):
+        bucket.success()
+    assert bucket.rate == 4
+
+
+def test_only_archive_stages_back_off():
+    bucket = thewatcher.archive_rate_limiters['upload']
+    rate = bucket.rate
+    # Validation is local, a failure there says nothing about the archive
+    thewatcher.back_off_archive_calls('validate')
+    assert bucket.rate == rate
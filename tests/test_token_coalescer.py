@@ -0,0 +1,75 @@
+import json
+import os
+import time
+
+import pytest
+
+import thewatcher
+
+
+def write_token(directory, name, files, mtime):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        json.dump(files, f)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_parse_token_filename():
+    assert thewatcher.parse_token_filename('/x/eco1-sq003ms_001-20250101-0001-EX00.fits') == ('eco1', 'sq003ms', '20250101')
+    assert thewatcher.parse_token_filename('eco1-sq003ms') == ('eco1', 'sq003ms', None)
+    with pytest.raises(ValueError):
+        thewatcher.parse_token_filename('nothing.fits')
+
+
+def test_groups_by_telescope_camera_and_night(tmp_path):
+    coalescer = thewatcher.TokenCoalescer(thewatcher.TokenIndex(str(tmp_path)), max_files=5, max_delay=3600)
+    coalescer.add('t1', ['eco1-sq003ms_001-20250101-0001-EX00.fits', 'eco1-sq003ms_001-20250101-0002-EX00.fits'])
+    coalescer.add('t2', ['eco1-sq003ms_001-20250101-0003-EX00.fits'])
+    coalescer.add('t3', ['eco1-sq003ms_001-20250102-0001-EX00.fits'])
+    coalescer.add('t4', ['eco1-sq005mm_001-20250101-0001-EX00.fits'])
+    assert coalescer.pop_ready(5) == []
+    # Filling a group sends it straight away
+    coalescer.add('t5', ['eco1-sq003ms_001-20250101-0004-EX00.fits', 'eco1-sq003ms_001-20250101-0005-EX00.fits'])
+    runs = coalescer.pop_ready(5)
+    assert [tokens for tokens, files in runs] == [['t1', 't2', 't5']]
+    assert len(runs[0][1]) == 5
+    # The rest go when they have waited max_delay
+    coalescer.max_delay = 0
+    assert sorted(tokens for tokens, files in coalescer.pop_ready(5)) == [['t3'], ['t4']]
+
+
+def test_big_and_odd_tokens_run_alone(tmp_path):
+    coalescer = thewatcher.TokenCoalescer(thewatcher.TokenIndex(str(tmp_path)), max_files=2, max_delay=3600)
+    coalescer.add('big', [f"eco1-sq003ms_001-20250101-{i:04d}-EX00.fits" for i in range(3)])
+    coalescer.add('odd', ['something.fits'])
+    assert [tokens for tokens, files in coalescer.pop_ready(5)] == [['big'], ['odd']]
+
+
+def test_runs_tokens_alone_after_a_failed_merge(tmp_path):
+    now = time.time()
+    files = ['eco1-sq003ms_001-20250101-0001-EX00.fits']
+    paths = [write_token(tmp_path, f"t{i}", files, now - 10 + i) for i in range(3)]
+    index = thewatcher.TokenIndex(str(tmp_path))
+    index.reconcile()
+    coalescer = thewatcher.TokenCoalescer(index, max_files=200, max_delay=0)
+    for name, path in index.pop_ready(3):
+        coalescer.add(path, files)
+    runs = coalescer.pop_ready(3)
+    assert [len(tokens) for tokens, contents in runs] == [3]
+
+    coalescer.finished({'original_token_files': runs[0][0], 'exit_code': 1})
+    index.wait(0)
+    for name, path in index.pop_ready(3):
+        coalescer.add(path, files)
+    assert sorted(tokens for tokens, contents in coalescer.pop_ready(3)) == [[path] for path in paths]
+
+
+def test_removes_merged_tokens_after_a_good_run(tmp_path):
+    files = ['eco1-sq003ms_001-20250101-0001-EX00.fits']
+    paths = [write_token(tmp_path, f"t{i}", files, time.time()) for i in range(3)]
+    coalescer = thewatcher.TokenCoalescer(thewatcher.TokenIndex(str(tmp_path)))
+    # EVA removes the token it was launched with
+    os.remove(paths[0])
+    coalescer.finished({'original_token_files': paths, 'exit_code': 0})
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,65 @@
+import json
+import os
+import time
+
+import thewatcher
+
+
+def write_token(directory, name, mtime):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        json.dump(['eco1-sq003ms_001-20250101-0001-EX00.fits'], f)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_hands_out_oldest_first(tmp_path):
+    now = time.time()
+    write_token(tmp_path, 'b', now - 10)
+    write_token(tmp_path, 'a', now - 20)
+    write_token(tmp_path, 'c', now - 5)
+    index = thewatcher.TokenIndex(str(tmp_path))
+    index.reconcile()
+    assert len(index) == 3
+    assert [name for name, path in index.pop_ready(2)] == ['a', 'b']
+    assert len(index) == 1
+
+
+def test_taken_tokens_stay_taken_until_their_file_goes(tmp_path):
+    now = time.time()
+    write_token(tmp_path, 'a', now - 20)
+    write_token(tmp_path, 'b', now - 10)
+    index = thewatcher.TokenIndex(str(tmp_path))
+    index.reconcile()
+    assert [name for name, path in index.pop_ready(1)] == ['a']
+    index.reconcile()
+    assert [name for name, path in index.pop_ready(5)] == ['b']
+    os.remove(tmp_path / 'a')
+    index.reconcile()
+    # Only what is on disk is remembered
+    assert index.taken == {'b'}
+
+
+def test_released_tokens_come_round_again(tmp_path):
+    write_token(tmp_path, 'a', time.time())
+    index = thewatcher.TokenIndex(str(tmp_path))
+    index.reconcile()
+    index.pop_ready(1)
+    index.release('a')
+    index.wait(0)
+    assert [name for name, path in index.pop_ready(1)] == ['a']
+
+
+def test_inotify_picks_up_new_tokens(tmp_path):
+    index = thewatcher.TokenIndex(str(tmp_path)).start()
+    if index.inotify is None:
+        return  # scanning instead, covered by reconcile above
+    write_token(tmp_path, 'a', time.time())
+    deadline = time.time() + 5
+    while not len(index) and time.time() < deadline:
+        index.wait(0.2)
+    assert [name for name, path in index.pop_ready(1)] == ['a']
+    os.remove(tmp_path / 'a')
+    index.wait(0.5)
+    assert index.taken == set()
+    index.inotify.close()
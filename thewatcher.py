@@ -29,6 +29,10 @@ import time
 import traceback
 import datetime
 import shutil
+import gzip
+import bz2
+import bisect
+import http.server
 import subprocess
 import psutil
 import os
@@ -38,433 +42,3568 @@ env=load_dotenv(".env")
 import resource
 from json.decoder import JSONDecodeError
 import requests
+import requests.adapters
 from ocs_ingester.ingester import  validate_fits_and_create_archive_record, upload_file_to_file_store, ingest_archive_record
+from ocs_ingester.archive import ArchiveService
+from ocs_ingester.settings import settings as ingester_settings
 
 import threading
 import queue
+import concurrent.futures
+import functools
+import multiprocessing
 import errno
+import sqlite3
+import mmap
+import hashlib
+import io
+import csv
+import heapq
+import re
+import collections
+import select
+import struct
+import ctypes
+import ctypes.util
 
 # Nobody gonna be changing RAM while the computer is running, so this is global
 total_ram = psutil.virtual_memory().total
 
+# Ingestion priority. Lower classes go first. Filenames look like
+# telescope-camera_xxx-date-frame-type..., the same as launch_eva_pipeline parses.
+INGEST_FRAME_CLASSES = ('science', 'calibration', 'reduced', 'sidecar')
+# Only as a field of its own (-sek., _thumbnail.) so camera names like sea002cs don't count
+INGEST_SIDECAR_PATTERN = re.compile(r'[-_.](sek|sea|psx|thumbnail)(?=[-_.]|$)', re.IGNORECASE)
+INGEST_CALIBRATION_PATTERN = re.compile(r'(bias|dark|flat|-(BI|DK|FL|SF)\d\d)', re.IGNORECASE)
+INGEST_REDUCED_PATTERN = re.compile(r'(-EX1\d|-EX2\d|reduced|smstack|stacked)', re.IGNORECASE)
+# Frames younger than this count as realtime and jump the backlog of their class
+INGEST_REALTIME_WINDOW = 3600
+
+def ingest_frame_class(name):
+    if INGEST_SIDECAR_PATTERN.search(name):
+        return 'sidecar'
+    if INGEST_CALIBRATION_PATTERN.search(name):
+        return 'calibration'
+    if INGEST_REDUCED_PATTERN.search(name):
+        return 'reduced'
+    return 'science'
+
+def parse_token_filename(name):
+    """
+    (telescope, camera, run date) from a frame filename, which look like
+    telescope-camera_xxx-date-frame-type... The run date is None if the name
+    stops after the camera. Raises ValueError for anything else.
+    """
+    parts = os.path.basename(name).split('-')
+    if len(parts) < 2:
+        raise ValueError("Not a telescope-camera filename: " + str(name))
+    return parts[0], parts[1].split('_')[0], parts[2] if len(parts) > 2 else None
+
+def ingest_stream(path):
+    """
+    (telescope, camera) from the filename, the unit we share ingestion out fairly between.
+    """
+    try:
+        return parse_token_filename(path)[:2]
+    except ValueError:
+        return ('unknown', 'unknown')
+
+def ingest_priority(path, mtime, size=0, now=None):
+    """
+    Sort key for an ingester file: realtime frames of every class before any
+    backlog, then by frame class, then oldest first, then smallest first.
+    """
+    if now is None:
+        now = time.time()
+    tier = INGEST_FRAME_CLASSES.index(ingest_frame_class(os.path.basename(path)))
+    if now - mtime > INGEST_REALTIME_WINDOW:
+        tier += len(INGEST_FRAME_CLASSES)
+    return (tier, mtime, size)
+
+
+class IngestionPriorityQueue:
+    """
+    Drop-in for the queue.Queue the ingester used to use. Items come out in
+    ingest_priority order, but each telescope/camera stream gets its own heap
+    and streams with equally urgent work take turns, so a big calibration or
+    reprocessing backlog from one camera can't starve everyone else.
+    """
+
+    def __init__(self):
+        self.streams = {}                       # stream -> heap of (priority, sequence, item)
+        self.rotation = collections.deque()     # streams with work, in round-robin order
+        self.sequence = 0
+        self.count = 0
+        self.unfinished = 0
+        self.sentinels = 0
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.all_done = threading.Condition(self.mutex)
+
+    def _priority(self, item):
+        file = item[0]
+        try:
+            mtime = os.stat(file).st_mtime
+        except OSError:
+            mtime = time.time()
+        try:
+            size = os.stat(file[:-5]).st_size
+        except OSError:
+            size = 0
+        return ingest_priority(file, mtime, size)
+
+    def put(self, item, block=True, timeout=None, priority=None):
+        """
+        Callers that have just scanned the directory pass the ingest_priority
+        they worked out, to save stat()ing the files again.
+        """
+        if priority is None and item is not None:
+            priority = self._priority(item)
+        with self.mutex:
+            self.unfinished += 1
+            if item is None:
+                # Graceful exit signal, goes before anything else
+                self.sentinels += 1
+            else:
+                stream = ingest_stream(item[0])
+                if stream not in self.streams:
+                    self.streams[stream] = []
+                    self.rotation.append(stream)
+                self.sequence += 1
+                heapq.heappush(self.streams[stream], (priority, self.sequence, item))
+                self.count += 1
+            self.not_empty.notify()
+
+    put_nowait = put
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self.count and not self.sentinels:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self.count and not self.sentinels:
+                    self.not_empty.wait()
+            else:
+                endtime = time.monotonic() + timeout
+                while not self.count and not self.sentinels:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+
+            if self.sentinels:
+                self.sentinels -= 1
+                return None
+
+            # The most urgent tier waiting anywhere, then the first stream in
+            # the rotation that has work in that tier takes its turn
+            best_tier = min(self.streams[stream][0][0][0] for stream in self.rotation)
+            for stream in self.rotation:
+                if self.streams[stream][0][0][0] == best_tier:
+                    break
+            priority, sequence, item = heapq.heappop(self.streams[stream])
+            self.rotation.remove(stream)
+            if self.streams[stream]:
+                self.rotation.append(stream)
+            else:
+                del self.streams[stream]
+            self.count -= 1
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        with self.all_done:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.unfinished = 0
+                self.all_done.notify_all()
+
+    def join(self):
+        with self.all_done:
+            while self.unfinished:
+                self.all_done.wait()
+
+    def qsize(self):
+        with self.mutex:
+            return self.count
+
+    def empty(self):
+        return self.qsize() == 0
+
 # Create a thread-safe queue
-ingester_queue = queue.Queue()
+ingester_queue = IngestionPriorityQueue()
 maximum_parallel_ingestions= 16
 
-# Need to randomly space out parallel ingestions via random delays
-# target total rate (requests per second across all threads)
-TOTAL_RATE = 16.0  
-# so per‐thread rate is:
-RATE_PER_THREAD = TOTAL_RATE / 16.0  # → 1 req/s
+# Target total rate (requests per second across all threads) of archive
+# calls. The rate limiters below share it out between the classes of call.
+TOTAL_RATE = 16.0  
+
+
+
+class Metric:
+    """
+    Base for the metrics below. Values are kept per set of label values, and
+    each update is one lock and a dict lookup, so instrumenting the ingest
+    workers costs next to nothing next to an archive call.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        if not self.labelnames and self.kind != 'histogram':
+            # Show up as 0 rather than not at all before anything happens
+            self.values[()] = 0
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def total(self):
+        """
+        Sum over every set of label values.
+        """
+        with self.lock:
+            return sum(self.values.values())
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append('%s%s %s' % (self.name, self._labels(key), repr(float(value))))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Set directly, or give it a function and it is read when scraped.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts (last one is +Inf), then sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return HistogramTimer(self, labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('%s_bucket%s %d' % (self.name, self._labels(key, [('le', le)]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, self._labels(key), repr(counts[-1])))
+            lines.append('%s_count%s %d' % (self.name, self._labels(key), cumulative))
+        return lines
+
+
+class HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/health':
+            status = health_monitor.check()
+            body = json.dumps(status, indent=2).encode()
+            self.send_response(200 if status['healthy'] else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every 15 seconds would drown out everything else in watcher.log
+        pass
+
+
+def start_metrics_server(address='127.0.0.1', port=9108):
+    """
+    Serve the metrics in Prometheus text format on http://address:port/metrics.
+    """
+    server = http.server.ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics_server').start()
+    print(f"Serving metrics on http://{address}:{port}/metrics")
+    return server
+
+metrics_registry = []
+
+ingest_queue_depth = Gauge('ptr_ingest_queue_depth', 'Items waiting in the ingester queue.',
+                           function=lambda: ingester_queue.qsize())
+ingest_in_flight = Gauge('ptr_ingest_in_flight', 'Ingest stages running right now.', ['stage'])
+ingest_stage_seconds = Histogram('ptr_ingest_stage_seconds', 'Time taken by each ingest stage, including rate limiting.', ['stage', 'outcome'])
+ingest_uploaded_bytes = Counter('ptr_ingest_uploaded_bytes_total', 'Bytes uploaded to the file store.')
+ingest_files = Counter('ptr_ingest_files_total', 'Files that made it into the archive.')
+ingest_errors = Counter('ptr_ingest_errors_total', 'Failed ingest stages by error class.', ['stage', 'error'])
+ingest_retries = Counter('ptr_ingest_retries_total', 'Files scheduled for another ingestion attempt.')
+ingest_given_up = Counter('ptr_ingest_given_up_total', 'Files moved to the fails directory.')
+tokens_pending = Gauge('ptr_tokens_pending', 'Tokens waiting to be run.')
+eva_runs_running = Gauge('ptr_eva_runs_running', 'EVA runs going right now.',
+                         function=lambda: len(eva_registry.running()))
+eva_runs = Counter('ptr_eva_runs_total', 'Finished EVA runs by outcome.', ['outcome'])
+eva_run_seconds = Histogram('ptr_eva_run_seconds', 'Wall time of finished EVA runs.', ['camera'],
+                            buckets=(30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400))
+eva_run_peak_rss_bytes = Histogram('ptr_eva_run_peak_rss_bytes', 'Peak memory of finished EVA runs.', ['camera'],
+                                   buckets=tuple(2**30 * gb for gb in (0.5, 1, 2, 4, 8, 16, 32, 64)))
+pipe_queue_buffered = Gauge('ptr_pipe_queue_buffered', 'PIPE queue work leased and waiting to run.')
+pipe_queue_leases = Counter('ptr_pipe_queue_leases_total', 'PIPE queue leases by outcome.', ['outcome'])
+scheduled_task_seconds = Histogram('ptr_scheduled_task_seconds', 'Time taken by each run of a scheduled task.', ['task', 'outcome'])
+scheduled_task_overruns = Counter('ptr_scheduled_task_overruns_total', 'Scheduled task runs that went past their timeout.', ['task'])
+main_loop_seconds = Histogram('ptr_main_loop_seconds', 'Time for one pass of the main loop.')
+
+def ingest_error_class(error_text):
+    """
+    Short label for an ingest error, the same split handle_ingest_job_error makes.
+    """
+    for needle, label in (('Version with this md5 already exists', 'duplicate'),
+                          ('502 Server Error', 'http_502'),
+                          ('500 Server Error', 'http_500'),
+                          ('400 Client Error', 'http_400'),
+                          ('Max retries exceeded', 'connection'),
+                          ('BrokenProcessPool', 'process_died')):
+        if needle in error_text:
+            return label
+    return 'other'
+
+def observe_eva_run(record):
+    """
+    EVA registry listener.
+    """
+    eva_runs.inc(outcome='ok' if record['exit_code'] == 0 else 'failed')
+    eva_run_seconds.observe(record['wall_time'], camera=record['camera'])
+    if record['peak_rss']:
+        eva_run_peak_rss_bytes.observe(record['peak_rss'], camera=record['camera'])
+
+
+HEARTBEAT = "thewatcher.hbeat"
+
+# The interpreter EVA runs under, which isn't necessarily the one running the watcher
+EVA_PYTHON = '/usr/bin/python3'
+
+def touch_heartbeat():
+    # create or update the timestamp
+    with open(HEARTBEAT, "a"):
+        os.utime(HEARTBEAT, None)
+    
+    with open("watcher.log", "a") as f:
+        f.write(f"[{datetime.datetime.now():%Y-%m-%d %H:%M:%S}] loop complete\n")
+
+class HealthMonitor:
+    """
+    Liveness of each part of the watcher, checked from its own thread.
+
+    Subsystems call beat() whenever they make progress. One that hasn't
+    beaten for stall_after seconds is stalled, unless its idle() says it
+    has nothing to do. Every interval seconds the monitor writes the status
+    of everything to status_file, and only if nothing is stalled touches
+    the heartbeat and watcher.log that monitor.sh watches. A slow cull or
+    a long EVA launch therefore no longer gets the whole watcher restarted,
+    but a thread that has genuinely stopped still does.
+
+    main() starts it before anything else, in the 'starting' state, so a
+    slow start up (token scan, journal replay, calibration walk) keeps the
+    heartbeat going. Start up itself is watched as the 'startup' subsystem
+    until started() is called.
+    """
+
+    def __init__(self, status_file='thewatcher.status.json', interval=10):
+        self.status_file = status_file
+        self.interval = interval
+        self.subsystems = {}  # name -> (stall_after, idle)
+        self.beats = {}       # name -> time.monotonic() of the last beat
+        self.status = {}
+        self.state = 'starting'
+
+    def register(self, name, stall_after, idle=None):
+        self.subsystems[name] = (stall_after, idle)
+        self.beats.setdefault(name, time.monotonic())
+
+    def beat(self, name):
+        self.beats[name] = time.monotonic()
+
+    def started(self):
+        self.state = 'running'
+        self.subsystems.pop('startup', None)
+
+    def check(self):
+        now = time.monotonic()
+        healthy = True
+        subsystems = {}
+        for name, (stall_after, idle) in list(self.subsystems.items()):
+            is_idle = False
+            if idle is not None:
+                try:
+                    is_idle = bool(idle())
+                except Exception:
+                    pass
+            if is_idle:
+                # Nothing to do counts as alive, and the clock starts again when work turns up
+                self.beats[name] = now
+            age = now - self.beats.get(name, now)
+            stalled = age > stall_after
+            healthy = healthy and not stalled
+            subsystems[name] = {
+                'seconds_since_beat': round(age, 1),
+                'stall_after': stall_after,
+                'idle': is_idle,
+                'stalled': stalled,
+            }
+        self.status = {
+            'healthy': healthy,
+            'state': self.state,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'pid': os.getpid(),
+            'subsystems': subsystems,
+        }
+        return self.status
+
+    def _run(self):
+        while True:
+            try:
+                status = self.check()
+                with open(self.status_file + '.tmp', 'w') as f:
+                    json.dump(status, f, indent=2)
+                os.replace(self.status_file + '.tmp', self.status_file)
+                if status['healthy']:
+                    touch_heartbeat()
+                else:
+                    stalled = [name for name, s in status['subsystems'].items() if s['stalled']]
+                    print("Stalled: " + ', '.join(stalled) + " " + str(datetime.datetime.now()))
+            except:
+                print(traceback.format_exc())
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name='health_monitor').start()
+        return self
+
+health_monitor = HealthMonitor()
+
+class PeriodicTaskScheduler:
+    """
+    Runs the main loop's housekeeping (disk checks, dated folders, the
+    ingester directory scan) on their own cadences, each run in a thread of
+    its own, so the main loop only has to look after tokens and a slow
+    duty never holds up the others.
+
+    A task runs every period seconds, or at the times its next_run(now)
+    returns for things like the day rollover. A run that is still going
+    when the task next falls due is left to finish rather than started
+    twice. One that goes past its timeout is reported, and shows up as
+    stalled in the health monitor for as long as it carries on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.changed = threading.Event()
+
+    def add(self, name, function, period=None, next_run=None, timeout=None, run_at_start=True):
+        task = {
+            'name': name,
+            'function': function,
+            'period': period,
+            'next_run': next_run,
+            'timeout': timeout or (2 * period if period else 600),
+            'due': 0,
+            'running_since': None,
+            'overrun': False,
+        }
+        task['due'] = time.time() if run_at_start else self._next_due(task, time.time())
+        with self.lock:
+            self.tasks[name] = task
+        health_monitor.register('task:' + name, task['timeout'], idle=lambda: task['running_since'] is None)
+        self.changed.set()
+        return self
+
+    def _next_due(self, task, started):
+        if task['next_run'] is not None:
+            return task['next_run'](datetime.datetime.fromtimestamp(started)).timestamp()
+        return started + task['period']
+
+    def _execute(self, task):
+        started = time.time()
+        outcome = 'ok'
+        try:
+            task['function']()
+        except:
+            outcome = 'error'
+            print("Scheduled task " + task['name'] + " failed")
+            print(traceback.format_exc())
+        finally:
+            scheduled_task_seconds.observe(time.time() - started, task=task['name'], outcome=outcome)
+            with self.lock:
+                task['running_since'] = None
+                task['overrun'] = False
+                task['due'] = max(self._next_due(task, started), time.time())
+            health_monitor.beat('task:' + task['name'])
+            self.changed.set()
+
+    def _run(self):
+        while True:
+            now = time.time()
+            next_due = now + 60
+            with self.lock:
+                for task in self.tasks.values():
+                    if task['running_since'] is not None:
+                        if not task['overrun'] and now - task['running_since'] > task['timeout']:
+                            task['overrun'] = True
+                            scheduled_task_overruns.inc(task=task['name'])
+                            print(f"Scheduled task {task['name']} has been running for over {task['timeout']}s")
+                        continue
+                    if now >= task['due']:
+                        task['running_since'] = now
+                        health_monitor.beat('task:' + task['name'])
+                        threading.Thread(target=self._execute, args=(task,), daemon=True,
+                                         name='task_' + task['name']).start()
+                    else:
+                        next_due = min(next_due, task['due'])
+            self.changed.wait(timeout=max(0.05, min(next_due - time.time(), 1)))
+            self.changed.clear()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name='task_scheduler').start()
+        return self
+
+def next_day_rollover(now):
+    """
+    A few seconds past the coming local midnight.
+    """
+    return datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(0, 0, 5))
+
+def provision_dated_folders(archive_base_directory, cameras, days_ahead=0):
+    """
+    Make localptrarchive/<camera>/<YYYYMMDD> for today and the next
+    days_ahead days, for the cameras that write into them.
+    """
+    today = datetime.datetime.now()
+    os.umask(0)
+    for camera in cameras:
+        for days in range(days_ahead + 1):
+            folder_date = (today + datetime.timedelta(days=days)).strftime('%Y%m%d')
+            os.makedirs(archive_base_directory + '/localptrarchive/' + camera + '/' + folder_date, mode=0o777, exist_ok=True)
+
+def processing_disk_has_room(processing_temp_directory, used_fraction=0.8):
+    """
+    Whether there's room on the processing disk for more EVA runs.
+    """
+    total, used, free = shutil.disk_usage(processing_temp_directory)
+    if (used / total) < used_fraction:
+        return True
+    print("Waiting for diskspace to clear.")
+    print("Total: %d GiB" % (total // (2 ** 30)))
+    print("Used: %d GiB" % (used // (2 ** 30)))
+    print("Free: %d GiB" % (free // (2 ** 30)))
+    return False
+
+
+# Start worker threads
+# Function to execute ingester items
+def ingester_worker():
+    while True:
+        ingester_item = ingester_queue.get()  # Blocks if queue is empty
+        if ingester_item is None:
+            break  # Graceful exit signal
+        try:
+            ingest_item(ingester_item)
+        except Exception as e:
+            print(f"Ingesting item raised an exception: {e}")
+        finally:
+            ingester_queue.task_done()
+def start_ptringester_worker_threads(engine='staged'):
+    """
+    "staged" runs the StagedIngestionPipeline, "threads" the original pool
+    of ingester_worker threads that each take a file start to finish.
+    """
+    if engine == 'staged':
+        StagedIngestionPipeline().start()
+    elif engine == 'threads':
+        for _ in range(maximum_parallel_ingestions):
+            threading.Thread(target=ingester_worker, daemon=True).start()
+    else:
+        raise ValueError(f"Unknown ingestion_engine {engine!r}, expected 'staged' or 'threads'")
+
+
+
+class IngestionJournal:
+    """
+    Crash-safe record of where each ingester file has got to, kept in a local
+    SQLite database in WAL mode so it survives monitor.sh restarting us.
+
+    States go discovered -> validated -> uploaded -> recorded, or failed.
+    The archive record and the S3 version are stored alongside, so a restarted
+    watcher can pick a file up after the last step that finished rather than
+    validating and uploading it all over again.
+    """
+
+    STATES = ('discovered', 'validated', 'uploaded', 'recorded', 'failed')
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ingestion ('
+                ' path TEXT PRIMARY KEY,'
+                ' state TEXT NOT NULL,'
+                ' size INTEGER,'
+                ' mtime REAL,'
+                ' record TEXT,'
+                ' s3_version TEXT,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' error TEXT,'
+                ' updated REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ingestion_state ON ingestion (state, updated)')
+            # Content index of everything the archive is known to have, so
+            # duplicates can be retired before any network calls
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ingested ('
+                ' md5 TEXT PRIMARY KEY,'
+                ' basename TEXT,'
+                ' ingested REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ingested_basename ON ingested (basename)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get(self, path):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT * FROM ingestion WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['record'] = json.loads(entry['record']) if entry['record'] else None
+        entry['s3_version'] = json.loads(entry['s3_version']) if entry['s3_version'] else None
+        return entry
+
+    def discovered(self, path, size, mtime):
+        """
+        Called when we pick a file up. Returns its journal entry. Anything
+        already journalled for a different file of the same name, or for an
+        earlier failed attempt, is thrown away and we start afresh.
+        """
+        entry = self.get(path)
+        if entry is not None and entry['size'] == size and entry['mtime'] == mtime and entry['state'] != 'failed':
+            return entry
+        attempts = entry['attempts'] if entry is not None and entry['size'] == size and entry['mtime'] == mtime else 0
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO ingestion (path, state, size, mtime, attempts, updated)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (path, 'discovered', size, mtime, attempts, time.time()))
+        return self.get(path)
+
+    def advance(self, path, state, record=None, s3_version=None, error=None):
+        """
+        Move a file on to the given state, storing whatever was produced by the step.
+        """
+        if state not in self.STATES:
+            raise ValueError("Unknown ingestion state: " + str(state))
+        assignments = ['state = ?', 'updated = ?']
+        values = [state, time.time()]
+        if record is not None:
+            assignments.append('record = ?')
+            values.append(json.dumps(record, default=str))
+        if s3_version is not None:
+            assignments.append('s3_version = ?')
+            values.append(json.dumps(s3_version, default=str))
+        if error is not None:
+            assignments.append('error = ?')
+            values.append(str(error)[-2000:])
+        values.append(path)
+        with self.lock:
+            self.connection.execute(
+                'UPDATE ingestion SET ' + ', '.join(assignments) + ' WHERE path = ?', values)
+
+    def count_attempt(self, path):
+        """
+        Bump and return the number of attempts made at this file.
+        """
+        with self.lock:
+            self.connection.execute(
+                'UPDATE ingestion SET attempts = attempts + 1, updated = ? WHERE path = ?',
+                (time.time(), path))
+            row = self.connection.execute(
+                'SELECT attempts FROM ingestion WHERE path = ?', (path,)).fetchone()
+        return row['attempts'] if row is not None else 0
+
+    def prune(self, max_age_days=14, content_max_age_days=180):
+        """
+        Forget finished entries older than max_age_days, and content index
+        entries older than content_max_age_days, so the journal doesn't grow forever.
+        """
+        cutoff = time.time() - max_age_days * 86400
+        content_cutoff = time.time() - content_max_age_days * 86400
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM ingestion WHERE state IN ('recorded', 'failed') AND updated < ?", (cutoff,))
+            self.connection.execute(
+                'DELETE FROM ingested WHERE ingested < ?', (content_cutoff,))
+
+    def already_ingested(self, md5):
+        """
+        The basename the archive already has this md5 under, or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT basename FROM ingested WHERE md5 = ?', (md5,)).fetchone()
+        if row is None:
+            return None
+        return row['basename'] or ''
+
+    def remember_ingested(self, md5, basename):
+        if not md5:
+            return
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO ingested (md5, basename, ingested) VALUES (?, ?, ?)',
+                (md5, basename, time.time()))
+
+    def seed_ingested(self, export_path):
+        """
+        Bulk load the content index from an archive export. Takes a CSV with
+        md5 and basename columns, or JSON lines of either {"md5", "basename"}
+        or archive frames with a version_set. Only reloaded when the export changes.
+        """
+        signature = f"{os.path.abspath(export_path)}:{os.path.getmtime(export_path)}:{os.path.getsize(export_path)}"
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'content_index_seed'").fetchone()
+        if row is not None and row['value'] == signature:
+            return 0
+
+        def rows():
+            with open(export_path, 'r', newline='') as f:
+                if export_path.endswith('.csv'):
+                    for line in csv.DictReader(f):
+                        yield line.get('md5'), line.get('basename')
+                else:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line)
+                        if 'version_set' in entry:
+                            for version in entry['version_set']:
+                                yield version.get('md5'), entry.get('basename')
+                        else:
+                            yield entry.get('md5'), entry.get('basename')
+
+        now = time.time()
+        loaded = 0
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for md5, basename in rows():
+                    if md5:
+                        self.connection.execute(
+                            'INSERT OR IGNORE INTO ingested (md5, basename, ingested) VALUES (?, ?, ?)',
+                            (md5, basename, now))
+                        loaded += 1
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('content_index_seed', ?)", (signature,))
+                self.connection.execute('COMMIT')
+            except:
+                self.connection.execute('ROLLBACK')
+                raise
+        return loaded
+
+# Replaced in main() with the on-disk journal. Until then (or when ingest_item
+# is driven from somewhere else) an in-memory one keeps everything working.
+ingestion_journal = IngestionJournal(':memory:')
+
+# Sidecars already handed to the ingester_queue by process_ingester_directory
+known_ingester_jsons=set()
+
+# When running in inotify mode this holds the IngesterDirectoryWatcher thread
+# that owns the ingester directory. None means we fall back to scanning.
+ingester_directory_watcher = None
+
+def preexec_limit():
+    # # We need to detach and limit each pipeline call.
+    limit = int(total_ram * 0.8)
+
+    # apply as the address-space limit
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def process_ingester_directory(
+    ingester_directory: str,
+    failed_ingestion_directory: str) :
+    """
+    Scan ingester_directory for new .json files, remove any 'variance_' files,
+    and schedule ingestion for the rest.
+
+    Parameters
+    ----------
+    ingester_directory : str
+        Path to the directory containing ingester JSON files (should end with a slash).
+    
+    failed_ingestion_directory : str
+        Path to the directory where failed ingestions should be moved/logged.
+
+    Only the 500 most urgent sidecars (by ingest_priority, worked out from
+    the scandir entry's mtime) go on the ingester_queue each pass, and their
+    priorities go with them so the queue doesn't stat them again.
+    """
+    if ingester_directory_watcher is not None:
+        # The watcher thread is already keeping the queue fed from inotify
+        # events, so there is nothing to scan here.
+        return
+
+    print("reading ingester directory")
+
+    # 1) scan for JSONs and get their mtime efficiently
+    entries = [
+        entry
+        for entry in os.scandir(ingester_directory)
+        if entry.name.endswith('.json')
+    ]
+    
+    # 2) & 3) only look at the 500 most urgent, realtime first then oldest
+    now = time.time()
+    priorities = {}
+    for entry in entries:
+        try:
+            priorities[entry.path] = ingest_priority(entry.path, entry.stat().st_mtime, now=now)
+        except FileNotFoundError:
+            continue
+    for item in heapq.nsmallest(500, priorities, key=priorities.get):
+        entry_name = os.path.basename(item)
+    
+        if item in known_ingester_jsons:
+            continue
+    
+        if 'variance_' in entry_name:
+            remove_variance_item(item)
+    
+        else:
+            # schedule this new item for ingestion
+            add_ingester_item([item, ingester_directory, failed_ingestion_directory], priorities[item])
+            known_ingester_jsons.add(item)
+
+def remove_variance_item(item):
+    """
+    We don't ingest variance frames. Remove the json and the unpacked file.
+    """
+    print(f"removing variance item: {item}")
+    try:
+        os.remove(item)
+    except OSError:
+        pass
+
+    # also remove the unpacked version if it exists
+    unpacked = item[:-5]  # strip “.json”
+    try:
+        os.remove(unpacked)
+    except OSError:
+        pass
+
+# Function to add ingester items to the queue. Items are
+# [json file, ingester_directory, failed_ingestion_directory]
+def add_ingester_item(item, priority=None):
+    ingester_queue.put(item, priority=priority)
+
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = os.O_CLOEXEC
+
+class Inotify:
+    """
+    Minimal ctypes wrapper around the linux inotify calls, so the pipes don't
+    need another package installed just to watch a couple of directories.
+    Raises OSError if inotify isn't available.
+    """
+    _event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found, no inotify")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not supported on this platform")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1 failed: " + os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch failed on " + str(path) + ": " + os.strerror(err))
+        return wd
+
+    def read(self, timeout=1.0, wake=()):
+        """
+        Wait up to timeout seconds for events, or for any of wake to become
+        readable. Returns a list of (wd, mask, name).
+        """
+        ready, _, _ = select.select([self.fd, *wake], [], [], timeout)
+        if self.fd not in ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._event_header.unpack_from(data, offset)
+            offset += self._event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class IngesterDirectoryWatcher:
+    """
+    Keeps an in-memory index of the JSON sidecars waiting in the ingester
+    directory, ordered by ingest_priority (so oldest first within each class),
+    and feeds them into the ingester_queue as they arrive.
+
+    inotify tells us when sidecars turn up or go away, so the directory only
+    gets a full scandir at startup, after an inotify queue overflow and every
+    reconcile_period seconds as a fallback. If inotify isn't available at all
+    we just reconcile every 30 seconds, much like the old scanning loop.
+    """
+
+    def __init__(self, ingester_directory, failed_ingestion_directory,
+                 reconcile_period=600, max_queued=500, settle_time=60):
+        self.ingester_directory = ingester_directory
+        self.failed_ingestion_directory = failed_ingestion_directory
+        self.reconcile_period = reconcile_period
+        # Don't let the ingester_queue grow past this, the rest waits in the index
+        self.max_queued = max_queued
+        # How long to wait for the data file to show up after its json
+        self.settle_time = settle_time
+
+        self.lock = threading.Lock()
+        self.pending = {}      # path -> ingest_priority, waiting to go into the queue
+        self.pending_heap = [] # (priority, path), entries not in pending are stale
+        self.queued = set()    # handed to the queue, forgotten when the json goes
+        self.deferred = {}     # path -> when we first found it without a data file
+        self.reconcile_requested = True
+        self.inotify = None
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(self.ingester_directory,
+                                   IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+            print("Watching ingester directory with inotify: " + str(self.ingester_directory))
+        except OSError as e:
+            print(f"inotify unavailable ({e}), falling back to periodic scans of the ingester directory")
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+            self.reconcile_period = min(self.reconcile_period, 30)
+        threading.Thread(target=self._run, daemon=True, name='ingester_directory_watcher').start()
+
+    def _run(self):
+        last_reconcile = 0
+        while True:
+            try:
+                if self.inotify is not None:
+                    events = self.inotify.read(timeout=1.0)
+                else:
+                    time.sleep(1)
+                    events = []
+
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW:
+                        # Kernel dropped events, we can't trust the index anymore
+                        self.reconcile_requested = True
+                        continue
+                    if not name.endswith('.json'):
+                        continue
+                    path = os.path.join(self.ingester_directory, name)
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        try:
+                            mtime = os.stat(path).st_mtime
+                        except FileNotFoundError:
+                            continue
+                        self._add(path, mtime)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self._forget(path)
+
+                if self.reconcile_requested or time.time() - last_reconcile > self.reconcile_period:
+                    self.reconcile()
+                    last_reconcile = time.time()
+
+                self._dispatch()
+                health_monitor.beat('ingester_directory_watcher')
+            except Exception:
+                print("Ingester directory watcher hit a snag")
+                print(traceback.format_exc())
+                time.sleep(5)
+
+    def _add(self, path, mtime):
+        if 'variance_' in os.path.basename(path):
+            remove_variance_item(path)
+            return
+        with self.lock:
+            if path in self.pending or path in self.queued:
+                return
+            priority = ingest_priority(path, mtime)
+            self.pending[path] = priority
+            heapq.heappush(self.pending_heap, (priority, path))
+
+    def _forget(self, path):
+        with self.lock:
+            self.queued.discard(path)
+            self.deferred.pop(path, None)
+            # Its heap entry goes stale and gets skipped in _dispatch
+            self.pending.pop(path, None)
+
+    def reconcile(self):
+        """
+        Full scandir of the ingester directory to catch anything inotify missed
+        and to drop anything that has gone away behind our back.
+        """
+        self.reconcile_requested = False
+        present = set()
+        new_entries = []
+        with os.scandir(self.ingester_directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                present.add(entry.path)
+                if entry.path in self.pending or entry.path in self.queued:
+                    continue
+                try:
+                    new_entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+
+        with self.lock:
+            self.queued &= present
+            for path in [p for p in self.pending if p not in present]:
+                del self.pending[path]
+            if len(self.pending_heap) > 2 * len(self.pending) + 1000:
+                self.pending_heap = [(k, p) for (k, p) in self.pending_heap if self.pending.get(p) == k]
+                heapq.heapify(self.pending_heap)
+
+        for mtime, path in new_entries:
+            self._add(path, mtime)
+
+    def _dispatch(self):
+        """
+        Move the most urgent pending sidecars into the ingester_queue.
+        """
+        not_ready = []
+        now = time.time()
+        while ingester_queue.qsize() < self.max_queued:
+            with self.lock:
+                if not self.pending_heap:
+                    break
+                priority, path = heapq.heappop(self.pending_heap)
+                if self.pending.get(path) != priority:
+                    continue  # stale heap entry
+
+            # The sidecar can land before its data file has finished arriving.
+            # Give it a little while before handing it to ingest_item, which
+            # would otherwise bin the json as having no data file.
+            if not os.path.exists(path[:-5]):
+                # mtime can be old if the copy preserved it, so time from when we first looked
+                if now - self.deferred.setdefault(path, now) < self.settle_time:
+                    not_ready.append((priority, path))
+                    continue
+
+            with self.lock:
+                self.deferred.pop(path, None)
+                if self.pending.pop(path, None) is None:
+                    continue
+                self.queued.add(path)
+            add_ingester_item([path, self.ingester_directory, self.failed_ingestion_directory], priority)
+
+        with self.lock:
+            for priority, path in not_ready:
+                if self.pending.get(path) == priority:
+                    heapq.heappush(self.pending_heap, (priority, path))
+
+
+class TokenIndex:
+    """
+    Index of the token files waiting in the tokens directory, oldest first.
+
+    inotify tells us when tokens are written or removed, so the directory
+    only gets a full scandir at startup, after an event overflow and every
+    reconcile_period seconds. Without inotify it is rescanned every
+    scan_period seconds instead. Tokens handed out by pop_ready are
+    remembered as taken until their file goes away (EVA removes it when it
+    is done), so that set stays the size of what's on disk rather than
+    growing all night.
+
+    Only used from the main loop, so no locking, except release(), which
+    other threads may call to hand a taken token back to be run again.
+    """
+
+    def __init__(self, token_directory, reconcile_period=600, scan_period=5):
+        self.token_directory = token_directory
+        self.reconcile_period = reconcile_period
+        self.scan_period = scan_period
+        self.pending = {}       # name -> mtime
+        self.pending_heap = []  # (mtime, name), entries not in pending are stale
+        self.taken = set()      # handed out, waiting for the file to go
+        self.released = collections.deque()  # taken names handed back, picked up in wait()
+        self.inotify = None
+        self.last_reconcile = 0
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(self.token_directory,
+                                   IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+            print("Watching token directory with inotify: " + str(self.token_directory))
+        except OSError as e:
+            print(f"inotify unavailable ({e}), falling back to scanning the token directory")
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+            self.reconcile_period = min(self.reconcile_period, self.scan_period)
+        self.reconcile()
+        return self
+
+    def _add(self, name, mtime):
+        if name in self.taken:
+            return
+        if self.pending.get(name) != mtime:
+            self.pending[name] = mtime
+            heapq.heappush(self.pending_heap, (mtime, name))
+
+    def _forget(self, name):
+        self.taken.discard(name)
+        # Its heap entry goes stale and gets skipped in pop_ready
+        self.pending.pop(name, None)
+
+    def reconcile(self):
+        """
+        Full scandir of the token directory, picking up anything missed and
+        dropping whatever has gone.
+        """
+        self.last_reconcile = time.time()
+        present = {}
+        with os.scandir(self.token_directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        present[entry.name] = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+        self.taken &= present.keys()
+        for name in [n for n in self.pending if n not in present]:
+            del self.pending[name]
+        for name, mtime in present.items():
+            self._add(name, mtime)
+        if len(self.pending_heap) > 2 * len(self.pending) + 1000:
+            self.pending_heap = [(m, n) for (m, n) in self.pending_heap if self.pending.get(n) == m]
+            heapq.heapify(self.pending_heap)
+
+    def wait(self, timeout=0, wake=()):
+        """
+        Take in whatever has changed, waiting up to timeout seconds for
+        something to happen, or for any of wake (things with a fileno) to
+        become readable.
+        """
+        if self.inotify is None:
+            if wake:
+                select.select(wake, [], [], timeout)
+            elif timeout:
+                time.sleep(timeout)
+        else:
+            reconcile_needed = False
+            events = self.inotify.read(timeout=timeout, wake=wake)
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    reconcile_needed = True
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    try:
+                        self._add(name, os.stat(os.path.join(self.token_directory, name)).st_mtime)
+                    except FileNotFoundError:
+                        continue
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget(name)
+            if reconcile_needed:
+                self.reconcile()
+        if time.time() - self.last_reconcile > self.reconcile_period:
+            self.reconcile()
+        while self.released:
+            name = self.released.popleft()
+            self.taken.discard(name)
+            try:
+                self._add(name, os.stat(os.path.join(self.token_directory, name)).st_mtime)
+            except FileNotFoundError:
+                pass
+
+    def release(self, name):
+        """
+        Put a taken token back in the running, if its file is still there. Thread safe.
+        """
+        self.released.append(name)
+
+    def pop_ready(self, n=1):
+        """
+        Up to n of the oldest pending tokens as (name, path), now counted as taken.
+        """
+        ready = []
+        while self.pending_heap and len(ready) < n:
+            mtime, name = heapq.heappop(self.pending_heap)
+            if self.pending.get(name) != mtime:
+                continue  # stale heap entry
+            del self.pending[name]
+            self.taken.add(name)
+            ready.append((name, os.path.join(self.token_directory, name)))
+        return ready
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def read_token_file(token_name, token_path):
+    """
+    A token's list of files, or None if the token is unusable (it gets deleted).
+    """
+    try:
+        # first, guard against an empty file
+        if os.path.getsize(token_path) == 0:
+            print(f"Empty token file {token_name}, deleting.")
+            os.remove(token_path)
+            return None
+
+        with open(token_path) as f:
+            token_contents = json.load(f)
+
+    except JSONDecodeError as e:
+        print(f"⚠️ JSONDecodeError for {token_name}: {e}. Deleting and skipping.")
+        os.remove(token_path)
+        return None
+
+    except Exception:
+        # any other error you might still want to log and skip
+        print(f"🔴 Unexpected error for {token_name}:")
+        traceback.print_exc()
+        try:
+            os.remove(token_path)
+        except FileNotFoundError:
+            pass
+        return None
+
+    if not token_contents:
+        print(f"No files in token {token_name}, deleting.")
+        os.remove(token_path)
+        return None
+    return token_contents
+
+
+class TokenCoalescer:
+    """
+    Merges small tokens for the same telescope, camera and night into one
+    EVA run, so they share one interpreter start-up, one import of EVA's
+    modules and one load of the calibration masters.
+
+    A group goes out once it holds max_files files or max_delay seconds
+    after its first token turned up, whichever comes first. A token that
+    is already bigger than max_files runs on its own.
+
+    finished() is the EVA registry listener for merged runs. When one goes
+    fine, EVA has removed the token it was launched with and the others
+    merged into it are done with too. When one fails, every token still
+    there goes back to token_index to be run again, this time on its own,
+    so one bad token can't keep taking the rest of its group down.
+    """
+
+    def __init__(self, token_index, max_files=200, max_delay=60):
+        self.token_index = token_index
+        self.max_files = max_files
+        self.max_delay = max_delay
+        self.groups = collections.OrderedDict()  # key -> {'first_seen', 'tokens', 'files'}
+        self.ready = collections.deque()         # (token paths, files)
+        self.solo = set()                        # token paths to run unmerged after a failed merged run
+
+    @staticmethod
+    def key(token_contents):
+        """
+        (telescope, camera, run date) of the token's first file.
+        """
+        telescope, camera, run_date = parse_token_filename(token_contents[0])
+        if run_date is None:
+            raise ValueError("No run date in " + str(token_contents[0]))
+        return telescope, camera, run_date
+
+    def add(self, token_path, token_contents):
+        if token_path in self.solo:
+            self.solo.discard(token_path)
+            self.ready.append(([token_path], token_contents))
+            return
+        try:
+            key = self.key(token_contents)
+        except (IndexError, AttributeError, TypeError, ValueError):
+            # Not a filename we can group on, let EVA have it as it is
+            self.ready.append(([token_path], token_contents))
+            return
+        group = self.groups.get(key)
+        if group is not None and len(group['files']) + len(token_contents) > self.max_files:
+            self._close(key)
+            group = None
+        if group is None:
+            group = self.groups[key] = {'first_seen': time.time(), 'tokens': [], 'files': {}}
+        group['tokens'].append(token_path)
+        # dict rather than list so a frame in two tokens is only processed once
+        group['files'].update(dict.fromkeys(token_contents))
+        if len(group['files']) >= self.max_files:
+            self._close(key)
+
+    def _close(self, key):
+        group = self.groups.pop(key)
+        self.ready.append((group['tokens'], list(group['files'])))
+
+    def pop_ready(self, n=1):
+        """
+        Up to n runs as (token paths, files), oldest groups first.
+        """
+        now = time.time()
+        for key in [k for k, group in self.groups.items() if now - group['first_seen'] >= self.max_delay]:
+            self._close(key)
+        runs = []
+        while self.ready and len(runs) < n:
+            runs.append(self.ready.popleft())
+        return runs
+
+    def __len__(self):
+        return len(self.ready) + len(self.groups)
+
+    def finished(self, record):
+        token_files = record.get('original_token_files') or []
+        if len(token_files) < 2:
+            return
+        if record['exit_code'] == 0:
+            if os.path.exists(token_files[0]):
+                return
+            for token_path in token_files[1:]:
+                try:
+                    os.remove(token_path)
+                except FileNotFoundError:
+                    pass
+            return
+        print(f"Merged EVA run of {len(token_files)} tokens failed, running them one at a time")
+        for token_path in token_files:
+            if os.path.exists(token_path):
+                # Marked solo before the index can hand it out again
+                self.solo.add(token_path)
+                self.token_index.release(os.path.basename(token_path))
+
+
+class PipeQueueClient:
+    """
+    Client for the shared PIPE work queue, so several pipes can split one
+    night's backlog between them rather than each only ever running its
+    own tokens directory.
+
+    Work is leased rather than dequeued: the queue hides a leased item for
+    visibility_timeout seconds, and puts it back for someone else if the
+    lease runs out. A background thread renews our leases while EVA runs.
+    When a run finishes (we hear about it from the EVA registry) the lease
+    is acked, or nacked so the item goes back on the queue straight away if
+    EVA failed. If this pipe dies outright its leases simply expire.
+
+    A prefetch thread keeps a small buffer of leased work topped up to
+    however many runs the main loop says it has room for (want()), asking
+    for the shortfall in one batched lease call that long polls for up to
+    long_poll seconds. With no room it asks for nothing, and whatever is
+    buffered beyond the room there is goes back to the queue (nacked)
+    rather than being renewed while other pipes could be running it. The
+    main loop picks the buffer up with take(), and can select() on the
+    client to wake the moment something arrives. If the queue answers
+    empty straight away rather than long polling, the thread falls back to
+    asking every poll_period seconds.
+
+    Queue API, relative to queue_url/queue_name:
+        POST lease                   {"worker", "visibility_timeout", "max_items", "wait"} -> [item, ...]
+        POST leases/<lease_id>/renew {"visibility_timeout"}
+        POST leases/<lease_id>/ack
+        POST leases/<lease_id>/nack  {"delay", "reason"}
+    where an item is {"id", "lease_id", "payload": {"request", "request_content"}}.
+    """
+
+    def __init__(self, queue_url, queue_name, worker, leased_token_directory,
+                 visibility_timeout=600, poll_period=30, long_poll=20, auth_token=None):
+        self.base_url = queue_url.rstrip('/') + '/' + queue_name + '/'
+        self.worker = worker
+        self.leased_token_directory = leased_token_directory
+        self.visibility_timeout = visibility_timeout
+        self.poll_period = poll_period
+        self.long_poll = long_poll
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=4))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=4))
+        if auth_token:
+            self.session.headers['Authorization'] = 'Token ' + str(auth_token)
+        self.lock = threading.Lock()
+        self.leases = {}  # lease_id -> {'item', 'token_path', 'renewed'}
+        self.buffer = collections.deque()  # runs leased and waiting for the main loop
+        self.wanted = 0
+        self.wanted_changed = threading.Event()
+        # Written to when runs land in the buffer, so the main loop can select() on it
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        os.set_blocking(self.wake_write, False)
+        os.makedirs(leased_token_directory, mode=0o777, exist_ok=True)
+        self._sweep_leased_tokens()
+
+    def _sweep_leased_tokens(self):
+        """
+        Remove token files left by leases from before a crash or restart.
+
+        Nothing here holds those leases any more, so they run out and the
+        queue hands the work out again.
+        """
+        for entry in os.scandir(self.leased_token_directory):
+            if entry.name.startswith('pipequeue_') and entry.is_file():
+                try:
+                    os.remove(entry.path)
+                    print(f"Removed {entry.name}, left over from an earlier lease")
+                except OSError:
+                    print(traceback.format_exc())
+
+    def fileno(self):
+        return self.wake_read
+
+    def _post(self, path, payload=None, timeout=20, missing_ok=False):
+        """
+        None for 204 (nothing to lease), and for 404 where missing_ok says a
+        lease may have gone. Any other 404 means a wrong pipe_queue_url or a
+        server without this API, and raises like any other error.
+        """
+        response = self.session.post(self.base_url + path, json=payload or {}, timeout=(10, timeout))
+        if response.status_code == 204 or (response.status_code == 404 and missing_ok):
+            return None
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def lease(self, max_items, wait=0):
+        """
+        Lease up to max_items, long polling up to wait seconds for them, and
+        turn them into runs: (token paths, files, lease_id).
+        """
+        try:
+            items = self._post('lease', {
+                'worker': self.worker,
+                'visibility_timeout': self.visibility_timeout,
+                'max_items': max_items,
+                'wait': wait,
+            }, timeout=wait + 20) or []
+        except:
+            print("Couldn't lease work from the PIPE queue at " + self.base_url)
+            print(traceback.format_exc())
+            return []
+
+        runs = []
+        for item in items:
+            lease_id = item['lease_id']
+            payload = item.get('payload') or {}
+            requested_task_content = [f for f in payload.get('request_content') or [] if f]
+            pipe_queue_leases.inc(outcome='leased')
+            if payload.get('request') != 'EVA_process_files':
+                print(f"PIPE queue item {item['id']} asks for {payload.get('request')!r}, which this pipe doesn't do")
+                self.nack(lease_id, reason='unsupported request', delay=self.visibility_timeout)
+                continue
+            if not requested_task_content:
+                print(f"PIPE queue item {item['id']} has no files, acking it")
+                self.ack(lease_id)
+                continue
+            # A token file of our own for EVA to work from, and remove when it is done
+            token_path = os.path.join(self.leased_token_directory, 'pipequeue_' + str(item['id']))
+            with open(token_path, 'w') as f:
+                json.dump(requested_task_content, f)
+            with self.lock:
+                self.leases[lease_id] = {'item': item, 'token_path': token_path, 'renewed': time.time()}
+            print(f"Leased PIPE queue item {item['id']}: {len(requested_task_content)} files")
+            runs.append(([token_path], requested_task_content, lease_id))
+        return runs
+
+    def want(self, n):
+        """
+        How many runs the main loop has room for besides its own tokens.
+        """
+        n = max(0, n)
+        with self.lock:
+            changed = n != len(self.buffer)
+            self.wanted = n
+        if changed:
+            self.wanted_changed.set()
+
+    def _shed_excess(self):
+        """
+        Give back buffered leases the main loop no longer has room for, newest first.
+        """
+        with self.lock:
+            excess = []
+            while len(self.buffer) > self.wanted:
+                excess.append(self.buffer.pop())
+        for token_paths, requested_task_content, lease_id in excess:
+            self.nack(lease_id, reason='no room to run it')
+
+    def take(self, n):
+        """
+        Up to n runs from the buffer.
+        """
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        runs = []
+        with self.lock:
+            while self.buffer and len(runs) < n:
+                runs.append(self.buffer.popleft())
+        return runs
+
+    def _prefetch(self):
+        while True:
+            self._shed_excess()
+            with self.lock:
+                short = self.wanted - len(self.buffer)
+            if short <= 0:
+                self.wanted_changed.wait(timeout=self.poll_period)
+                self.wanted_changed.clear()
+                continue
+            asked = time.time()
+            runs = self.lease(short, wait=self.long_poll)
+            if runs:
+                with self.lock:
+                    self.buffer.extend(runs)
+                try:
+                    os.write(self.wake_write, b'\0')
+                except BlockingIOError:
+                    pass  # pipe full, the main loop has plenty of wake ups waiting already
+            elif time.time() - asked < self.long_poll / 2:
+                # Nothing, and no long poll either: the queue is empty, or down
+                time.sleep(self.poll_period)
+
+    def renew_due(self):
+        """
+        Renew every lease that is a third of the way to running out.
+        """
+        now = time.time()
+        with self.lock:
+            due = [lease_id for lease_id, lease in self.leases.items()
+                   if not lease.get('lost') and now - lease['renewed'] > self.visibility_timeout / 3]
+        for lease_id in due:
+            try:
+                if self._post(f'leases/{lease_id}/renew', {'visibility_timeout': self.visibility_timeout},
+                              missing_ok=True) is None:
+                    # Lease already gone: expired, or the item was handed to someone else
+                    print(f"Lost the PIPE queue lease {lease_id}")
+                    pipe_queue_leases.inc(outcome='lost')
+                    with self.lock:
+                        # Someone else may have it now, so don't run it from the buffer
+                        unrun = [run for run in self.buffer if run[2] == lease_id]
+                        for run in unrun:
+                            self.buffer.remove(run)
+                        if lease_id in self.leases:
+                            # Kept until EVA finishes with it, so its token file goes too
+                            self.leases[lease_id]['lost'] = True
+                    if unrun:
+                        self._release(lease_id)
+                    continue
+            except:
+                print(f"Couldn't renew PIPE queue lease {lease_id}, will try again")
+                print(traceback.format_exc())
+                continue
+            with self.lock:
+                if lease_id in self.leases:
+                    self.leases[lease_id]['renewed'] = time.time()
+
+    def _release(self, lease_id):
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+        if lease is not None:
+            try:
+                os.remove(lease['token_path'])
+            except FileNotFoundError:
+                pass
+
+    def ack(self, lease_id):
+        self._release(lease_id)
+        pipe_queue_leases.inc(outcome='acked')
+        try:
+            self._post(f'leases/{lease_id}/ack', missing_ok=True)
+        except:
+            print(f"Couldn't ack PIPE queue lease {lease_id}, it will come round again when it expires")
+            print(traceback.format_exc())
+
+    def nack(self, lease_id, reason='', delay=0):
+        self._release(lease_id)
+        pipe_queue_leases.inc(outcome='nacked')
+        try:
+            self._post(f'leases/{lease_id}/nack', {'delay': delay, 'reason': reason}, missing_ok=True)
+        except:
+            print(f"Couldn't nack PIPE queue lease {lease_id}, it will come round again when it expires")
+            print(traceback.format_exc())
+
+    def finished(self, record):
+        """
+        EVA registry listener.
+        """
+        lease_id = record.get('pipe_queue_lease')
+        if lease_id is None:
+            return
+        if record['exit_code'] == 0:
+            self.ack(lease_id)
+        else:
+            self.nack(lease_id, reason=f"EVA exited with {record['exit_code']}")
+
+    def _run(self):
+        while True:
+            try:
+                # The prefetcher may be stuck in a long poll, so shed here too
+                self._shed_excess()
+                self.renew_due()
+            except:
+                print(traceback.format_exc())
+            time.sleep(min(30, self.visibility_timeout / 6))
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name='pipe_queue_leases').start()
+        threading.Thread(target=self._prefetch, daemon=True, name='pipe_queue_prefetch').start()
+        return self
+
+    def __len__(self):
+        with self.lock:
+            return len(self.buffer)
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all the ingestion threads for one class of archive
+    call. The refill rate follows AIMD: it is halved when the archive pushes
+    back with a 500/502 or refuses connections, and creeps back up by a fixed
+    step on every successful call until it is back at max_rate.
+
+    The calls already in flight when the rate is halved were sent at the old
+    rate, so their errors say nothing new about the archive and don't halve
+    it again. One bad patch costs one halving however many calls it catches.
+    """
+
+    def __init__(self, name, max_rate, min_rate=0.25, increase=0.1, decrease=0.5):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.rate = max_rate
+        # Allow up to a second's worth of calls in a burst
+        self.capacity = max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.last_backoff = 0
+        self.lock = threading.Lock()
+        # When this thread's current call was let through
+        self.issued = threading.local()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Block until this thread is allowed to make a call.
+        """
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.issued.at = time.monotonic()
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def backoff(self):
+        """
+        Called from the thread whose call failed, after its acquire().
+        """
+        with self.lock:
+            now = time.monotonic()
+            # Sent before the last backoff: the same bad patch, already counted
+            if getattr(self.issued, 'at', now) < self.last_backoff:
+                return
+            self.last_backoff = now
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 1.0)
+            print(f"Archive {self.name} calls backing off to {self.rate:.2f} per second")
+
+# One bucket per class of archive endpoint, shared by all ingestion threads,
+# each with an equal share of TOTAL_RATE. Validation is header parsing done
+# here, it never calls the archive.
+archive_rate_limiters = {
+    'upload': TokenBucket('upload', TOTAL_RATE / 2),
+    'record': TokenBucket('record', TOTAL_RATE / 2),
+}
+
+def back_off_archive_calls(stage):
+    if stage in archive_rate_limiters:
+        archive_rate_limiters[stage].backoff()
+
+class RetryScheduler:
+    """
+    Holds ingester items that need another go later, so a file sitting out
+    its backoff doesn't tie up one of the ingestion threads. The delay doubles
+    with each attempt (with jitter so a flapping archive doesn't get all the
+    retries at once) and after max_attempts the file is given up on.
+    A single timer thread puts items back on the ingester_queue when due.
+    """
+
+    def __init__(self, base_delay=2.0, max_delay=900.0, max_attempts=12):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.heap = []  # (due, sequence, item)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def delay_for(self, attempt):
+        """
+        Equal jitter: half the exponential delay, plus a random part of the other half.
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempt - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule(self, item, attempt):
+        """
+        Queue item (an ingester_queue item) to go
+        back on the queue after the backoff for this attempt. Returns the
+        delay used, or None if the item has run out of attempts.
+        """
+        if attempt > self.max_attempts:
+            return None
+        delay = self.delay_for(attempt)
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='ingestion_retry_scheduler')
+                self.thread.start()
+            self.sequence += 1
+            heapq.heappush(self.heap, (time.monotonic() + delay, self.sequence, item))
+            self.condition.notify()
+        return delay
+
+    def __len__(self):
+        with self.condition:
+            return len(self.heap)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.condition.wait(timeout)
+                due, sequence, item = heapq.heappop(self.heap)
+            add_ingester_item(item)
+
+ingestion_retry_scheduler = RetryScheduler()
+
+def retry_ingest_item_later(file, tempfilename, ingester_directory, failed_ingestion_directory, error_text):
+    """
+    Hand a file that hit a transient archive error to the retry scheduler,
+    or move it to the fails directory once it has had too many goes.
+    """
+    attempts = ingestion_journal.count_attempt(file)
+    delay = ingestion_retry_scheduler.schedule(
+        [file, ingester_directory, failed_ingestion_directory], attempts)
+    if delay is None:
+        ingest_given_up.inc()
+        print (f"Giving up on {tempfilename} after {attempts} attempts. Copying file to fails directory")
+        ingestion_journal.advance(file, 'failed', error=error_text)
+        move_to_failed_ingestion(file, tempfilename, failed_ingestion_directory)
+    else:
+        ingest_retries.inc()
+        print (f"Retry {attempts} of {tempfilename} in {delay:.0f}s")
+
+def move_to_failed_ingestion(file, tempfilename, failed_ingestion_directory):
+    """
+    Move the json and its data file into the failed ingestion directory,
+    replacing anything of the same name already there.
+    """
+    for path in (file, tempfilename):
+        destination = failed_ingestion_directory + '/' + path.split('/')[-1]
+        try:
+            # if dst exists, delete it
+            if os.path.exists(destination):
+                os.remove(destination)
+            shutil.move(path, destination)
+            try:
+                os.remove(path)
+            except:
+                pass
+        except:
+            print(traceback.format_exc())
+
+def remove_ingested_files(file, tempfilename):
+    for path in (file, tempfilename):
+        try:
+            os.remove(path)
+        except:
+            print(traceback.format_exc())
+
+def finish_ingest_item(file):
+    """
+    Anything still sitting in the ingester directory is either back in the
+    queue or stuck, either way the scan shouldn't queue it again.
+    """
+    if not os.path.exists(file):
+        known_ingester_jsons.discard(file)
+
+
+class MappedFitsFile(io.RawIOBase):
+    """
+    Read-only file object over a memory-mapped data file. Validation, the md5
+    and the upload all read from the same mapping, so a big mosaic comes off
+    the archive disk once and everything after that is served from the page
+    cache, which the validation processes share too when they map the file.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.name = path
+        self.mode = 'rb'
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self.position = 0
+        self._md5 = None
+
+    @property
+    def md5(self):
+        """
+        md5 of the file, worked out in a single sequential pass the first time it is asked for.
+        """
+        if self._md5 is None:
+            if hasattr(self.map, 'madvise'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+            md5 = hashlib.md5()
+            chunk_size = 8 * 2 ** 20
+            with memoryview(self.map) as view:
+                for offset in range(0, self.size, chunk_size):
+                    md5.update(view[offset:offset + chunk_size])
+            if hasattr(self.map, 'madvise'):
+                self.map.madvise(mmap.MADV_NORMAL)
+            self._md5 = md5.hexdigest()
+        return self._md5
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("invalid whence " + str(whence))
+        if position < 0:
+            raise ValueError("negative seek position " + str(position))
+        self.position = position
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+        data = self.map[self.position:end]
+        self.position = end
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.map.close()
+        super().close()
+
+
+class IngestJob:
+    """
+    One ingester file on its way through the validate, upload and record stages.
+    """
+
+    STAGES = ('validate', 'upload', 'record')
+
+    def __init__(self, file, ingester_directory, failed_ingestion_directory):
+        self.file = file
+        self.tempfilename = str(file.replace('.json',''))
+        self.ingester_directory = ingester_directory
+        self.failed_ingestion_directory = failed_ingestion_directory
+        self.headerdict = None
+        self.record = None
+        self.s3_version = None
+        self.state = 'discovered'
+        self.mapped = None
+        self.md5 = None
+        self.size = 0
+
+    def data_file(self):
+        """
+        The data file, memory-mapped once and shared by every stage of this job.
+        """
+        if self.mapped is None:
+            self.mapped = MappedFitsFile(self.tempfilename)
+        self.mapped.seek(0)
+        return self.mapped
+
+    def content_md5(self):
+        """
+        md5 of the data file, from the upload if we resumed past validation.
+        """
+        if self.md5 is None and self.s3_version:
+            self.md5 = self.s3_version.get('md5')
+        if self.md5 is None:
+            try:
+                self.md5 = self.data_file().md5
+            except OSError:
+                pass
+        return self.md5
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+    @property
+    def item(self):
+        return [self.file, self.ingester_directory, self.failed_ingestion_directory]
+
+    def remaining_stages(self):
+        if self.state == 'discovered':
+            return list(self.STAGES)
+        if self.state == 'validated':
+            return ['upload', 'record']
+        if self.state == 'uploaded':
+            return ['record']
+        return []
+
+
+def prepare_ingest_job(item):
+    """
+    Do the cheap checks on an ingester item and work out which stage it starts
+    from. Returns an IngestJob, or None if the item has already been dealt
+    with here (missing, too small, a thumbnail or ingested before a restart).
+    """
+    file, ingester_directory, failed_ingestion_directory = item
+    print ("Starting ingestion of " + str(file.replace('.pickle','').replace(ingester_directory,'')))
+
+    job = IngestJob(file, ingester_directory, failed_ingestion_directory)
+    tempfilename = job.tempfilename
+
+    if not os.path.exists(tempfilename):
+        print (tempfilename + " not found, skipping ingestion.")
+        try:
+            os.remove(file)
+            os.remove(tempfilename)
+        except:
+            print(traceback.format_exc())
+        return None
+
+    # An empty sek, sea or psx file is actually size 50... so consider any file bigger than that.
+    filestat = os.stat(tempfilename)
+    if filestat.st_size <= 51:
+        print (tempfilename + " too small, skipping ingestion.")
+        try:
+            os.remove(file)
+            os.remove(tempfilename)
+        except:
+            print(traceback.format_exc())
+        return None
+
+    # Pick up from wherever we got to before any restart
+    job.size = filestat.st_size
+    journal_entry = ingestion_journal.discovered(file, filestat.st_size, filestat.st_mtime)
+    if journal_entry['state'] == 'recorded':
+        print ("Already ingested, tidying up: " + str(tempfilename))
+        remove_ingested_files(file, tempfilename)
+        return None
+
+    if 'thumbnail' in tempfilename:
+        print ("OCS Ingester doesn't like thumbnail image: " + str(tempfilename))
+        ingestion_journal.advance(file, 'failed', error='thumbnail')
+        move_to_failed_ingestion(file, tempfilename, failed_ingestion_directory)
+        return None
+
+    with open(file, 'r') as tempfile:
+        job.headerdict = json.load(tempfile)
+
+    job.state = journal_entry['state']
+    job.record = journal_entry['record']
+    job.s3_version = journal_entry['s3_version']
+    return job
+
+
+class IngestSubprocessError(Exception):
+    """
+    Carries the formatted traceback back from a validation process. The
+    requests exceptions don't always survive pickling, and the error handling
+    matches on the traceback text anyway.
+    """
+
+
+def validate_in_subprocess(tempfilename, headerdict):
+    """
+    Runs in the validation process pool, away from the GIL of the main process.
+    """
+    try:
+        with MappedFitsFile(tempfilename) as fileobj:
+            return validate_fits_and_create_archive_record(fileobj, file_metadata=headerdict)
+    except Exception:
+        raise IngestSubprocessError(traceback.format_exc())
+
+
+def validate_ingest_job(job, executor=None):
+    """
+    Validate the FITS file and build its archive record. With an executor
+    (the process pool) the work is done there, otherwise in this thread.
+    """
+    # One sequential pass for the checksum pulls the whole file into the page
+    # cache, everything after this reads it from memory.
+    job.md5 = job.data_file().md5
+
+    # Don't bother the archive with anything we know it already has
+    known_as = ingestion_journal.already_ingested(job.md5)
+    if known_as is not None:
+        print ("Archive already has this md5 (" + str(known_as) + "), retiring: " + str(job.tempfilename))
+        job.state = 'recorded'
+        ingestion_journal.advance(job.file, 'recorded')
+        remove_ingested_files(job.file, job.tempfilename)
+        return
+
+    if executor is None:
+        job.record = validate_fits_and_create_archive_record(job.data_file(), file_metadata=job.headerdict)
+    else:
+        job.record = executor.submit(validate_in_subprocess, job.tempfilename, job.headerdict).result()
+    job.state = 'validated'
+    ingestion_journal.advance(job.file, 'validated', record=job.record)
+
+def upload_ingest_job(job):
+    archive_rate_limiters['upload'].acquire()
+    job.s3_version = upload_file_to_file_store(job.data_file(), file_metadata=job.headerdict)
+    archive_rate_limiters['upload'].success()
+    ingest_uploaded_bytes.inc(job.size)
+    job.state = 'uploaded'
+    ingestion_journal.advance(job.file, 'uploaded', s3_version=job.s3_version)
+
+def record_ingest_job(job):
+    archive_rate_limiters['record'].acquire()
+    if archive_http_session is None:
+        ingest_archive_record(job.s3_version, job.record)
+    else:
+        post_archive_record(job.s3_version, job.record, archive_http_session)
+    archive_rate_limiters['record'].success()
+    mark_ingest_job_recorded(job)
+
+def mark_ingest_job_recorded(job):
+    ingest_files.inc()
+    job.state = 'recorded'
+    ingestion_journal.advance(job.file, 'recorded')
+    ingestion_journal.remember_ingested(job.content_md5(), os.path.basename(job.tempfilename))
+    remove_ingested_files(job.file, job.tempfilename)
+
+ingest_stage_functions = {
+    'validate': validate_ingest_job,
+    'upload': upload_ingest_job,
+    'record': record_ingest_job,
+}
+
+def handle_ingest_job_error(job, stage, error_text):
+    """
+    Work out what to do with a file after one of its archive calls fell over.
+    """
+    file = job.file
+    tempfilename = job.tempfilename
+    ingest_errors.inc(stage=stage, error=ingest_error_class(error_text))
+    if ('Version with this md5 already exists') in error_text:
+        print ("Version with this md5 already exists: " + str(tempfilename))
+        ingestion_journal.advance(file, 'recorded')
+        ingestion_journal.remember_ingested(job.content_md5(), os.path.basename(tempfilename))
+        remove_ingested_files(file, tempfilename)
+    elif ('502 Server Error') in error_text:
+        print ("502 Server Error. Backing off and waiting: "+ str(tempfilename))
+        back_off_archive_calls(stage)
+        retry_ingest_item_later(file, tempfilename, job.ingester_directory, job.failed_ingestion_directory, error_text)
+    elif ('500 Server Error') in error_text:
+        print ("500 Server Error. Backing off and waiting: "+ str(tempfilename))
+        back_off_archive_calls(stage)
+        retry_ingest_item_later(file, tempfilename, job.ingester_directory, job.failed_ingestion_directory, error_text)
+    elif ('400 Client Error') in error_text:
+        print ("400 Server Error. Copying file to fails directory")
+        ingestion_journal.advance(file, 'failed', error=error_text)
+        move_to_failed_ingestion(file, tempfilename, job.failed_ingestion_directory)
+    elif ('Max retries exceeded') in error_text:
+        print ("Max retries error. Backing off and waiting: "+ str(tempfilename))
+        back_off_archive_calls(stage)
+        retry_ingest_item_later(file, tempfilename, job.ingester_directory, job.failed_ingestion_directory, error_text)
+    elif ('BrokenProcessPool') in error_text:
+        print ("Validation process died. Putting file back for another go: "+ str(tempfilename))
+        retry_ingest_item_later(file, tempfilename, job.ingester_directory, job.failed_ingestion_directory, error_text)
+    else:
+        print (error_text)
+        ingestion_journal.advance(file, 'failed', error=error_text)
+
+def run_ingest_stage(job, stage, **kwargs):
+    """
+    Run one stage for a job. Returns True if it went through, False if it
+    failed and the error has been dealt with.
+    """
+    ingest_in_flight.inc(stage=stage)
+    stage_start = time.monotonic()
+    try:
+        ingest_stage_functions[stage](job, **kwargs)
+        ingest_stage_seconds.observe(time.monotonic() - stage_start, stage=stage, outcome='ok')
+        return True
+    except:
+        ingest_stage_seconds.observe(time.monotonic() - stage_start, stage=stage, outcome='error')
+        handle_ingest_job_error(job, stage, traceback.format_exc())
+        return False
+    finally:
+        ingest_in_flight.dec(stage=stage)
+        health_monitor.beat('ingestion')
+
+# Keep-alive connection pool for the archive record posts, set up in main()
+archive_http_session = None
+
+def post_archive_record(version, record, session):
+    """
+    ingest_archive_record, but through session's connection pool rather
+    than a new connection and TLS handshake per frame. Errors come out of
+    ocs_ingester's own response handling, so they read the same.
+    """
+    archive = ArchiveService(api_root=ingester_settings.API_ROOT, auth_token=ingester_settings.AUTH_TOKEN)
+    record['version_set'] = [version]
+    response = session.post(archive.api_root + 'frames/', json=record, headers=archive.headers, timeout=120)
+    return archive.handle_response(response)
+
+def ingest_archive_records(versions_and_records):
+    """
+    Post a batch of records to the archive's frames endpoint in one request,
+    the bulk equivalent of ingest_archive_record. Returns the created frames,
+    one per record, in the same order.
+    """
+    payload = []
+    for version, record in versions_and_records:
+        record = dict(record)
+        record['version_set'] = [version]
+        payload.append(record)
+    response = (archive_http_session or requests).post(ingester_settings.API_ROOT + 'frames/',
+                                                       json=payload,
+                                                       headers={'Authorization': 'Token ' + str(ingester_settings.AUTH_TOKEN)},
+                                                       timeout=120)
+    response.raise_for_status()
+    created = response.json()
+    if not isinstance(created, list) or len(created) != len(payload):
+        raise ValueError("Archive didn't return one frame per record in the batch")
+    return created
+
+
+class ArchiveRecordBatcher:
+    """
+    Collects jobs whose files are validated and uploaded and posts their
+    archive records in bulk, flushing when batch_size records are waiting or
+    the oldest has waited max_latency seconds. Each job gets a Future that
+    resolves to whether its record went in. submit() blocks while two full
+    batches are waiting, so a slow archive holds the record stage up just
+    as the bounded stage queues do.
+
+    If a bulk post fails, each record in it goes through the single-record
+    path instead, so every file still gets its own result and error handling.
+    If the archive won't take bulk posts at all, we stop trying.
+    """
+
+    def __init__(self, batch_size=50, max_latency=5.0):
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.waiting = []  # (job, future)
+        self.max_waiting = 2 * batch_size
+        self.oldest = None
+        self.bulk_supported = True
+        self.condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name='archive_record_batcher').start()
+        return self
+
+    def submit(self, job):
+        future = concurrent.futures.Future()
+        with self.condition:
+            while len(self.waiting) >= self.max_waiting:
+                self.condition.wait()
+            if not self.waiting:
+                self.oldest = time.monotonic()
+            self.waiting.append((job, future))
+            # Wake the flusher to start the clock on a new batch, or to send a full one
+            if len(self.waiting) == 1 or len(self.waiting) >= self.batch_size:
+                self.condition.notify_all()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.waiting or (len(self.waiting) < self.batch_size
+                                           and time.monotonic() - self.oldest < self.max_latency):
+                    timeout = self.oldest + self.max_latency - time.monotonic() if self.waiting else None
+                    self.condition.wait(timeout)
+                batch = self.waiting[:self.batch_size]
+                self.waiting = self.waiting[self.batch_size:]
+                self.oldest = time.monotonic()
+                # Room again for anyone held up in submit()
+                self.condition.notify_all()
+            try:
+                self._flush(batch)
+            except Exception:
+                print(f"Archive record batch raised an exception: {traceback.format_exc()}")
+                for job, future in batch:
+                    if not future.done():
+                        future.set_result(False)
+
+    def _flush(self, batch):
+        if self.bulk_supported and len(batch) > 1:
+            archive_rate_limiters['record'].acquire()
+            batch_start = time.monotonic()
+            try:
+                ingest_archive_records([(job.s3_version, job.record) for job, future in batch])
+            except Exception:
+                error_text = traceback.format_exc()
+                print(f"Bulk post of {len(batch)} archive records failed, falling back to one at a time")
+                if ('500 Server Error') in error_text or ('502 Server Error') in error_text or ('Max retries exceeded') in error_text:
+                    archive_rate_limiters['record'].backoff()
+            else:
+                archive_rate_limiters['record'].success()
+                ingest_stage_seconds.observe(time.monotonic() - batch_start, stage='record_batch', outcome='ok')
+                print(f"Posted {len(batch)} archive records in one go")
+                for job, future in batch:
+                    mark_ingest_job_recorded(job)
+                    future.set_result(True)
+                return
+
+            results = [run_ingest_stage(job, 'record') for job, future in batch]
+            if all(results) and not (('500 Server Error') in error_text or ('502 Server Error') in error_text or ('Max retries exceeded') in error_text):
+                # The archive took every record on its own but not as a list
+                print("Archive doesn't seem to take bulk record posts, posting records one at a time from now on")
+                self.bulk_supported = False
+            for (job, future), went_through in zip(batch, results):
+                future.set_result(went_through)
+        else:
+            for job, future in batch:
+                future.set_result(run_ingest_stage(job, 'record'))
+
+# Set up in main() when config.json asks for batch_archive_records
+archive_record_batcher = None
+
+def submit_ingest_stage(job, stage, **kwargs):
+    """
+    Like run_ingest_stage, but returns a Future of the result. Records go to
+    the ArchiveRecordBatcher when batching is on, anything else runs now.
+    """
+    if stage == 'record' and archive_record_batcher is not None:
+        return archive_record_batcher.submit(job)
+    future = concurrent.futures.Future()
+    future.set_result(run_ingest_stage(job, stage, **kwargs))
+    return future
+
+def ingest_item(item):
+    """
+    Ingest one file start to finish in this thread.
+    """
+    file = item[0]
+    job = None
+    try:
+        job = prepare_ingest_job(item)
+        while job is not None and job.remaining_stages():
+            if not submit_ingest_stage(job, job.remaining_stages()[0]).result():
+                break
+    except:
+        print(traceback.format_exc())
+        try:
+            ingestion_journal.advance(file, 'failed', error=traceback.format_exc())
+        except:
+            pass
+    finally:
+        if job is not None:
+            job.close()
+        finish_ingest_item(file)
+
+
+class StagedIngestionPipeline:
+    """
+    Replaces the pool of ingester_worker threads with three stages joined by
+    bounded queues, so the CPU bound and network bound parts of ingestion
+    don't hold each other up:
+
+        validate - FITS validation in a process pool sized to the cores
+        upload   - S3 uploads in their own thread pool
+        record   - archive record posts in a smaller thread pool
+
+    A feeder thread takes items off the ingester_queue, does the cheap checks
+    and drops each job into the stage it needs to start from. A full stage
+    queue blocks the stage before it, so nothing piles up in memory.
+    """
+
+    def __init__(self, validation_processes=None, upload_threads=None, record_threads=4):
+        self.validation_processes = validation_processes or os.cpu_count() or 4
+        self.stage_threads = {
+            'validate': self.validation_processes,
+            # Looked up now, main() sets it from the config after import
+            'upload': upload_threads or maximum_parallel_ingestions,
+            'record': record_threads,
+        }
+        self.stage_queues = {
+            stage: queue.Queue(maxsize=2 * count) for stage, count in self.stage_threads.items()
+        }
+        self.validation_pool = None
+        self.pool_lock = threading.Lock()
+
+    def _new_validation_pool(self):
+        # forkserver, as forking a process full of threads and locks is asking for trouble
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.validation_processes,
+            mp_context=multiprocessing.get_context('forkserver'))
+
+    def start(self):
+        self.validation_pool = self._new_validation_pool()
+        threading.Thread(target=self._feed, daemon=True, name='ingestion_feeder').start()
+        for stage, count in self.stage_threads.items():
+            for _ in range(count):
+                threading.Thread(target=self._stage_worker, args=(stage,), daemon=True,
+                                 name='ingestion_' + stage).start()
+        print(f"Started staged ingestion: {self.validation_processes} validation processes, "
+              f"{self.stage_threads['upload']} upload threads, {self.stage_threads['record']} record threads")
+
+    def _check_validation_pool(self, pool):
+        """
+        A validation process that dies takes the whole pool with it, so swap in a new one.
+        """
+        try:
+            pool.submit(int).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            with self.pool_lock:
+                if self.validation_pool is pool:
+                    print ("Validation process pool broke, starting a new one")
+                    self.validation_pool = self._new_validation_pool()
+                    pool.shutdown(wait=False)
+
+    def _feed(self):
+        while True:
+            ingester_item = ingester_queue.get()  # Blocks if queue is empty
+            if ingester_item is None:
+                break  # Graceful exit signal
+            try:
+                job = prepare_ingest_job(ingester_item)
+                if job is None:
+                    finish_ingest_item(ingester_item[0])
+                else:
+                    self.stage_queues[job.remaining_stages()[0]].put(job)
+            except Exception:
+                print(f"Preparing ingestion item raised an exception: {traceback.format_exc()}")
+                try:
+                    ingestion_journal.advance(ingester_item[0], 'failed', error=traceback.format_exc())
+                except:
+                    pass
+            finally:
+                ingester_queue.task_done()
+
+    def _stage_worker(self, stage):
+        stage_queue = self.stage_queues[stage]
+        while True:
+            job = stage_queue.get()
+            try:
+                if stage == 'validate':
+                    pool = self.validation_pool
+                    went_through = run_ingest_stage(job, stage, executor=pool)
+                    if not went_through:
+                        self._check_validation_pool(pool)
+                    self._next_stage(job, went_through)
+                else:
+                    # Records may be batched up, in which case this job
+                    # carries on from the batcher's thread when it is done
+                    submit_ingest_stage(job, stage).add_done_callback(
+                        lambda future, job=job: self._next_stage(job, future.result()))
+            except Exception:
+                print(f"Ingestion {stage} stage raised an exception: {traceback.format_exc()}")
+            finally:
+                stage_queue.task_done()
+
+    def _next_stage(self, job, went_through):
+        remaining = job.remaining_stages()
+        if went_through and remaining:
+            self.stage_queues[remaining[0]].put(job)
+        else:
+            job.close()
+            finish_ingest_item(job.file)
+
+class ResourceSampler:
+    """
+    Background thread that samples CPU, memory and disk I/O every interval
+    seconds from psutil counter deltas and keeps an exponentially smoothed
+    snapshot, so scheduling decisions can read the current state instantly
+    instead of blocking on psutil.cpu_percent(interval=1) or iostat.
+
+    Disk figures are kB/s for each watched device, the same units iostat
+    reports, so the old thresholds still mean the same thing.
+    """
+
+    def __init__(self, interval=1.0, smoothing_time=5.0):
+        self.interval = interval
+        # Weight of each new sample, for roughly a smoothing_time second window
+        self.alpha = min(1.0, interval / smoothing_time)
+        self.devices = []
+        self.lock = threading.Lock()
+        self.current = None
+        self.thread = None
+
+    def start(self, devices=()):
+        self.devices = [device for device in devices if device and device != 'none']
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True, name='resource_sampler')
+            self.thread.start()
+
+    def _disk_counters(self):
+        try:
+            counters = psutil.disk_io_counters(perdisk=True) or {}
+        except Exception:
+            counters = {}
+        return {device: counters.get(device) for device in self.devices}
+
+    def _run(self):
+        last_cpu = psutil.cpu_times()
+        last_disks = self._disk_counters()
+        last_time = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            try:
+                now = time.monotonic()
+                elapsed = max(now - last_time, 1e-6)
+                cpu = psutil.cpu_times()
+                disks = self._disk_counters()
+                memory = psutil.virtual_memory()
+
+                total = sum(cpu) - sum(last_cpu)
+                idle = (cpu.idle + getattr(cpu, 'iowait', 0)) - (last_cpu.idle + getattr(last_cpu, 'iowait', 0))
+                sample = {
+                    'cpu_percent': 100.0 * (1 - idle / total) if total > 0 else 0.0,
+                    'memory_percent': memory.percent,
+                    'memory_available': memory.available,
+                    'disks': {},
+                }
+                for device, counters in disks.items():
+                    previous = last_disks.get(device)
+                    if counters is None or previous is None:
+                        continue
+                    sample['disks'][device] = {
+                        'read_kBps': (counters.read_bytes - previous.read_bytes) / 1024 / elapsed,
+                        'write_kBps': (counters.write_bytes - previous.write_bytes) / 1024 / elapsed,
+                        'busy_percent': 100.0 * (getattr(counters, 'busy_time', 0) - getattr(previous, 'busy_time', 0)) / 1000 / elapsed,
+                    }
+                last_cpu, last_disks, last_time = cpu, disks, now
+                self._publish(sample)
+            except Exception:
+                print("Resource sampler hit a snag")
+                print(traceback.format_exc())
+
+    def _publish(self, sample):
+        with self.lock:
+            if self.current is None:
+                smoothed = sample
+            else:
+                smoothed = {
+                    'cpu_percent': self._smooth(self.current['cpu_percent'], sample['cpu_percent']),
+                    # Memory is a level, not a rate, so the latest reading is what matters
+                    'memory_percent': sample['memory_percent'],
+                    'memory_available': sample['memory_available'],
+                    'disks': {},
+                }
+                for device, rates in sample['disks'].items():
+                    previous = self.current['disks'].get(device, rates)
+                    smoothed['disks'][device] = {
+                        key: self._smooth(previous.get(key, value), value) for key, value in rates.items()
+                    }
+            smoothed['time'] = time.time()
+            self.current = smoothed
+
+    def _smooth(self, previous, value):
+        return previous + self.alpha * (value - previous)
+
+    def snapshot(self):
+        """
+        The latest smoothed readings. Before the first sample is in, a quick
+        non-blocking reading stands in.
+        """
+        with self.lock:
+            if self.current is not None:
+                return self.current
+        return {
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'memory_percent': psutil.virtual_memory().percent,
+            'memory_available': psutil.virtual_memory().available,
+            'disks': {},
+            'time': time.time(),
+        }
+
+resource_sampler = ResourceSampler()
+
+def eva_token_camera(requested_task_content):
+    """
+    Camera name from the first file in a token.
+    """
+    try:
+        return parse_token_filename(requested_task_content[0])[1]
+    except (IndexError, TypeError, ValueError):
+        return 'unknown'
+
+
+class EvaProcessRegistry:
+    """
+    Every EVA run the watcher has launched: token, PID and process group,
+    start time, sampled RSS and CPU, wall time and exit code.
+
+    A background thread samples the process tree of each running EVA and
+    reaps runs as they finish through their Popen, so exit codes aren't
+    lost the way they were to waitpid(-1). Finished runs are appended to a
+    JSON lines history file for sizing the pipe and tuning thresholds, and
+    handed to any listeners (the admission controller learns from them).
+    """
+
+    def __init__(self, history_file=None, sample_interval=2.0):
+        self.history_file = history_file
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.runs = {}     # pid -> run record
+        self.popens = {}   # pid -> Popen
+        self.listeners = []
+        self.finished_count = 0
+        self.thread = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def launched(self, popen, token, requested_task_content, **details):
+        try:
+            pgid = os.getpgid(popen.pid)
+        except OSError:
+            pgid = None
+        record = {
+            'token': str(token),
+            'pid': popen.pid,
+            'pgid': pgid,
+            'camera': eva_token_camera(requested_task_content),
+            'n_files': len(requested_task_content),
+            'start': time.time(),
+            'end': None,
+            'wall_time': None,
+            'rss': 0,
+            'peak_rss': 0,
+            'cpu_seconds': 0.0,
+            'cpu_cores': None,
+            'exit_code': None,
+        }
+        record.update(details)
+        with self.lock:
+            self.runs[popen.pid] = record
+            self.popens[popen.pid] = popen
+        return record
+
+    def running(self):
+        """
+        Copies of the records of the runs still going.
+        """
+        with self.lock:
+            return [dict(record) for record in self.runs.values()]
+
+    def _sample(self, pid):
+        """
+        RSS and CPU seconds of a run's whole process tree (bash, EVA and anything it spawns).
+        """
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return None
+        rss = 0
+        cpu_seconds = 0.0
+        for p in processes:
+            try:
+                rss += p.memory_info().rss
+                cpu_times = p.cpu_times()
+                cpu_seconds += cpu_times.user + cpu_times.system
+            except psutil.Error:
+                continue
+        return rss, cpu_seconds
+
+    def poll(self):
+        """
+        Sample the running EVAs and reap any that have finished.
+        """
+        with self.lock:
+            runs = [(pid, self.runs[pid], self.popens[pid]) for pid in self.runs]
+        for pid, record, popen in runs:
+            sample = self._sample(pid)
+            if sample is not None:
+                rss, cpu_seconds = sample
+                with self.lock:
+                    record['rss'] = rss
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+                    # Children that already exited drop out of the sum, so keep the high water mark
+                    record['cpu_seconds'] = max(record['cpu_seconds'], cpu_seconds)
+            exit_code = popen.poll()
+            if exit_code is None:
+                continue
+            with self.lock:
+                self.runs.pop(pid, None)
+                self.popens.pop(pid, None)
+                record['end'] = time.time()
+                record['wall_time'] = record['end'] - record['start']
+                record['cpu_cores'] = record['cpu_seconds'] / max(record['wall_time'], 1.0)
+                record['rss'] = 0
+                record['exit_code'] = exit_code
+                self.finished_count += 1
+            print(f"EVA run {pid} for {record['token'].split('/')[-1]} finished with exit code {exit_code} "
+                  f"after {record['wall_time']:.0f}s, peak {record['peak_rss'] / 2**30:.1f} GB")
+            self._export(record)
+            for listener in self.listeners:
+                try:
+                    listener(record)
+                except:
+                    print(traceback.format_exc())
+
+    def _export(self, record):
+        if not self.history_file:
+            return
+        try:
+            with open(self.history_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except:
+            print("Couldn't write EVA run history")
+            print(traceback.format_exc())
+
+    def load_history(self, max_runs=5000):
+        """
+        The most recent finished runs from the history file.
+        """
+        if not self.history_file or not os.path.exists(self.history_file):
+            return []
+        history = collections.deque(maxlen=max_runs)
+        with open(self.history_file) as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Half written line from a crash
+                    continue
+        return list(history)
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+                health_monitor.beat('eva_registry')
+            except:
+                print(traceback.format_exc())
+            time.sleep(self.sample_interval)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='eva-reaper', daemon=True)
+            self.thread.start()
+        return self
+
+eva_registry = EvaProcessRegistry()
+
+
+class EvaAdmissionController:
+    """
+    Decides when another EVA run can start. Each token's peak memory and CPU
+    use is estimated from its number of files and its camera, starting from
+    rough defaults and refined (a per-camera least squares fit for memory, a
+    running average for CPU) from what finished runs actually used.
+
+    A run is admitted while fewer than max_concurrent runs are going and the
+    projected memory (what is in use now, plus what running EVAs are still
+    expected to grow by, plus the new run) and CPU stay inside the budgets.
+    When nothing is running the next token always goes, so one run that is
+    bigger than the budget can't block the pipe forever. On pipes that wait
+    for the work drive, nothing more starts while it is saturated (busy for
+    more than disk_busy_limit percent of the time) or writing faster than
+    disk_write_limit kB/s.
+    """
+
+    GIGABYTE = 2 ** 30
+
+    def __init__(self, registry, memory_budget_percent=40, cpu_budget_percent=40, max_concurrent=8,
+                 base_memory=2.0 * GIGABYTE, memory_per_file=0.25 * GIGABYTE, cpu_cores=1.0,
+                 workdrive=None, disk_write_limit=None, disk_busy_limit=None, model_file=None):
+        self.registry = registry
+        self.memory_budget = total_ram * memory_budget_percent / 100
+        self.cpu_budget = (psutil.cpu_count() or 1) * cpu_budget_percent / 100
+        self.max_concurrent = max_concurrent
+        self.default_base_memory = base_memory
+        self.default_memory_per_file = memory_per_file
+        self.default_cpu_cores = cpu_cores
+        self.workdrive = workdrive
+        self.disk_write_limit = disk_write_limit
+        self.disk_busy_limit = disk_busy_limit
+        # Functions giving bytes of RAM spoken for by something other than
+        # EVA, like a calibration cache on tmpfs that may still grow
+        self.memory_reservations = []
+        self.model_file = model_file
+        self.lock = threading.Lock()
+        self.models = {}   # camera -> fit statistics
+        if model_file and os.path.exists(model_file):
+            try:
+                with open(model_file) as f:
+                    self.models = json.load(f)
+            except:
+                print("Couldn't read EVA cost model, starting from defaults")
+                print(traceback.format_exc())
+        else:
+            # No saved model yet, learn what we can from the run history
+            for record in registry.load_history():
+                self.finished(record, save=False)
+        registry.add_listener(self.finished)
+
+    def _model(self, camera):
+        if camera not in self.models:
+            # Two pseudo-runs on the default line, so the first real runs
+            # nudge the fit rather than replace it outright
+            points = [(1, self.default_base_memory + self.default_memory_per_file),
+                      (20, self.default_base_memory + 20 * self.default_memory_per_file)]
+            self.models[camera] = {
+                'n': len(points),
+                'sum_x': sum(x for x, y in points),
+                'sum_y': sum(y for x, y in points),
+                'sum_xx': sum(x * x for x, y in points),
+                'sum_xy': sum(x * y for x, y in points),
+                'cpu_cores': self.default_cpu_cores,
+                'runs': 0,
+            }
+        return self.models[camera]
+
+    def estimate(self, camera, n_files):
+        """
+        (peak memory in bytes, CPU cores) expected for a run.
+        """
+        with self.lock:
+            model = self._model(camera)
+            denominator = model['n'] * model['sum_xx'] - model['sum_x'] ** 2
+            if denominator > 0:
+                slope = (model['n'] * model['sum_xy'] - model['sum_x'] * model['sum_y']) / denominator
+                intercept = (model['sum_y'] - slope * model['sum_x']) / model['n']
+            else:
+                slope, intercept = self.default_memory_per_file, self.default_base_memory
+            memory = intercept + max(slope, 0) * n_files
+            # 20% headroom, and never below a few hundred MB for the interpreter and imports
+            memory = max(memory * 1.2, 0.5 * self.GIGABYTE)
+            return memory, model['cpu_cores']
+
+    def observe(self, camera, n_files, peak_rss, cpu_cores, save=True):
+        """
+        Fold a finished run into the camera's model.
+        """
+        with self.lock:
+            model = self._model(camera)
+            model['n'] += 1
+            model['sum_x'] += n_files
+            model['sum_y'] += peak_rss
+            model['sum_xx'] += n_files * n_files
+            model['sum_xy'] += n_files * peak_rss
+            model['cpu_cores'] += 0.2 * (cpu_cores - model['cpu_cores'])
+            model['runs'] += 1
+            if save and self.model_file:
+                try:
+                    with open(self.model_file + '.tmp', 'w') as f:
+                        json.dump(self.models, f, indent=2)
+                    os.replace(self.model_file + '.tmp', self.model_file)
+                except:
+                    print(traceback.format_exc())
+
+    def finished(self, record, save=True):
+        """
+        Registry listener; runs killed before they were ever sampled teach us nothing.
+        """
+        if record.get('peak_rss') and record.get('cpu_cores') is not None:
+            self.observe(record['camera'], record['n_files'], record['peak_rss'], record['cpu_cores'], save=save)
+
+    def launched(self, popen, token, requested_task_content, **details):
+        camera = eva_token_camera(requested_task_content)
+        memory, cpu_cores = self.estimate(camera, len(requested_task_content))
+        self.registry.launched(popen, token, requested_task_content,
+                               memory_estimate=memory, cpu_estimate=cpu_cores, **details)
+        print(f"EVA run {popen.pid} admitted: {len(requested_task_content)} {camera} files, "
+              f"expecting {memory / self.GIGABYTE:.1f} GB and {cpu_cores:.1f} cores")
+
+    def capacity(self):
+        """
+        How many more runs max_concurrent leaves room for.
+        """
+        return max(self.max_concurrent - len(self.registry.running()), 0)
+
+    def can_admit(self, requested_task_content, snapshot):
+        """
+        Returns (admit, reason).
+        """
+        memory, cpu_cores = self.estimate(eva_token_camera(requested_task_content), len(requested_task_content))
+        runs = self.registry.running()
+        if not runs:
+            return True, 'nothing running'
+        if len(runs) >= self.max_concurrent:
+            return False, f"{len(runs)} EVA runs going already"
+
+        memory_in_use = total_ram - snapshot['memory_available']
+        still_to_grow = sum(max(0, run.get('memory_estimate', 0) - run['rss']) for run in runs)
+        reserved = sum(reservation() for reservation in self.memory_reservations)
+        projected_memory = memory_in_use + still_to_grow + reserved + memory
+        if projected_memory > self.memory_budget:
+            return False, (f"projected memory {projected_memory / self.GIGABYTE:.1f} GB over "
+                           f"budget {self.memory_budget / self.GIGABYTE:.1f} GB")
+
+        cores_in_use = snapshot['cpu_percent'] / 100 * (psutil.cpu_count() or 1)
+        committed_cores = sum(run.get('cpu_estimate', 0) for run in runs)
+        projected_cores = max(cores_in_use, committed_cores) + cpu_cores
+        if projected_cores > self.cpu_budget:
+            return False, f"projected CPU {projected_cores:.1f} cores over budget {self.cpu_budget:.1f}"
+
+        disk = snapshot['disks'].get(self.workdrive)
+        if disk is not None:
+            if self.disk_busy_limit is not None and disk['busy_percent'] > self.disk_busy_limit:
+                return False, f"{self.workdrive} busy {disk['busy_percent']:.0f}% of the time"
+            if self.disk_write_limit is not None and disk['write_kBps'] > self.disk_write_limit:
+                return False, f"{self.workdrive} writing {disk['write_kBps']:.0f} kB/s"
 
-# When we start up, for for the first little while, you do NOT want
-# A thousand tokens to simulataneously start. So for the first half hour,
-# we drip them in a minute at a time. 
-startuptime=time.time()
+        return True, 'within budget'
 
+# Set up in main() once we know the thresholds for this pipe
+eva_admission = None
 
-def reap_zombies():
+def wait_for_eva_admission(requested_task_content):
     """
-    Reap any exited child processes so they don’t become zombies.
+    Hold the main loop until the admission controller lets this token's run start.
+    Ingestion carries on meanwhile, the housekeeping scheduler scans for it.
     """
-    try:
-        # -1 means “any child”; WNOHANG means “don’t block”
-        while True:
-            pid, status = os.waitpid(-1, os.WNOHANG)
-            if pid == 0:
-                break
-    except ChildProcessError:
-        # no child processes at all
-        pass
-    except OSError as e:
-        if e.errno != errno.ECHILD:
-            raise
+    vert_timer=time.time()
+    while True:
+        admitted, reason = eva_admission.can_admit(requested_task_content, resource_sampler.snapshot())
+        if admitted:
+            return
+        if time.time()-vert_timer > 30:
+            print('Waiting: ' + reason + " " + str(datetime.datetime.now()))
+            vert_timer=time.time()
+        time.sleep(1)
+        health_monitor.beat('main_loop')
 
-HEARTBEAT = "thewatcher.hbeat"
+class ArchiveDiskCuller:
+    """
+    Frees space on the archive disk by deleting the oldest files under the
+    cullable directories. Once free space drops below trigger_free_fraction
+    it walks the trees once, heaps every file by mtime and deletes the
+    oldest in one batch until the disk is back up to target_free_fraction.
+    Culling to a bit above the trigger means we aren't back here five
+    minutes later for the next handful of files.
 
-def touch_heartbeat():
-    # create or update the timestamp
-    with open(HEARTBEAT, "a"):
-        os.utime(HEARTBEAT, None)
-    
-    with open("watcher.log", "a") as f:
-        f.write(f"[{datetime.datetime.now():%Y-%m-%d %H:%M:%S}] loop complete\n")
+    Anything under a protected path (calibrations, tokens) is never touched.
+    In the background the cull runs in a niced thread so the main loop
+    carries on launching tokens meanwhile.
+    """
 
-# Start worker threads
-# Function to execute ingester items
-def ingester_worker():
-    while True:
-        ingester_item = ingester_queue.get()  # Blocks if queue is empty
-        if ingester_item is None:
-            break  # Graceful exit signal
-        try:
-            ingester_item()
-        except Exception as e:
-            print(f"Ingesting item raised an exception: {e}")
-        finally:
-            ingester_queue.task_done()
-def start_ptringester_worker_threads():
-    for _ in range(maximum_parallel_ingestions):
-        threading.Thread(target=ingester_worker, daemon=True).start()
+    def __init__(self, archive_base_directory, directories, trigger_free_fraction=0.2,
+                 target_free_fraction=0.25, protected_paths=(), background=True):
+        self.archive_base_directory = archive_base_directory
+        self.directories = [os.path.join(archive_base_directory, d) for d in directories]
+        self.trigger_free_fraction = trigger_free_fraction
+        self.target_free_fraction = max(target_free_fraction, trigger_free_fraction)
+        self.protected_paths = [os.path.normpath(os.path.join(archive_base_directory, p)) for p in protected_paths]
+        self.background = background
+        self.thread = None
 
+    def free_fraction(self):
+        total, used, free = shutil.disk_usage(self.archive_base_directory)
+        return free / total
 
+    def _protected(self, path):
+        path = os.path.normpath(path)
+        return any(path == p or path.startswith(p + os.sep) for p in self.protected_paths)
 
-known_ingester_jsons=[]
+    def _index(self):
+        """
+        (mtime, bytes on disk, path) for every cullable file, from one walk of each tree.
+        """
+        files = []
+        for directory in self.directories:
+            for root, dirs, filenames in os.walk(directory):
+                health_monitor.beat('culler')
+                dirs[:] = [d for d in dirs if not self._protected(os.path.join(root, d))]
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        try:
+                            if not entry.is_file(follow_symlinks=False) or self._protected(entry.path):
+                                continue
+                            st = entry.stat(follow_symlinks=False)
+                        except FileNotFoundError:
+                            continue
+                        files.append((st.st_mtime, st.st_blocks * 512, entry.path))
+        return files
 
-def preexec_limit():
-    # # We need to detach and limit each pipeline call.
-    limit = int(total_ram * 0.8)
+    def cull(self):
+        """
+        Returns the number of bytes freed.
+        """
+        total, used, free = shutil.disk_usage(self.archive_base_directory)
+        if free / total >= self.trigger_free_fraction:
+            return 0
+        bytes_needed = self.target_free_fraction * total - free
+        print(f"Diskspace Free: {free / total * 100:.1f}%, culling {bytes_needed / 2**30:.1f} GB of the oldest files")
 
-    # apply as the address-space limit
-    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        cull_start = time.time()
+        files = self._index()
+        heapq.heapify(files)
+        batch = []
+        batch_bytes = 0
+        while files and batch_bytes < bytes_needed:
+            mtime, size, path = heapq.heappop(files)
+            batch.append(path)
+            batch_bytes += size
 
+        freed = 0
+        deleted = 0
+        for path in batch:
+            health_monitor.beat('culler')
+            try:
+                size = os.lstat(path).st_blocks * 512
+                os.remove(path)
+                freed += size
+                deleted += 1
+            except FileNotFoundError:
+                continue
+            except:
+                print(f"Couldn't delete {path}")
+                print(traceback.format_exc())
+        print(f"Culled {deleted} files, {freed / 2**30:.1f} GB in {time.time() - cull_start:.0f}s. "
+              f"Diskspace Free: {self.free_fraction() * 100:.1f}%")
+        if not batch:
+            print("No files left to cull outside the protected paths.")
+        return freed
 
-def process_ingester_directory(
-    ingester_directory: str,
-    failed_ingestion_directory: str) :
+    def _background_cull(self):
+        try:
+            # Lowest CPU priority for this thread only; Linux takes a thread id here
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        try:
+            self.cull()
+        except:
+            print(traceback.format_exc())
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def check(self):
+        """
+        Cull if the disk is below the trigger, in the background if set up that way.
+        """
+        if self.free_fraction() >= self.trigger_free_fraction:
+            return
+        if not self.background:
+            self.cull()
+        elif self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._background_cull, name='archive-culler', daemon=True)
+            self.thread.start()
+
+class EvaCodeSnapshots:
     """
-    Scan ingester_directory for new .json files, remove any 'variance_' files,
-    and schedule ingestion for the rest.
+    Read-only copies of the EVA code, one per version, keyed by a hash of
+    the contents of EVApipeline.py, modules/ and configs/. Token
+    directories hardlink the two scripts EVA runs from its own directory
+    and symlink modules/ and configs/ to the snapshot, rather than copying
+    the lot for every token. The snapshot is byte-compiled by EVA's own
+    interpreter (eva_python) when it is made, as nothing can write
+    __pycache__ into it afterwards. If that fails the directories are
+    left writable so EVA can still cache its own bytecode.
 
-    Parameters
-    ----------
-    ingester_directory : str
-        Path to the directory containing ingester JSON files (should end with a slash).
-    
-    failed_ingestion_directory : str
-        Path to the directory where failed ingestions should be moved/logged.
-    add_ingester_item : Callable
-        Function that takes a zero-argument callable and schedules it for ingestion.
-    ingest_item : Callable
-        Function that actually performs ingestion; called with [item, ingester_directory, failed_ingestion_directory].
+    Hashing is skipped while the (path, size, mtime) of every file is the
+    same as last time, so an unchanged checkout costs a stat walk per token.
     """
-    print("reading ingester directory")
-    # pattern = os.path.join(ingester_directory, '*.json')
-    # ingester_files_list = glob.glob(pattern)
-
-    # for item in ingester_files_list:
-    #     if item in known_ingester_jsons:
-    #         continue
-
-    #     if 'variance_' in os.path.basename(item):
-    #         print(f"removing variance item: {item}")
-    #         try:
-    #             os.remove(item)
-    #         except OSError:
-    #             pass
-    #         # also remove the unpacked version if it exists
-    #         unpacked = item.replace('.json', '')
-    #         try:
-    #             os.remove(unpacked)
-    #         except OSError:
-    #             pass
-    #     else:
-    #         # schedule this new item for ingestion
-    #         add_ingester_item(lambda item=item: ingest_item([item, ingester_directory, failed_ingestion_directory]))
-    #         known_ingester_jsons.append(item)
-    
-    # # Keep known_ingester_jsons tidy now that any known existing files are in the queue
-    # for item in known_ingester_jsons:
-    #     if not item in ingester_files_list:
-    #         known_ingester_jsons.remove(item)
-    
-    # 1) scan for JSONs and get their mtime efficiently
-    entries = [
-        entry
-        for entry in os.scandir(ingester_directory)
-        if entry.name.endswith('.json')
-    ]
-    
-    # 2) sort ascending by mtime → oldest first
-    entries.sort(key=lambda e: e.stat().st_mtime)
-    
-    # 3) only look at the 500 oldest
-    for entry in entries[:500]:
-        item = entry.path
-    
-        if item in known_ingester_jsons:
-            continue
-    
-        if 'variance_' in entry.name:
-            print(f"removing variance item: {item}")
+
+    CODE_PATHS = ['EVApipeline.py', 'modules', 'configs']
+
+    def __init__(self, cache_directory, keep=5, eva_python=EVA_PYTHON):
+        self.cache_directory = cache_directory
+        self.keep = keep
+        self.eva_python = eva_python
+        self.lock = threading.Lock()
+        self.signatures = {}  # EVA_py_directory -> (stat signature, version)
+        os.makedirs(cache_directory, mode=0o777, exist_ok=True)
+        # Half built snapshots left by a crash
+        for entry in os.scandir(cache_directory):
+            if '.building.' in entry.name:
+                self._remove(entry.path)
+
+    def _code_files(self, EVA_py_directory):
+        files = []
+        for code_path in self.CODE_PATHS:
+            full_path = os.path.join(EVA_py_directory, code_path)
+            if os.path.isfile(full_path):
+                files.append(code_path)
+                continue
+            for root, dirnames, filenames in os.walk(full_path):
+                dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+                for filename in sorted(filenames):
+                    if not filename.endswith('.pyc'):
+                        files.append(os.path.relpath(os.path.join(root, filename), EVA_py_directory))
+        return files
+
+    def version(self, EVA_py_directory):
+        """
+        Content hash of the EVA code as it stands on disk.
+        """
+        files = self._code_files(EVA_py_directory)
+        signature = []
+        for relative_path in files:
+            st = os.stat(os.path.join(EVA_py_directory, relative_path))
+            signature.append((relative_path, st.st_size, st.st_mtime_ns))
+        cached = self.signatures.get(EVA_py_directory)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        for relative_path in files:
+            digest.update(relative_path.encode() + b'\0')
+            with open(os.path.join(EVA_py_directory, relative_path), 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        version = digest.hexdigest()[:16]
+        self.signatures[EVA_py_directory] = (signature, version)
+        return version
+
+    def snapshot(self, EVA_py_directory):
+        """
+        Returns (version, snapshot directory), making the snapshot if this version is new.
+        """
+        with self.lock:
+            version = self.version(EVA_py_directory)
+            snapshot_directory = os.path.join(self.cache_directory, version)
+            if os.path.isdir(snapshot_directory):
+                return version, snapshot_directory
+
+            print("Snapshotting EVA code version " + version)
+            building_directory = snapshot_directory + '.building.' + str(os.getpid())
+            self._remove(building_directory)
+            os.makedirs(building_directory)
+            for relative_path in self._code_files(EVA_py_directory):
+                destination = os.path.join(building_directory, relative_path)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copy2(os.path.join(EVA_py_directory, relative_path), destination)
+            # .pyc files are per interpreter version, so they have to come from the python EVA runs under
             try:
-                os.remove(item)
-            except OSError:
-                pass
-    
-            # also remove the unpacked version if it exists
-            unpacked = item[:-5]  # strip “.json”
+                compiled = subprocess.run([self.eva_python, '-m', 'compileall', '-q', building_directory],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                          timeout=300).returncode == 0
+            except (OSError, subprocess.TimeoutExpired):
+                compiled = False
+            if not compiled:
+                print("Couldn't byte-compile the EVA snapshot with " + self.eva_python + ", leaving it writable")
+            self._make_read_only(building_directory, directories=compiled)
+            os.rename(building_directory, snapshot_directory)
+            self._prune(keep_version=version)
+            return version, snapshot_directory
+
+    def link_into(self, snapshot_directory, token_temp_directory):
+        """
+        Lay the snapshot out in a token directory the way the old per-token copy did.
+        """
+        for source, name in [('EVApipeline.py', 'EVApipeline.py'),
+                             ('modules/archive_file_input_classes.py', 'archive_file_input_classes.py')]:
+            destination = os.path.join(token_temp_directory, name)
             try:
-                os.remove(unpacked)
+                os.link(os.path.join(snapshot_directory, source), destination)
             except OSError:
-                pass
-    
+                # Cache on a different filesystem
+                shutil.copy(os.path.join(snapshot_directory, source), destination)
+        for name in ['modules', 'configs']:
+            os.symlink(os.path.join(snapshot_directory, name), os.path.join(token_temp_directory, name))
+
+    def _make_read_only(self, directory, directories=True):
+        for root, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                os.chmod(os.path.join(root, filename), 0o444)
+        if not directories:
+            return
+        for root, dirnames, filenames in os.walk(directory, topdown=False):
+            os.chmod(root, 0o555)
+
+    def _remove(self, directory):
+        if not os.path.isdir(directory):
+            return
+        for root, dirnames, filenames in os.walk(directory):
+            os.chmod(root, 0o755)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def _prune(self, keep_version):
+        """
+        Drop all but the newest few snapshots, leaving any a running EVA is still using.
+        """
+        in_use = {run.get('eva_code_version') for run in eva_registry.running()}
+        in_use.add(keep_version)
+        snapshots = []
+        for entry in os.scandir(self.cache_directory):
+            if entry.is_dir(follow_symlinks=False) and '.' not in entry.name:
+                snapshots.append((entry.stat().st_mtime, entry.name))
+        snapshots.sort(reverse=True)
+        for mtime, name in snapshots[self.keep:]:
+            if name not in in_use:
+                print("Removing old EVA code snapshot " + name)
+                self._remove(os.path.join(self.cache_directory, name))
+
+
+CALIBRATION_TYPE_PATTERNS = [
+    ('bias', re.compile(r'(bias|-BI\d\d)', re.IGNORECASE)),
+    ('dark', re.compile(r'(dark|-DK\d\d)', re.IGNORECASE)),
+    ('flat', re.compile(r'(flat|-FL\d\d|-SF\d\d)', re.IGNORECASE)),
+]
+CALIBRATION_DATE_PATTERN = re.compile(r'(20\d{6})')
+
+class CalibrationCache:
+    """
+    Index of the calibration masters in localptrarchive/calibrations by
+    telescope, camera, type and date, plus uncompressed copies of the
+    newest masters on fast local disk.
+
+    EVA runs get the cache directory and their camera's part of the index
+    through info_for_EVA, so concurrent runs for the same camera memory map
+    the same files and share the page cache rather than each reading and
+    holding a private copy of the same arrays.
+
+    Prefetching happens on a background thread when a camera's token is
+    launched; anything not cached yet is still listed with its source path.
+    The least recently used copies go when the cache is over max_bytes,
+    except those listed for a run that hasn't finished yet: prepare() pins
+    them to the token and finished() lets them go when its run exits.
+
+    The cache can live in /dev/shm, but that is RAM, so memory_headroom()
+    tells the EVA admission controller how much more it may take up.
+    """
+
+    COMPRESSED_SUFFIXES = ('.fz', '.gz', '.bz2')
+
+    def __init__(self, calibrations_directory, cache_directory, max_bytes=8 * 2**30,
+                 per_type=2, refresh_period=300):
+        self.calibrations_directory = calibrations_directory
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        # How many of the newest masters of each type to keep cached per camera
+        self.per_type = per_type
+        self.refresh_period = refresh_period
+        self.lock = threading.Lock()
+        self.index = {}     # (telescope, camera, type) -> [(date, source path)], newest first
+        self.cached = {}    # source path -> {'path', 'size', 'source_mtime', 'last_used'}
+        self.pinned = {}    # token -> (time pinned, {source path})
+        self.requests = queue.Queue()
+        self.last_refresh = 0
+        os.makedirs(cache_directory, mode=0o777, exist_ok=True)
+        self.in_memory = self.on_tmpfs(cache_directory)
+        self._adopt_existing()
+
+    @staticmethod
+    def classify(path):
+        """
+        (telescope, camera, type, date) for a calibration master, or None if it doesn't look like one.
+        """
+        name = os.path.basename(path)
+        try:
+            telescope, camera, run_date = parse_token_filename(name)
+        except ValueError:
+            return None
+        for calibration_type, pattern in CALIBRATION_TYPE_PATTERNS:
+            if pattern.search(name):
+                break
         else:
-            # schedule this new item for ingestion
-            add_ingester_item(lambda item=item: ingest_item([item,
-                                                              ingester_directory,
-                                                              failed_ingestion_directory]))
-            known_ingester_jsons.append(item)
-    
-    # 4) clean up known_ingester_jsons in one go
-    known_ingester_jsons[:] = [
-        item for item in known_ingester_jsons
-        if os.path.exists(item)
-    ]
+            return None
+        date = CALIBRATION_DATE_PATTERN.search(name) or CALIBRATION_DATE_PATTERN.search(path)
+        if date:
+            date = date.group(1)
+        else:
+            date = datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y%m%d')
+        return telescope, camera, calibration_type, date
 
-# Function to add ingester items to the queue
-def add_ingester_item(item):
-    ingester_queue.put(item)
+    @staticmethod
+    def on_tmpfs(path):
+        """
+        Whether path is on a RAM backed filesystem.
+        """
+        path = os.path.realpath(path)
+        mountpoint, fstype = '', ''
+        for partition in psutil.disk_partitions(all=True):
+            if (path == partition.mountpoint or path.startswith(partition.mountpoint.rstrip('/') + '/')) \
+                    and len(partition.mountpoint) > len(mountpoint):
+                mountpoint, fstype = partition.mountpoint, partition.fstype
+        return fstype in ('tmpfs', 'ramfs')
 
-def ingest_item(item):
-    file, ingester_directory, failed_ingestion_directory = item
-    print ("Starting ingestion of " + str(file.replace('.pickle','').replace(ingester_directory,'')))
-    
-    try:
-    
-        tempfilename=str(file.replace('.json',''))
-        # An empty sek, sea or psx file is actually size 50... so consider any file bigger than that. 
-        if os.path.exists(tempfilename):
-            if os.path.getsize(tempfilename) > 51:
-                with open(file, 'r') as tempfile:
-                    headerdict = json.load(tempfile)             
-                
-                with open(tempfilename, "rb") as fileobj:
-                    try:
-                        if not 'thumbnail' in tempfilename:
-                            
-                            record=validate_fits_and_create_archive_record(fileobj, file_metadata=headerdict)
-                            time.sleep(random.expovariate(RATE_PER_THREAD))
-                            s3_version=upload_file_to_file_store(fileobj, file_metadata=headerdict)
-                            time.sleep(random.expovariate(RATE_PER_THREAD))
-                            ingest_archive_record(s3_version,record)
-                            time.sleep(random.expovariate(RATE_PER_THREAD))
-                            try:
-                                os.remove(file)
-                            except:
-                                print(traceback.format_exc())
-                            try:
-                                os.remove(tempfilename)
-                            except:
-                                print(traceback.format_exc())
-                        else:
-                            print ("OCS Ingester doesn't like thumbnail image: " + str(tempfilename))
-                            # if dst exists, delete it                            
-                            try:
-                                if os.path.exists(failed_ingestion_directory +'/'+file.split('/')[-1]):
-                                    os.remove(failed_ingestion_directory +'/'+file.split('/')[-1])
-                                shutil.move(file, failed_ingestion_directory+'/'+file.split('/')[-1])
-                                try:
-                                    os.remove(file)
-                                except:
-                                    pass
-                            except:
-                                print(traceback.format_exc())                 
-                            
-                            try:
-                                if os.path.exists(failed_ingestion_directory +'/'+tempfilename.split('/')[-1]):
-                                    os.remove(failed_ingestion_directory +'/'+tempfilename.split('/')[-1])                              
-                                shutil.move(tempfilename, failed_ingestion_directory+'/'+tempfilename.split('/')[-1])
-                                try:
-                                    os.remove(tempfilename)
-                                except:
-                                    pass
-                            except:
-                                print(traceback.format_exc())
-                    except:
-                       
-                        if 'thumbnail' in tempfilename:
-                            print ("Problematic thumbnail image: " + str(tempfilename))
-                            # if dst exists, delete it                            
-                            try:
-                                if os.path.exists(failed_ingestion_directory +'/'+file.split('/')[-1]):
-                                    os.remove(failed_ingestion_directory +'/'+file.split('/')[-1])
-                                shutil.move(file, failed_ingestion_directory+'/'+file.split('/')[-1])
-                                try:
-                                    os.remove(file)
-                                except:
-                                    pass
-                            except:
-                                print(traceback.format_exc())                 
-                            
-                            try:
-                                if os.path.exists(failed_ingestion_directory +'/'+tempfilename.split('/')[-1]):
-                                    os.remove(failed_ingestion_directory +'/'+tempfilename.split('/')[-1])                              
-                                shutil.move(tempfilename, failed_ingestion_directory+'/'+tempfilename.split('/')[-1])
-                                try:
-                                    os.remove(tempfilename)
-                                except:
-                                    pass
-                            except:
-                                print(traceback.format_exc())
-                        
-                        elif ('Version with this md5 already exists') in traceback.format_exc() and not 'thumbnail' in tempfilename:
-                            print ("Version with this md5 already exists: " + str(tempfilename))
-                            try:
-                                os.remove(file)
-                            except:
-                                print(traceback.format_exc())
-                            try:
-                                os.remove(tempfilename)
-                            except:
-                                print(traceback.format_exc())
-                        elif ('502 Server Error') in traceback.format_exc() and not 'thumbnail' in tempfilename:
-                            print ("502 Server Error. Backing off and waiting. Putting file back into queue: "+ str(tempfilename))
-                            time.sleep(1)
-                            add_ingester_item(lambda item=file: ingest_item([item, ingester_directory, failed_ingestion_directory]))
-                        elif ('500 Server Error') in traceback.format_exc() and not 'thumbnail' in tempfilename:
-                            print ("500 Server Error. Backing off and waiting. Putting file back into queue: "+ str(tempfilename))
-                            time.sleep(1)
-                            add_ingester_item(lambda item=file: ingest_item([item, ingester_directory, failed_ingestion_directory]))
-                        elif ('400 Client Error') in traceback.format_exc() and not 'thumbnail' in tempfilename:
-                            print ("400 Server Error. Copying file to fails directory")
-                                                                                   
-                            # if dst exists, delete it                            
-                            try:
-                                if os.path.exists(failed_ingestion_directory +'/'+file.split('/')[-1]):
-                                    os.remove(failed_ingestion_directory +'/'+file.split('/')[-1])
-                                shutil.move(file, failed_ingestion_directory+'/'+file.split('/')[-1])
-                                try:
-                                    os.remove(file)
-                                except:
-                                    pass
-                            except:
-                                print(traceback.format_exc())                 
-                            
-                            try:
-                                if os.path.exists(failed_ingestion_directory +'/'+tempfilename.split('/')[-1]):
-                                    os.remove(failed_ingestion_directory +'/'+tempfilename.split('/')[-1])                              
-                                shutil.move(tempfilename, failed_ingestion_directory+'/'+tempfilename.split('/')[-1])
-                                try:
-                                    os.remove(tempfilename)
-                                except:
-                                    pass
-                            except:
-                                print(traceback.format_exc())
-                            
-                        elif ('Max retries exceeded') in traceback.format_exc() and not 'thumbnail' in tempfilename:
-                            print ("Max retries error. Backing off and waiting. Putting file back into queue: "+ str(tempfilename))
-                            time.sleep(1)
-                            add_ingester_item(lambda item=file: ingest_item([item, ingester_directory, failed_ingestion_directory]))
-            else:
-                print (tempfilename + " too small, skipping ingestion.")
+    def memory_headroom(self):
+        """
+        Bytes of RAM the cache may still grow into, 0 unless it is on tmpfs.
+        """
+        if not self.in_memory:
+            return 0
+        with self.lock:
+            return max(0, self.max_bytes - sum(entry['size'] for entry in self.cached.values()))
+
+    def _cache_name(self, source):
+        name = os.path.basename(source)
+        for suffix in self.COMPRESSED_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        return hashlib.sha1(source.encode()).hexdigest()[:12] + '-' + name
+
+    def _adopt_existing(self):
+        """
+        Pick up copies a previous watcher left behind.
+        """
+        manifest_path = os.path.join(self.cache_directory, 'manifest.json')
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            manifest = {}
+        for source, entry in manifest.items():
+            if os.path.exists(entry['path']):
+                self.cached[source] = entry
+
+    def _save_manifest(self):
+        manifest_path = os.path.join(self.cache_directory, 'manifest.json')
+        with self.lock:
+            manifest = dict(self.cached)
+            index = {'/'.join(key): entries for key, entries in self.index.items()}
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        with open(os.path.join(self.cache_directory, 'index.json.tmp'), 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(os.path.join(self.cache_directory, 'index.json.tmp'), os.path.join(self.cache_directory, 'index.json'))
+
+    def refresh(self):
+        """
+        Rebuild the index from a walk of the calibrations directory.
+        """
+        index = collections.defaultdict(list)
+        for root, dirs, files in os.walk(self.calibrations_directory):
+            for name in files:
+                path = os.path.join(root, name)
                 try:
-                    os.remove(file)
-                    os.remove(tempfilename)
-                except:
-                    print(traceback.format_exc())
-        else:
-            print (tempfilename + " not found, skipping ingestion.")
+                    key = self.classify(path)
+                except OSError:
+                    continue
+                if key is not None:
+                    index[key[:3]].append((key[3], path))
+        for entries in index.values():
+            entries.sort(reverse=True)
+        with self.lock:
+            self.index = dict(index)
+            self.last_refresh = time.time()
+
+    def _decompress(self, source, destination):
+        """
+        Write an uncompressed copy of source to destination.
+        """
+        if source.endswith('.gz'):
+            with gzip.open(source, 'rb') as fin, open(destination, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+        elif source.endswith('.bz2'):
+            with bz2.open(source, 'rb') as fin, open(destination, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+        elif source.endswith('.fz'):
+            # Tile compressed, only astropy can unpack it. EVA has it, the watcher may not.
             try:
-                os.remove(file)
-                os.remove(tempfilename)
-            except:
-                print(traceback.format_exc())
-        
-    except:
-        print(traceback.format_exc())
-    
-def wait_for_resources(memory_fraction=40, cpu_fraction=40, wait_for_harddrive=False, workdrive='none', ingester_directory='none',failed_ingestion_directory='none', ingest_to_ptrarchive=False):
-    
-    # A delaying mechanism that will random push itself forward in the future
-    # but at some point... the show must go on! So it will release itself. 
-    # It is possible for things to stall for hours if it just waits forever
-    # But if it barges itself into the proceedings it can at least keep moving
-    # and get there in the end. 
-        
-    random_timeout_period= random.randint(1800, 7200)
-    
-    file_wait_timeout_timer=time.time()
-    vert_timer=time.time()
-    if wait_for_harddrive:
-        
-        cpu_usage=psutil.cpu_percent(interval=1)
-        memory_usage=psutil.virtual_memory().percent
-        hard_drive_usage=hard_drive_activity(workdrive)
-        
-        
-        while ((memory_usage > memory_fraction) or (cpu_usage > cpu_fraction) or hard_drive_usage > 10000) and (time.time()-file_wait_timeout_timer < random_timeout_period) :       
-            
-            if time.time()-vert_timer > 30:
-                print('Waiting: Mem: ' + str(memory_usage) + ' CPU: '+ str(cpu_usage) + "HD: "+str(hard_drive_usage) + " " + str(datetime.datetime.now()))
-                vert_timer=time.time()
-                # We want to still be ingesting stuff while we are waiting!
+                from astropy.io import fits
+            except ImportError:
+                shutil.copyfile(source, destination)
+                return
+            # Same HDU layout as the original, just with the images uncompressed
+            with fits.open(source) as hdul:
+                hdus = [fits.PrimaryHDU(data=hdul[0].data, header=hdul[0].header)]
+                for hdu in hdul[1:]:
+                    if isinstance(hdu, fits.CompImageHDU):
+                        hdus.append(fits.ImageHDU(data=hdu.data, header=hdu.header))
+                    else:
+                        hdus.append(hdu.copy())
+                fits.HDUList(hdus).writeto(destination, overwrite=True)
+        else:
+            shutil.copyfile(source, destination)
+
+    def _prefetch(self, source):
+        try:
+            st = os.stat(source)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            entry = self.cached.get(source)
+            if entry is not None and entry['source_mtime'] == st.st_mtime and os.path.exists(entry['path']):
+                entry['last_used'] = time.time()
+                return
+        destination = os.path.join(self.cache_directory, self._cache_name(source))
+        building = destination + '.tmp'
+        self._decompress(source, building)
+        os.chmod(building, 0o444)
+        os.replace(building, destination)
+        with self.lock:
+            self.cached[source] = {
+                'path': destination,
+                'size': os.path.getsize(destination),
+                'source_mtime': st.st_mtime,
+                'last_used': time.time(),
+            }
+
+    def finished(self, record):
+        """
+        EVA registry listener, the run's copies can go now.
+        """
+        with self.lock:
+            self.pinned.pop(record['token'], None)
+
+    def _evict(self):
+        running = {run['token'] for run in eva_registry.running()}
+        with self.lock:
+            # Pins for a token whose run never got going (launch failed) don't last forever
+            for token, (pinned_at, sources) in list(self.pinned.items()):
+                if token not in running and time.time() - pinned_at > 600:
+                    del self.pinned[token]
+            in_use = set().union(*(sources for pinned_at, sources in self.pinned.values()))
+            total = sum(entry['size'] for entry in self.cached.values())
+            for source, entry in sorted(self.cached.items(), key=lambda item: item[1]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if source in in_use:
+                    continue
                 try:
-                    if ingest_to_ptrarchive:
-                        process_ingester_directory(ingester_directory,failed_ingestion_directory)
-                except:
-                    print ("Failed ingester directory")
-            time.sleep(1)
-            cpu_usage=psutil.cpu_percent(interval=1)
-            memory_usage=psutil.virtual_memory().percent
-            hard_drive_usage=hard_drive_activity(workdrive)
-            
-            touch_heartbeat()
-            
-    else:
-        cpu_usage=psutil.cpu_percent(interval=1)
-        memory_usage=psutil.virtual_memory().percent
-        while (memory_usage > memory_fraction or cpu_usage > cpu_fraction) and (time.time()-file_wait_timeout_timer < random_timeout_period):       
-            
-            if time.time()-vert_timer > 30:
-                print('Waiting: Mem: ' + str(memory_usage) + ' CPU: '+ str(cpu_usage)+ " " + str(datetime.datetime.now()))
-                # We want to still be ingesting stuff while we are waiting!
+                    # Runs that already mapped it keep their mapping
+                    os.remove(entry['path'])
+                except FileNotFoundError:
+                    pass
+                total -= entry['size']
+                del self.cached[source]
+
+    def camera_index(self, telescope, camera):
+        """
+        {type: [{'date', 'source', 'cached'}]} for one camera, newest first.
+        cached is None for masters that haven't been prefetched.
+        """
+        camera_index = {}
+        with self.lock:
+            for (index_telescope, index_camera, calibration_type), entries in self.index.items():
+                if index_telescope != telescope or index_camera != camera:
+                    continue
+                camera_index[calibration_type] = []
+                for date, source in entries:
+                    entry = self.cached.get(source)
+                    if entry is not None:
+                        entry['last_used'] = time.time()
+                    camera_index[calibration_type].append({
+                        'date': date,
+                        'source': source,
+                        'cached': entry['path'] if entry is not None else None,
+                    })
+        return camera_index
+
+    def prepare(self, token, telescope, camera):
+        """
+        The camera's index for token's info_for_EVA, and a nudge to get its
+        newest masters cached. The copies it lists stay until the run is over.
+        """
+        self.requests.put((telescope, camera))
+        camera_index = self.camera_index(telescope, camera)
+        with self.lock:
+            self.pinned[token] = (time.time(), {entry['source']
+                                                for entries in camera_index.values()
+                                                for entry in entries if entry['cached'] is not None})
+        return camera_index
+
+    def _run(self):
+        while True:
+            try:
                 try:
-                    if ingest_to_ptrarchive:
-                        process_ingester_directory(ingester_directory,failed_ingestion_directory)
-                except:
-                    print ("Failed ingester directory")
-                vert_timer=time.time()
-            time.sleep(1)
-            cpu_usage=psutil.cpu_percent(interval=1)
-            memory_usage=psutil.virtual_memory().percent
-            touch_heartbeat()
-
-def hard_drive_activity(drive):
-    output = subprocess.check_output(["iostat","-y" ,"5","1","|","grep",drive])#, shell=True)
-    output = str(output).split(drive)[-1].split(' ')
-    while("" in output):
-         output.remove("")
-    #print ("Hard Drive activity at " + str(drive) + " : " + str(float(output[2])))
-    return float(output[2])
-     
-def find_and_delete_oldest_file(directory):
-    oldest_file = None
-    oldest_time = float('inf')
-
-    # Use scandir for faster traversal
-    for root, dirs, files in os.walk(directory):
-        with os.scandir(root) as entries:
-            for entry in entries:
-                if entry.is_file():
-                    try:
-                        # Get the file's modification time directly from DirEntry
-                        file_time = entry.stat().st_mtime
+                    telescope, camera = self.requests.get(timeout=self.refresh_period)
+                except queue.Empty:
+                    telescope = camera = None
+                if time.time() - self.last_refresh > self.refresh_period:
+                    self.refresh()
+                if telescope is not None:
+                    with self.lock:
+                        sources = [source
+                                   for (t, c, calibration_type), entries in self.index.items()
+                                   if t == telescope and c == camera
+                                   # Oldest first, so the newest are the last to be evicted
+                                   for date, source in reversed(entries[:self.per_type])]
+                    for source in sources:
+                        self._prefetch(source)
+                    self._evict()
+                self._save_manifest()
+            except Exception:
+                print("Calibration cache hit a snag")
+                print(traceback.format_exc())
+                time.sleep(5)
+
+    def start(self):
+        self.refresh()
+        threading.Thread(target=self._run, daemon=True, name='calibration_cache').start()
+        return self
 
-                        # Check if this is the oldest file
-                        if file_time < oldest_time:
-                            oldest_time = file_time
-                            oldest_file = entry.path
-                    except FileNotFoundError:
-                        continue
 
-    # Delete the oldest file
-    if oldest_file:
-        print(f"Oldest file: {oldest_file}")
-        os.remove(oldest_file)
-        print(f"Deleted: {oldest_file}")
-    else:
-        print("No files found in the directory.")
-    
 def launch_eva_pipeline(token: str,
                         requested_task_content: list[str],
                         processing_temp_directory: str,
                         pipeid: str,
                         EVA_py_directory: str,
                         local_calibrations_directory: str,
-                        site_name: str):
+                        site_name: str,
+                        code_snapshots: EvaCodeSnapshots = None,
+                        original_token_files: list[str] = None,
+                        calibration_cache: CalibrationCache = None):
     """
-    Prepare a per-token temp dir, dump info_for_EVA.json, copy code, write a runner script,
+    Prepare a per-token temp dir, dump info_for_EVA.json, link (or copy) code, write a runner script,
     and launch EVApipeline.py in its own process group.
     Returns (subprocess.Popen, info_for_EVA dict).
     """
@@ -481,38 +3620,63 @@ def launch_eva_pipeline(token: str,
         pass
 
     # Build info dict
-    first_file = requested_task_content[0]
-    parts = first_file.split('-')
+    telescope, camera_name, run_date = parse_token_filename(requested_task_content[0])
     info_for_EVA = {
         'filter': 'na',
         'calib_directory': local_calibrations_directory,
         'files_to_process': requested_task_content,
-        'run_date': parts[2],
-        'telescope': parts[0],
-        'camera_name': parts[1].split('_')[0],
+        'run_date': run_date,
+        'telescope': telescope,
+        'camera_name': camera_name,
         'is_osc': 'mono',
         'pipeid': pipeid,
         'token_temp_directory': str(token_temp_directory).replace('//','/'),
         'original_token_file': str(token).replace('//','/'),
+        # Every token this run covers, when several were merged into one run
+        'original_token_files': [str(t).replace('//','/') for t in (original_token_files or [token])],
+        'calibration_cache_directory': None,
+        'calibration_cache_index': {},
         'file_location_expected': 'ptrarchive'
     }
 
+    # Shared read-only snapshot of this version of the code, if we have a cache
+    eva_code_version = None
+    if code_snapshots is not None:
+        try:
+            eva_code_version, snapshot_directory = code_snapshots.snapshot(EVA_py_directory)
+        except:
+            print("Couldn't snapshot the EVA code, copying it instead")
+            print(traceback.format_exc())
+    info_for_EVA['eva_code_version'] = eva_code_version
+
+    # Masters shared with the other runs for this camera, memory mappable
+    if calibration_cache is not None:
+        try:
+            info_for_EVA['calibration_cache_index'] = calibration_cache.prepare(token.split('/')[-1], info_for_EVA['telescope'], info_for_EVA['camera_name'])
+            info_for_EVA['calibration_cache_directory'] = calibration_cache.cache_directory
+        except:
+            print("Couldn't get the calibration cache index")
+            print(traceback.format_exc())
+
     # Dump settings
     info_path = os.path.join(token_temp_directory, 'info_for_eva.json')
     with open(info_path, 'w') as f:
         json.dump(info_for_EVA, f, indent=2)
 
     # 4) Copy pipeline code & resources
-    shutil.copy(os.path.join(EVA_py_directory, 'EVApipeline.py'),
-                token_temp_directory)
-    shutil.copy(os.path.join(EVA_py_directory, 'modules/archive_file_input_classes.py'),
-                token_temp_directory)
-    shutil.copytree(os.path.join(EVA_py_directory, 'modules'),
-                    os.path.join(token_temp_directory, 'modules'),
-                    dirs_exist_ok=True)
-    shutil.copytree(os.path.join(EVA_py_directory, 'configs'),
-                    os.path.join(token_temp_directory, 'configs'),
-                    dirs_exist_ok=True)
+    if eva_code_version is not None:
+        code_snapshots.link_into(snapshot_directory, token_temp_directory)
+    else:
+        shutil.copy(os.path.join(EVA_py_directory, 'EVApipeline.py'),
+                    token_temp_directory)
+        shutil.copy(os.path.join(EVA_py_directory, 'modules/archive_file_input_classes.py'),
+                    token_temp_directory)
+        shutil.copytree(os.path.join(EVA_py_directory, 'modules'),
+                        os.path.join(token_temp_directory, 'modules'),
+                        dirs_exist_ok=True)
+        shutil.copytree(os.path.join(EVA_py_directory, 'configs'),
+                        os.path.join(token_temp_directory, 'configs'),
+                        dirs_exist_ok=True)
 
     # Write the bash runner
     runner_path = os.path.join(token_temp_directory, 'EVAscriptrunner')
@@ -523,7 +3687,7 @@ def launch_eva_pipeline(token: str,
         # get the directory this script lives in, and cd there:
         f.write('SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" >/dev/null 2>&1 && pwd)"\n')
         f.write('cd "$SCRIPT_DIR"\n')
-        f.write('/usr/bin/python3 EVApipeline.py na na generic na na na '+str(pipeid)+' >> log.txt\n')
+        f.write(EVA_PYTHON + ' EVApipeline.py na na generic na na na '+str(pipeid)+' >> log.txt\n')
     os.chmod(runner_path, 0o755)
     
     
@@ -535,17 +3699,11 @@ def launch_eva_pipeline(token: str,
         preexec_fn=preexec_limit,     
         start_new_session=True       
     )
-    
-    if (time.time() - startuptime) < 1800:
-        time.sleep(60)
-    elif (time.time() - startuptime) < 3600:
-        time.sleep(30)
-    elif (time.time() - startuptime) < 7800: # speed it up in the second half hour
-        time.sleep(10)
 
     return popen, info_for_EVA
 
 def main():
+    global ingestion_journal, ingester_directory_watcher, archive_http_session, archive_record_batcher, eva_admission
 
     touch_heartbeat()    
 
@@ -582,16 +3740,36 @@ def main():
     with open(config_path, 'r') as f:
         config = json.load(f)
     
+    # Keep the heartbeat going through start up, which can take a while on big trees
+    health_monitor.status_file = config.get('health_status_file', 'thewatcher.status.json')
+    health_monitor.register('startup', config.get('startup_stall_seconds', 1800))
+    health_monitor.start()
+    
     pipe_id = config['pipe_id'] 
 
-    pipe_queue_timer=time.time() - 300
-
     cpu_frac = config['cpu_threshold']
     mem_frac = config['memory_threshold']
     #breakpoint()
     if config["ingest_to_ptrarchive"]:
         # Start workers
-        start_ptringester_worker_threads()
+        engine = config.get('ingestion_engine', 'staged')
+        # One pool of keep-alive connections for the archive record posts
+        archive_http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=maximum_parallel_ingestions)
+        archive_http_session.mount('https://', adapter)
+        archive_http_session.mount('http://', adapter)
+        start_ptringester_worker_threads(engine)
+        # Post archive records in bulk rather than one request per frame. The
+        # batcher finds out from the first bulk post whether the archive takes them.
+        if config.get('batch_archive_records', False):
+            if engine == 'staged':
+                archive_record_batcher = ArchiveRecordBatcher(
+                    batch_size=config.get('archive_record_batch_size', 50),
+                    max_latency=config.get('archive_record_batch_latency', 5.0)).start()
+            else:
+                # Each thread would sit waiting on its own record, so a batch
+                # could never hold more than the thread count
+                print("batch_archive_records needs the staged ingestion engine, posting records one at a time")
 
     if pipe_id=='arolinux':
         with open('/home/mrcpipeline/.bash_profile') as f:
@@ -658,6 +3836,25 @@ def main():
         #breakpoint()
     
     
+    # Keep an eye on CPU, memory and the work drive in the background
+    resource_sampler.start([workdrive])
+    
+    # Track every EVA run we launch, reaping them as they finish
+    eva_registry.history_file = config.get('eva_run_history_file', os.path.join(script_dir, 'eva_run_history.jsonl'))
+    eva_registry.start()
+    
+    # Admits EVA runs while their projected memory and CPU fit in the budget
+    eva_admission = EvaAdmissionController(
+        eva_registry,
+        memory_budget_percent=mem_frac,
+        cpu_budget_percent=cpu_frac,
+        max_concurrent=config.get('max_concurrent_eva_runs', 8),
+        workdrive=workdrive,
+        disk_write_limit=10000 if wait_for_harddrive else None,
+        disk_busy_limit=config.get('eva_disk_busy_percent', 90) if wait_for_harddrive else None,
+        model_file=config.get('eva_cost_model_file', os.path.join(script_dir, 'eva_cost_model.json'))
+    )
+    
     processing_temp_directory=archive_base_directory + '/realtime_temp/'
     
     if os.path.isdir(processing_temp_directory):
@@ -689,168 +3886,178 @@ def main():
     for d in dirs:
         os.makedirs(d, mode=0o777, exist_ok=True)
     
-    # Array of completed tokens
-    completed_tokens=[]
+    # One read-only copy of the EVA code per version, shared by every token
+    eva_code_snapshots = None
+    if config.get('eva_code_cache', True):
+        eva_code_snapshots = EvaCodeSnapshots(
+            config.get('eva_code_cache_directory', f"{base}/eva_code_cache"),
+            keep=config.get('eva_code_cache_keep', 5)
+        )
+    
+    # Uncompressed copies of the newest calibration masters on fast storage,
+    # shared by every run. Only worth it on a fast local disk (or a small
+    # tmpfs) rather than the archive array the masters come from, so it is
+    # off until calibration_cache_directory says where that is.
+    calibration_cache = None
+    calibration_cache_directory = config.get('calibration_cache_directory')
+    if calibration_cache_directory and config.get('calibration_cache', True):
+        # In RAM it comes out of the EVA memory budget, so keep it small there
+        default_max_gb = 2 if CalibrationCache.on_tmpfs(os.path.dirname(calibration_cache_directory.rstrip('/'))) else 8
+        try:
+            calibration_cache = CalibrationCache(
+                local_calibrations_directory,
+                calibration_cache_directory,
+                max_bytes=config.get('calibration_cache_max_gb', default_max_gb) * 2**30,
+                per_type=config.get('calibration_cache_per_type', 2)
+            ).start()
+            eva_registry.add_listener(calibration_cache.finished)
+            eva_admission.memory_reservations.append(calibration_cache.memory_headroom)
+        except:
+            print("Couldn't start the calibration cache, EVA will read the calibrations directory itself")
+            print(traceback.format_exc())
+    
+    # Local journal of how far each ingester file has got, so a restart
+    # carries on rather than re-validating and re-uploading everything
+    ingestion_journal = IngestionJournal(config.get('ingestion_journal', os.path.join(script_dir, 'ingestion_journal.sqlite3')))
+    if config.get('content_index_seed_file'):
+        try:
+            print ("Seeded content index with " + str(ingestion_journal.seed_ingested(config['content_index_seed_file'])) + " entries")
+        except:
+            print ("Couldn't seed the content index")
+            print(traceback.format_exc())
+    ingestion_retry_scheduler.max_attempts = config.get('ingestion_max_attempts', ingestion_retry_scheduler.max_attempts)
+    
+    # "inotify" keeps an event driven index of the ingester directory,
+    # "scan" is the old rescan-the-lot-every-pass behaviour.
+    if config["ingest_to_ptrarchive"] and config.get('ingester_watch_mode', 'inotify') == 'inotify':
+        ingester_directory_watcher = IngesterDirectoryWatcher(
+            ingester_directory,
+            failed_ingestion_directory,
+            reconcile_period=config.get('ingester_reconcile_period', 600)
+        )
+        ingester_directory_watcher.start()
+    
+    # Deletes the oldest reduced files and local archive frames when the disk fills up
+    archive_culler = ArchiveDiskCuller(
+        archive_base_directory,
+        ['localptrarchive', 'EVAreducedfiles'],
+        trigger_free_fraction=config.get('cull_trigger_free_fraction', 0.2),
+        target_free_fraction=config.get('cull_target_free_fraction', 0.25),
+        protected_paths=config.get('cull_protected_paths', ['localptrarchive/calibrations', 'localptrarchive/tokens',
+                                                            'localptrarchive/pipequeue_tokens']),
+        background=config.get('cull_in_background', True)
+    )
+    
+    # Tokens waiting to be run, oldest first
+    token_index = TokenIndex(
+        monitor_directories[0],
+        reconcile_period=config.get('token_reconcile_period', 600)
+    ).start()
+    
+    # Optionally merge small tokens for the same telescope, camera and night into one run
+    token_coalescer = None
+    if config.get('coalesce_tokens', False):
+        token_coalescer = TokenCoalescer(
+            token_index,
+            max_files=config.get('coalesce_max_files', 200),
+            max_delay=config.get('coalesce_max_delay', 60)
+        )
+        eva_registry.add_listener(token_coalescer.finished)
+    
+    # Share the night's work with the other pipes through the PIPE queue
+    pipe_queue = None
+    if config.get('pipe_queue_enabled', False):
+        pipe_queue = PipeQueueClient(
+            config.get('pipe_queue_url', 'https://api.photonranch.org/api/pipe/queue'),
+            config.get('pipe_queue_name', 'lcs1'),
+            worker=evapipeid,
+            leased_token_directory=f"{base}/localptrarchive/pipequeue_tokens",
+            visibility_timeout=config.get('pipe_queue_visibility_timeout', 600),
+            poll_period=config.get('pipe_queue_poll_period', 30),
+            long_poll=config.get('pipe_queue_long_poll', 20),
+            auth_token=config.get('pipe_queue_auth_token')
+        ).start()
+        eva_registry.add_listener(pipe_queue.finished)
+        pipe_queue_buffered.function = lambda: len(pipe_queue)
     
-    check_archive_hard_drive_usage_period= 300
-    check_archive_hard_drive_usage_timer=time.time() - (2*check_archive_hard_drive_usage_period)
+    # Housekeeping, each on its own cadence and thread, away from the token launching
+    dated_folder_cameras = {'mrc': ['sq003ms', 'sq101sm'], 'eco': ['ec002cs', 'ec003zwo', 'eco3zwo']}
+    dated_folder_days_ahead = {'eco': 1}
+    processing_disk_room = threading.Event()
+    processing_disk_room.set()
+    
+    def check_archive_disk():
+        print ("checking archive usage")
+        print ("Diskspace Free: " + str(archive_culler.free_fraction() * 100) + '%')
+        archive_culler.check()
+    
+    def check_processing_disk():
+        # Don't start more EVA runs while the processing disk is nearly full
+        if processing_disk_has_room(processing_temp_directory):
+            processing_disk_room.set()
+        else:
+            processing_disk_room.clear()
+    
+    def scan_ingester_directory():
+        if config["ingest_to_ptrarchive"]:
+            process_ingester_directory(ingester_directory, failed_ingestion_directory)
+    
+    housekeeping = PeriodicTaskScheduler()
+    housekeeping.add('archive_disk', check_archive_disk,
+                     period=config.get('archive_disk_check_period', 300))
+    housekeeping.add('processing_disk', check_processing_disk,
+                     period=config.get('processing_disk_check_period', 30))
+    # Only does anything without inotify, when it is a full scandir and a
+    # stat per sidecar, so the same 30 s the main loop always used
+    housekeeping.add('ingester_scan', scan_ingester_directory,
+                     period=config.get('ingester_scan_period', 30), timeout=600)
+    cameras = config.get('dated_folder_cameras', dated_folder_cameras.get(pipe_id, []))
+    if cameras:
+        housekeeping.add('dated_folders',
+                         functools.partial(provision_dated_folders, archive_base_directory, cameras,
+                                           config.get('dated_folder_days_ahead', dated_folder_days_ahead.get(pipe_id, 0))),
+                         next_run=next_day_rollover, timeout=600)
+    # Keeps the journal and its content index from growing for as long as the watcher runs
+    housekeeping.add('journal_prune',
+                     functools.partial(ingestion_journal.prune,
+                                       content_max_age_days=config.get('content_index_max_age_days', 180)),
+                     next_run=next_day_rollover, timeout=600)
+    housekeeping.start()
+    
+    # Each part of the watcher beats as it makes progress, and the heartbeat
+    # monitor.sh looks at is only touched while none of them are stalled
+    health_monitor.register('main_loop', config.get('main_loop_stall_seconds', 600))
+    health_monitor.register('eva_registry', 120)
+    health_monitor.register('culler', config.get('culler_stall_seconds', 1800),
+                            idle=lambda: not archive_culler.busy())
+    if config["ingest_to_ptrarchive"]:
+        health_monitor.register('ingestion', config.get('ingestion_stall_seconds', 900),
+                                idle=lambda: ingester_queue.qsize() == 0 and ingest_in_flight.total() == 0)
+    if ingester_directory_watcher is not None:
+        health_monitor.register('ingester_directory_watcher', 300)
+    health_monitor.started()
+    
+    # Metrics for Prometheus, or anyone with curl
+    tokens_pending.function = lambda: len(token_index) + (len(token_coalescer) if token_coalescer is not None else 0)
+    eva_registry.add_listener(observe_eva_run)
+    if config.get('metrics_port', 9108):
+        try:
+            start_metrics_server(config.get('metrics_address', '127.0.0.1'), config.get('metrics_port', 9108))
+        except OSError:
+            print("Couldn't start the metrics server")
+            print(traceback.format_exc())
     
     # Simple watcher loop    
+    loop_start = None
     while True:
+        if loop_start is not None:
+            main_loop_seconds.observe(time.monotonic() - loop_start)
+        loop_start = time.monotonic()
                     
-        # Check archive hard drive and cull.
-        if time.time() - check_archive_hard_drive_usage_timer > check_archive_hard_drive_usage_period:
-            print ("checking archive usage")
-            # reset timer
-            check_archive_hard_drive_usage_timer=time.time() 
-            # Check disk space
-            total, used, free =shutil.disk_usage(archive_base_directory)
-            diskspace_Free=free/total
-            print ("Diskspace Free: " + str(diskspace_Free * 100) + '%')
-            while diskspace_Free < 0.2:
-                find_and_delete_oldest_file(archive_base_directory+'/localptrarchive')
-                find_and_delete_oldest_file(archive_base_directory+'/EVAreducedfiles')
-                total, used, free =shutil.disk_usage(archive_base_directory)
-                diskspace_Free=free/total    
-        
-        if pipe_id=='mrc':
-            current_date_for_folder_construction= str(datetime.datetime.now()).split(' ')[0].replace('-','')
-            if not os.path.exists(archive_base_directory +'/localptrarchive/sq003ms'):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/sq003ms', mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/sq003ms/'+current_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/sq003ms/'+current_date_for_folder_construction, mode=0o777)
-                
-            if not os.path.exists(archive_base_directory +'/localptrarchive/sq101sm'):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/sq101sm', mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/sq101sm/'+current_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/sq101sm/'+current_date_for_folder_construction, mode=0o777)
-        
-        
-        if pipe_id=='eco':
-            current_date_for_folder_construction= str(datetime.datetime.now()).split(' ')[0].replace('-','')
-            tomorrows_date_for_folder_construction= str(datetime.datetime.now() + datetime.timedelta(days=1)).split(' ')[0].replace('-','')
-            if not os.path.exists(archive_base_directory +'/localptrarchive/ec002cs'):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/ec002cs', mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/ec002cs/'+current_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/ec002cs/'+current_date_for_folder_construction, mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/ec002cs/'+tomorrows_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/ec002cs/'+tomorrows_date_for_folder_construction, mode=0o777)
-        
-            if not os.path.exists(archive_base_directory +'/localptrarchive/ec003zwo'):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/ec003zwo', mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/ec003zwo/'+current_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/ec003zwo/'+current_date_for_folder_construction, mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/ec003zwo/'+tomorrows_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/ec003zwo/'+tomorrows_date_for_folder_construction, mode=0o777)
-            
-            
-            if not os.path.exists(archive_base_directory +'/localptrarchive/eco3zwo'):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/eco3zwo', mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/eco3zwo/'+current_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/eco3zwo/'+current_date_for_folder_construction, mode=0o777)
-            if not os.path.exists(archive_base_directory +'/localptrarchive/eco3zwo/'+tomorrows_date_for_folder_construction):
-                os.umask(0)
-                os.makedirs(archive_base_directory +'/localptrarchive/eco3zwo/'+tomorrows_date_for_folder_construction, mode=0o777) 
-        
-        
-        # Make sure we don't go over the diskspace limit while downloading
-        while True:
-            total, used, free = shutil.disk_usage(processing_temp_directory)
-            if (used / total) < 0.8:
-                break        
-            print("Waiting for diskspace to clear.")
-            print("Total: %d GiB" % (total // (2 ** 30)))
-            print("Used: %d GiB" % (used // (2 ** 30)))
-            print("Free: %d GiB" % (free // (2 ** 30)))      
-            time.sleep(30)    
-        
-        
-        # Here is the testing area for the PIPE communication code
-        # CURRENTLY NOT UNDER OPERATION, BUT WE CAN USE IT IN THE FUTURE
-        if False and pipe_id=='eco' and (time.time()- pipe_queue_timer) > 30:
-            pipe_queue_timer=time.time()
-            print ("Checking PIPE QUUEUE")
-            #Here check if queue exists and if not, create it.
-            if False:
-                uri_status = "https://api.photonranch.org/api/pipe/queue"
-                # NB None of the strings can be empty. Otherwise this put faults.
-                payload = {"queue_name": "lcs1"}
-            
-                data = json.dumps(payload)
-                try:                
-                    response = requests.post(uri_status, data=data, timeout=20)        
-                    if response.ok:
-                       # pass
-                       print("~")
-                       print (response)
-                except:
-                    print ("Whoaeut")     
-    
-            try:
-                # Check in on the queues
-                uri_status = "https://api.photonranch.org/api/pipe/queue/lcs1/dequeue"
-                response = requests.post(uri_status,timeout=20)# allow_redirects=False, headers=close_headers)
-                print (response)
-                print (response.content)
-                            
-                print ('404' in str(response))  
-                  
-                if not '404' in str(response):
-                    print ("WE GOT SOMETHING!")
-                    pipe_queue_timer=time.time()-300
-                    json_string = response.content.decode('utf-8')
-                    data = json.loads(json_string)
-                    token = data['id']
-                    requested_task=data['payload']['request']
-                    requested_task_content=data['payload']['request_content']
-                    
-                    print (requested_task)
-                    print (requested_task_content)
-                    
-                    if len(requested_task_content) == 1:
-                        if requested_task_content[0] == '':
-                            print ("we have found a blank one!!")
-                    
-                    elif requested_task == 'EVA_process_files':
-                        popen, info = launch_eva_pipeline(
-                            token=token,
-                            requested_task_content=requested_task_content,
-                            processing_temp_directory=processing_temp_directory,
-                            pipeid=evapipeid,
-                            EVA_py_directory=EVA_py_directory,
-                            local_calibrations_directory=local_calibrations_directory,
-                            site_name=pipe_id
-                        )
-                        print("Launched PID:", popen.pid)
-                        print("EVA info:", info)
-            except:
-                print ("Hit a snag somewhere? ")
-                print(traceback.format_exc())
-                
-        try:    
-            if config["ingest_to_ptrarchive"]:                    
-                process_ingester_directory(ingester_directory,failed_ingestion_directory)
-        except:
-            print ("Failed ingester directory")
-        
         print ("reading tokens")
         print (datetime.datetime.now())
-        touch_heartbeat()
+        health_monitor.beat('main_loop')
         
-        # reap any finished EVApipeline subprocesses
-        reap_zombies()
         
         # # Check there is new stuff in the local directory
         # tokens_in_directory=glob.glob(monitor_directories[0]+ '/*')
@@ -891,66 +4098,62 @@ def main():
         #             print(traceback.format_exc())
         #             completed_tokens.append(token)
         
-        monitor_dir = monitor_directories[0]
-        # completed_tokens should be filenames only, e.g. ["aro1_sq003ms_…", …]
-        completed = set(completed_tokens)
-        
-        # find the one oldest file not yet done
-        with os.scandir(monitor_dir) as it:
-            candidates = (
-                entry for entry in it
-                if entry.is_file() and entry.name not in completed          # ← use .name here
-            )
-            try:
-                oldest = min(candidates, key=lambda e: e.stat().st_mtime)
-            except ValueError:
-                oldest = None  # no new files
+        # As many of the oldest tokens as there is room to run, and if
+        # there's nothing we can do right now, don't spin
+        capacity = eva_admission.capacity() if processing_disk_room.is_set() else 0
+        work_waiting = len(token_index) or (pipe_queue is not None and len(pipe_queue))
+        token_index.wait(timeout=0 if capacity and work_waiting else 1,
+                         wake=[pipe_queue] if pipe_queue is not None and capacity else [])
+        if token_coalescer is not None:
+            # Everything waiting goes to the coalescer, which hands back the runs that are ready
+            for token_name, token_path in token_index.pop_ready(len(token_index)):
+                token_contents = read_token_file(token_name, token_path)
+                if token_contents is not None:
+                    token_coalescer.add(token_path, token_contents)
+            runs = token_coalescer.pop_ready(capacity)
+        else:
+            runs = []
+            for token_name, token_path in token_index.pop_ready(capacity):
+                token_contents = read_token_file(token_name, token_path)
+                if token_contents is not None:
+                    runs.append(([token_path], token_contents))
         
-        wait_for_resources(
-            ingester_directory=ingester_directory,
-            failed_ingestion_directory=failed_ingestion_directory, wait_for_harddrive=wait_for_harddrive, cpu_fraction=cpu_frac, memory_fraction=mem_frac, ingest_to_ptrarchive=config["ingest_to_ptrarchive"], workdrive=workdrive
-        )
+        runs = [(token_paths, token_contents, None) for token_paths, token_contents in runs]
         
-        if oldest:
-            token_name = oldest.name                                      # ← grab the name
-            token_path = os.path.join(monitor_dir, token_name)
+        # Local tokens first, then whatever room is left goes to the shared PIPE queue
+        if pipe_queue is not None:
+            local_tokens_waiting = len(token_index) or (token_coalescer is not None and len(token_coalescer))
+            runs += pipe_queue.take(capacity - len(runs))
+            pipe_queue.want(0 if local_tokens_waiting else capacity - len(runs))
         
+        for token_paths, token_contents, pipe_queue_lease in runs:
+            token_path = token_paths[0]
+            token_name = os.path.basename(token_path)
+            print(len(token_contents), "entries in", token_name, "" if len(token_paths) == 1 else f"and {len(token_paths) - 1} more tokens")
+            wait_for_eva_admission(token_contents)
             try:
-               # first, guard against an empty file
-               if os.path.getsize(token_path) == 0:
-                   print(f"Empty token file {token_name}, deleting.")
-                   os.remove(token_path)
-                   continue
-        
-               with open(token_path) as f:
-                   token_contents = json.load(f)
-        
-            except JSONDecodeError as e:
-                print(f"⚠️ JSONDecodeError for {token_name}: {e}. Deleting and skipping.")
-                os.remove(token_path)
-                continue
-             
-            except Exception:
-                # any other error you might still want to log and skip
-                print(f"🔴 Unexpected error for {token_name}:")
-                traceback.print_exc()
-                os.remove(token_path)
+                popen, info = launch_eva_pipeline(
+                    token=token_path,
+                    requested_task_content=token_contents,
+                    processing_temp_directory=processing_temp_directory,
+                    pipeid=evapipeid,
+                    EVA_py_directory=EVA_py_directory,
+                    local_calibrations_directory=local_calibrations_directory,
+                    site_name=pipe_id,
+                    code_snapshots=eva_code_snapshots,
+                    original_token_files=token_paths,
+                    calibration_cache=calibration_cache
+                )
+            except:
+                if pipe_queue_lease is None:
+                    raise
+                # Give it straight back so another pipe can have a go
+                print(traceback.format_exc())
+                pipe_queue.nack(pipe_queue_lease, reason="EVA failed to launch")
                 continue
-             
-            # — if we get here, token_contents is valid —
-            print(len(token_contents), "entries in", token_name)
-            popen, info = launch_eva_pipeline(
-                token=token_path,
-                requested_task_content=token_contents,
-                processing_temp_directory=processing_temp_directory,
-                pipeid=evapipeid,
-                EVA_py_directory=EVA_py_directory,
-                local_calibrations_directory=local_calibrations_directory,
-                site_name=pipe_id
-            )
-             
-            completed.add(token_name)
-            completed_tokens.append(token_name)
+            eva_admission.launched(popen, token_name, token_contents, eva_code_version=info['eva_code_version'],
+                                   original_token_files=info['original_token_files'],
+                                   pipe_queue_lease=pipe_queue_lease)
              
             # try:
             #     with open(token_path) as f: